@@ -1,14 +1,19 @@
-import copy
 import os
 
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 # import scanpy as sc
-from matplotlib.pyplot import rc_context
-from database_connections import find_similarities
 
+import metrics
+from database_connections import expand_frontier, fetch_file_names, load_source_matrix, source_rows
+from gene_index import DEFAULT_TOP_N, get_gene_index, has_gene_index, top_n_columns
+from knn_graph import expand_over_graph, load_knn_graph, snn_clusters
+from results_writer import ResultsWriter
 
-def find_clusters(collection, seed_ids, limit=1024, iterations=5):
+
+def find_clusters(collection, seed_ids, limit=1024, iterations=5, batch_size=100, parallelism=4, use_cache=True,
+                  graph=None, experiments=None, min_similarity=None, adaptive=False, results_path=None):
     """
     Identifies clusters of similar cells starting from seed cell IDs and iteratively expands the search.
 
@@ -20,6 +25,22 @@ def find_clusters(collection, seed_ids, limit=1024, iterations=5):
     :param seed_ids (list): A list of initial cell IDs to start the clustering process.
     :param limit (int, optional): The maximum number of similar cells to retrieve per query. Defaults to 1024.
     :param iterations (int, optional): The number of iterations to perform. Defaults to 5.
+    :param batch_size (int, optional): Cells per search request. Defaults to 100.
+    :param parallelism (int, optional): Maximum number of concurrent search requests. Defaults to 4.
+    :param use_cache (bool, optional): Reuse neighbor results cached by earlier runs. Defaults to True.
+    :param graph (str or tuple, optional): Expand over a precomputed kNN graph instead of querying the
+        collection: a path written by knn_graph.py, or a (keys, graph) tuple. The graph must store at least
+        limit neighbors per cell. Defaults to None (query the collection).
+    :param experiments (list, optional): Only expand into cells of these experiment numbers; only their
+        partitions are searched. Not supported together with graph. Defaults to None (every experiment).
+    :param min_similarity (float, optional): Only follow neighbors with at least this cosine similarity. Far
+        fewer ids come back per query in sparse regions, which also keeps the next frontier small. Not
+        supported together with graph. Defaults to None (always take limit neighbors).
+    :param adaptive (bool, optional): With min_similarity, ask for a few neighbors first and grow the number
+        (up to limit) only for queries whose neighbors all cleared the threshold. Defaults to False.
+    :param results_path (str, optional): Also append every searched cell's neighbors to the Parquet results
+        dataset in this directory (see results_writer.py), one batch per iteration as it finishes. Not
+        supported together with graph. Defaults to None.
 
     Returns:
     pandas.DataFrame: A DataFrame containing the cell IDs and their counts that meet the frequency cutoff.
@@ -34,85 +55,73 @@ def find_clusters(collection, seed_ids, limit=1024, iterations=5):
     clustered cell IDs and their counts.
 
     Note:
-    The function saves the results to a CSV file in the 'data' directory. The file name includes the first seed ID,
-    the number of iterations, and the limit used for the queries.
+    The function saves the results to a Parquet file in the 'data' directory. The file name includes the first
+    seed ID, the number of iterations, and the limit used for the queries.
     """
     cutoff = limit * iterations
     it_temp = iterations
     results = {}
     next_queries = set(seed_ids)
     already_queried = set()
-    size = 100
+    vectors = {}
     queried_cells = 0
+    if graph is not None and experiments is not None:
+        raise ValueError('experiments cannot be used with a precomputed graph; build the graph from a '
+                         'collection holding only those experiments instead')
+    if graph is not None and min_similarity is not None:
+        raise ValueError('min_similarity cannot be used with a precomputed graph')
+    if graph is not None and results_path is not None:
+        raise ValueError('results_path cannot be used with a precomputed graph, which has no similarities')
+    writer = ResultsWriter(results_path) if results_path is not None else None
+    if graph is not None:
+        # Same expansion and counting, as sparse matrix products over the stored graph
+        keys, adjacency = load_knn_graph(graph) if isinstance(graph, str) else graph
+        with metrics.span('clusters.graph_expand', seeds=len(seed_ids), iterations=iterations):
+            results, queried_cells = expand_over_graph(keys, adjacency, seed_ids, limit, iterations)
+        iterations = 0
     while iterations > 0:
-        print(f'iter: {iterations}')
-        # print(f'already queried: {already_queried}')
-        # print(f'next_queries: {next_queries}')
-        length = len(next_queries)
-
-        print(f'cells to query: {length}')
-        exit_loop = False
-        next_queries2 = set()
-        counter = size
-        while True:
-            query_list = []
-            for j in range(size):
-                try:
-                    query_list.append(next_queries.pop())
-                except KeyError:
-                    exit_loop = True
-                    break
-
-            #print(f'query list: {query_list}')
-            if not len(query_list):
-                break
-
-            milvus = find_similarities(collection, query_list, limit)
-            queried_cells += len(query_list)
-            print(f'Queried {counter}...')
-            counter += size
-
-            #print(milvus)
+        # Search the whole frontier concurrently. Matches come back with their vectors,
+        # so only the seeds ever need a separate get()
+        with metrics.span('clusters.expand', frontier=len(next_queries)):
+            milvus, match_vectors = expand_frontier(collection, next_queries, vectors, limit,
+                                                    batch_size=batch_size, parallelism=parallelism,
+                                                    use_cache=use_cache, experiments=experiments,
+                                                    min_similarity=min_similarity, adaptive=adaptive)
+        queried_cells += len(milvus)
+        if writer is not None:
+            with metrics.span('clusters.write_results', queries=len(milvus)):
+                neighbor_ids = {cell_id2 for matches in milvus.values() for cell_id2, _ in matches}
+                writer.write(milvus, fetch_file_names(collection, neighbor_ids))
+
+        with metrics.span('clusters.aggregate', queries=len(milvus)):
+            next_queries = set()
             for cell_id in milvus.keys():
-                #print(milvus[cell_id])
                 for cell_id2, _ in milvus[cell_id]:
                     if cell_id2 in results.keys():
                         results[cell_id2] += 1
                     else:
                         results[cell_id2] = 1
-
+                    next_queries.add(cell_id2)
                 already_queried.add(cell_id)
-                # print(f'\tAQ: {already_queried}')
-                for id2, _ in milvus[cell_id]:
-                    # id, similarity tuple
-                    if id2 not in already_queried:
-                        # print(f'\tAdding {id2} to query')
-                        next_queries2.add(id2)
-
-            if exit_loop:
-                break
+            next_queries -= already_queried
 
-        next_queries = set(next_queries2)
-        # print(f'Queries for next it: {next_queries}')
-
-        # print(f'cells to query: {length}')
+        # Keep only the vectors the next frontier needs. Matches of cached queries have
+        # no vector yet and are fetched by the next expand_frontier call if needed
+        vectors = {cell_id: match_vectors[cell_id] for cell_id in next_queries if cell_id in match_vectors}
 
         iterations -= 1
 
+    if writer is not None:
+        writer.close()
 
-    counter3 = 0
-    for key in results.keys():
-        counter3 += results[key]
-    print(f'queried cells: {queried_cells}, result length: {len(results.keys())}, res total: {counter3}')
-    print(results)
+    metrics.count('clusters.queried_cells', queried_cells)
+    metrics.count('clusters.reached_cells', len(results))
     # Only return cells that appear iterations-1 times
-    out = pd.DataFrame(columns=['cell_id', 'count'])
-    for cid in results.keys():
-        if results[cid] >= cutoff:
-            temp = (cid, results[cid])
-            out.loc[len(out)] = temp
-    save_path = os.path.join('data', f'ex_2_seed{seed_ids[0]}-list_i{it_temp}_l{limit}.csv')
-    out.to_csv(save_path, index=False)
+    counts = pd.Series(results, dtype=np.int64)
+    counts = counts[counts >= cutoff]
+    out = pd.DataFrame({'cell_id': counts.index.to_numpy(dtype=np.int64), 'count': counts.to_numpy()})
+    save_path = os.path.join('data', f'ex_2_seed{seed_ids[0]}-list_i{it_temp}_l{limit}.parquet')
+    out.to_parquet(save_path, index=False)
 
     return out
 
@@ -146,123 +155,195 @@ def find_clusters(collection, seed_ids, limit=1024, iterations=5):
 
 
 
-def get_similar_cell_ids(similarity_obj):
+def cluster_cells(collection, seed_ids, limit=50, hops=2, prune=0.15, batch_size=100, parallelism=4,
+                  use_cache=True, experiments=None, min_similarity=None):
+    """
+    Partitions every cell reached from the seeds into shared-nearest-neighbor communities.
+
+    Instead of repeating expansions until hit counts pass a cutoff (find_clusters), this searches every
+    reached cell at most once: the seeds, then the cells they reach, for hops rounds. The neighbor lists
+    are accumulated as edges of one sparse kNN matrix, which knn_graph.snn_clusters splits into
+    communities. Every reached cell gets a label, including the cells of the last round that were
+    reached but not searched themselves.
+
+    :param collection (str): The collection to query.
+    :param seed_ids (list): Cell IDs to start from.
+    :param limit (int, optional): Neighbors per searched cell (the k of the kNN graph). Defaults to 50.
+    :param hops (int, optional): Rounds of searches. 1 only searches the seeds. Communities are only as
+        coherent as the searched cells are dense, so too few searched cells per population splits it into
+        several communities; raise limit or hops if that happens. Defaults to 2.
+    :param prune (float, optional): Smallest Jaccard index of two cells' neighborhoods that links them.
+        Defaults to 0.15.
+    :param batch_size (int, optional): Cells per search request. Defaults to 100.
+    :param parallelism (int, optional): Maximum number of concurrent search requests. Defaults to 4.
+    :param use_cache (bool, optional): Reuse neighbor results cached by earlier runs. Defaults to True.
+    :param experiments (list, optional): Only reach cells of these experiment numbers. Defaults to None.
+    :param min_similarity (float, optional): Only keep edges to neighbors with at least this cosine
+        similarity. Defaults to None.
+
+    Returns:
+    pandas.DataFrame: Columns cell_id, cluster (0 is the largest community) and searched (whether the
+    cell's own neighbors were part of the graph), one row per reached cell. It is also saved to a Parquet
+    file in the 'data' directory.
+    """
+    sources = []
+    targets = []
+    frontier = set(seed_ids)
+    searched = set()
+    vectors = {}
+    for _ in range(hops):
+        if not frontier:
+            break
+        with metrics.span('clusters.expand', frontier=len(frontier)):
+            neighbors, match_vectors = expand_frontier(collection, frontier, vectors, limit, batch_size=batch_size,
+                                                       parallelism=parallelism, use_cache=use_cache,
+                                                       experiments=experiments, min_similarity=min_similarity)
+        searched.update(frontier)
+        for cell_id, matches in neighbors.items():
+            sources.append(np.full(len(matches), cell_id, dtype=np.int64))
+            targets.append(np.fromiter((match[0] for match in matches), dtype=np.int64, count=len(matches)))
+        frontier = set(np.concatenate(targets).tolist()) - searched if targets else set()
+        vectors = {cell_id: match_vectors[cell_id] for cell_id in frontier if cell_id in match_vectors}
+
+    sources = np.concatenate(sources) if sources else np.empty(0, dtype=np.int64)
+    targets = np.concatenate(targets) if targets else np.empty(0, dtype=np.int64)
+    # Seeds that are not stored have no neighbors and are left out
+    cell_ids, nodes = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+    edges = len(sources)
+    graph = sp.csr_matrix((np.ones(edges, dtype=np.float32), (nodes[:edges], nodes[edges:])),
+                          shape=(len(cell_ids), len(cell_ids)))
+    is_searched = np.isin(cell_ids, list(searched))
+    with metrics.span('clusters.snn', rows=len(cell_ids), nnz=graph.nnz):
+        labels = snn_clusters(graph, prune, searched=is_searched)
+    metrics.count('clusters.queried_cells', len(searched))
+    metrics.count('clusters.reached_cells', len(cell_ids))
+
+    out = pd.DataFrame({'cell_id': cell_ids, 'cluster': labels, 'searched': is_searched})
+    save_path = os.path.join('data', f'snn_seed{seed_ids[0]}_h{hops}_l{limit}.parquet')
+    out.to_parquet(save_path, index=False)
+    return out
+
+
+def get_similar_cell_ids(similarity_obj, collection=None, path=os.path.join('data', 'similar_cells')):
     """
-    Processes similarity data and saves the results to CSV files.
+    Saves similarity results as one long table in a Parquet dataset.
 
     This function takes a dictionary of similarity objects where each key represents a query vector,
     and the value is a list of tuples containing cell IDs and their corresponding cosine similarity scores.
-    For each query vector, the function creates a DataFrame to store the cell IDs and their cosine similarity scores,
-    and then saves this DataFrame as a CSV file in the 'data' directory.
+    Every (query, match) pair becomes one row of query_id, neighbor_id, similarity, rank and file_name,
+    built from flat arrays and appended to the dataset at path, partitioned by the experiment of the match
+    (see results_writer.py). Calling it again appends to the same dataset.
 
     :param similarity_obj (dict): A dictionary where keys are query vectors (typically identifiers) and values are lists of tuples.
                            Each tuple contains a cell ID and a cosine similarity score.
+    :param collection (str, optional): Collection the matches are stored in, used to fill in their source
+        file names with one request. Defaults to None (file_name is left empty).
+    :param path (str, optional): Directory of the results dataset. Defaults to 'data/similar_cells'.
+
+    Returns:
+    int: The number of rows written.
 
     Example:
     similarity_obj = {
-        'query1': [(123, 0.98), (456, 0.95)],
-        'query2': [(789, 0.99), (101, 0.97)]
+        101: [(123, 0.98), (456, 0.95)],
+        102: [(789, 0.99), (101, 0.97)]
     }
     get_similar_cell_ids(similarity_obj)
 
-    This will create two CSV files in the 'data' directory:
-    - 'ex_2_Pool_B_queryquery1.csv' containing:
-        Cell_ids_query_query1, cosine_sim
-        123, 0.98
-        456, 0.95
-    - 'ex_2_Pool_B_queryquery2.csv' containing:
-        Cell_ids_query_query2, cosine_sim
-        789, 0.99
-        101, 0.97
+    This will append four rows to 'data/similar_cells':
+        query_id, neighbor_id, similarity, rank, file_name
+        101, 123, 0.98, 0, None
+        101, 456, 0.95, 1, None
+        102, 789, 0.99, 0, None
+        102, 101, 0.97, 1, None
+    read_results('data/similar_cells') reads them back as a DataFrame.
     """
+    file_names = None
+    if collection is not None:
+        file_names = fetch_file_names(collection, {match[0] for matches in similarity_obj.values()
+                                                   for match in matches})
+    with ResultsWriter(path) as writer:
+        return writer.write(similarity_obj, file_names)
 
-    for query_vec in similarity_obj.keys():
-        print(query_vec)
-        cell_ids = pd.DataFrame(columns=[f'Cell_ids_query_{query_vec}', 'cosine_sim'])
-        for match in similarity_obj[query_vec]:
-
-            cell_id = match[0]
-            cell_ids.loc[len(cell_ids)] = (cell_id, match[1])
 
-        save_path = os.path.join('data', f'ex_2_Pool_B_query{query_vec}.csv')
-        cell_ids.to_csv(save_path, index=False)
-
-
-def get_similar_genes(similarity_obj, file, top_n=327):
+def get_similar_genes(similarity_obj, file, top_n=DEFAULT_TOP_N, collection=None):
     """
     This function will:
         1. Find the original gene data for each cell in the top-n
             similar cells.
         2. Map the cell_ids to a cell_name from the respective experiment.
-        3. Return a dictionary with the keys [cell_id, cell_name, top_genes]
-            where cell_id and cell_name are from the vectors in Milvus and
-            top_genes is a list of the top_n genes expressed in each cell, ordered
-            most to least expressed.
+        3. Return a table with a cell_ids column followed by the top_n genes
+            expressed in each cell, ordered most to least expressed, where
+            cell_ids are the vectors returned by Milvus.
+    With a collection whose ingestion indexed file (see gene_index.py), the genes are
+    gathered from the precomputed top-gene index. Otherwise all matched cells are
+    gathered from the expression matrix with a single fancy index and ranked together.
+
     :param top_n: Top genes to return
     :param similarity_obj: A similarity dictionary from the find_similarities function
-    :return: See 2.
+    :param file: The file in the data directory the matched cells come from
+    :param collection: The collection the cells were ingested into, whose top-gene index to
+        use. Without one, or if its index keeps fewer than top_n genes, the matrix is ranked.
+    :return: See 3.
     """
-    print(f'** get_similar_genes function **')
-
-    # data = pd.read_csv('data/ex_1_pool_a.csv', delimiter=',', nrows=5, skiprows=2, header=None)
-    #
-    # print(data)
-
-
-    # Get original gene data
-    filepath = os.path.join('data', file)
-    print(f'Loading data from {filepath}... ', end='')
-    raw_data = pd.read_csv(filepath, delimiter=',')
-    print('Done')
-
-    cell_genes = pd.DataFrame(columns=np.arange(len(raw_data.columns)))
-    for query_vec in similarity_obj[0].keys():
-        counter = 0
-        for match in similarity_obj[0][query_vec]:
-
-            cell_id = match[0]
-            print(f'file {counter} (id {cell_id}): {match}')
-
-            #filepath = os.path.join('data', match[2])
-
-            #data = pd.read_csv(filepath, delimiter=',', nrows=1, skiprows=cell_id-724, header=None)
-            data = raw_data.loc[raw_data['Unnamed: 0'] == cell_id]
-            data_list = data.loc[:, :].values.flatten().tolist()
-            cell_genes.loc[len(cell_genes)] = data_list
-
-            counter += 1
-
-    print(cell_genes.head(10))
-
-    # Find the top_n most expressed genes
-    # Code from: https://stackoverflow.com/questions/34518634/finding-highest-values-in-each-row-in-a-data-frame-for-python
-    # expressed_genes = pd.DataFrame({n: df.T[col].nlargest(top_n).index.tolist() for n, col in enumerate(df.T)}).T
-    # index = 0
-    # offset = len(similarity_obj[0].keys())
-    data = cell_genes
-    cell_ids = data[[0]].copy()
+    # Every match of every query, in order
+    match_ids = np.asarray([match[0] for query_vec in similarity_obj[0].keys()
+                            for match in similarity_obj[0][query_vec]])
+
+    if collection is not None and has_gene_index(collection, file, top_n):
+        index = get_gene_index(collection, file)
+        found, gene_idx, _ = index.top_genes(match_ids, top_n)
+        gene_names = index.gene_names
+    else:
+        # Get original gene data from the binary cache of the CSV, or the sparse matrix
+        raw_data = load_source_matrix(os.path.join('data', file))
+        rows = source_rows(file, raw_data, match_ids)
+        found = rows >= 0
+        rows = rows[found]
+        # Find the top_n most expressed genes for all matched cells, gathering a block
+        # of rows at a time so the gathered copy stays small for wide matrices
+        block = 1024
+        with metrics.span('genes.top_n', rows=len(rows), top_n=top_n):
+            gene_idx = np.concatenate(
+                [top_n_columns(raw_data.values[rows[i:i + block]], top_n)[0] for i in range(0, len(rows), block)]
+                or [np.empty((0, min(top_n, raw_data.shape[1])), dtype=np.int64)])
+        gene_names = raw_data.genes
+    if not found.all():
+        print(f'Warning: {(~found).sum()} of {len(found)} matched cells are not in {file} (neither by '
+              f'experiment key nor by cell id) and were skipped')
+    match_ids = match_ids[found]
+
+    cell_ids = pd.DataFrame({0: match_ids})
     save_path = os.path.join('data', f'{file}_top{top_n}_to_id_825_CELL_IDS.csv')
     cell_ids.to_csv(save_path, index=False)
-    return
-    cell_ids.rename(columns={0: -1}, inplace=True)
-    data = data.drop(columns=[0], axis=1)
-    expressed_genes = pd.DataFrame({n: data.T[col].nlargest(top_n).index.tolist() for n, col in enumerate(data.T)}).T
-
-    # Join back in cell_ids
-    expressed_genes = expressed_genes.join(cell_ids)
 
-    # Put cell_id column first
-    expressed_genes = expressed_genes.reindex(columns=sorted(expressed_genes.columns))
-    expressed_genes.rename(columns={-1: 'cell_ids'}, inplace=True)
+    expressed_genes = pd.DataFrame(gene_names[gene_idx])
+    expressed_genes.insert(0, 'cell_ids', match_ids)
 
     save_path = os.path.join('data', f'{file}_top{top_n}_to_id_825.csv')
     expressed_genes.to_csv(save_path, index=False)
 
-    pd.set_option('display.max_columns', None)
-    pd.set_option('display.width', 300)
-    #print(f'cell_genes: {cell_genes}')
-    print(f'expressed genes: {expressed_genes}')
+    print(f'Found top {gene_idx.shape[1]} genes for {len(match_ids)} cells')
+    return expressed_genes
+
+
+def find_marker_cells(collection, file, gene, max_rank=None):
+    """
+    Cells of an experiment that have a gene among their most expressed genes, from the
+    gene -> cells side of the top-gene index built at ingestion.
+
+    :param collection (str): The collection the experiment was ingested into.
+    :param file (str): The experiment's file in the data directory.
+    :param gene (str): The marker gene.
+    :param max_rank (int, optional): Only cells with the gene among their max_rank most expressed genes.
+        Defaults to None (anywhere in the indexed top genes).
 
+    Returns:
+    pandas.DataFrame: Columns cell_id, rank (0 is the cell's most expressed gene) and expression, ordered by
+    decreasing expression.
+    """
+    keys, ranks, values = get_gene_index(collection, file).cells_with_gene(gene, max_rank)
+    return pd.DataFrame({'cell_id': keys, 'rank': ranks, 'expression': values})
 
 
 def plot_umap(gene_map):
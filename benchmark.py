@@ -0,0 +1,312 @@
+"""
+Benchmark of ingest, similarity search and clustering on synthetic scRNA-seq data.
+
+Synthetic count matrices with planted clusters are written in the usual
+data/ex_N_*.csv layout inside a scratch working directory (the cells split over
+--experiments experiments), ingested with insert_data, and then searched and
+clustered (with the find_clusters cutoff and with cluster_cells). Search
+latency is also measured against the number of experiment partitions searched,
+and recall@k, latency and memory of the quantized local indexes (IVF_SQ8,
+IVF_PQ) are compared with the exact one. Results are written
+as JSON so runs from different versions can be compared.
+
+Usage:
+    python benchmark.py --cells 20000 --genes 2000 --out bench.json
+Runs against the in-process local backend unless --backend milvus is given.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import database_connections
+from database_connections import find_similarities, insert_data
+from ingest import experiment_primary_keys
+from knn_graph import export_vectors
+from local_backend import LocalCollection
+from schema import pq_subvectors
+
+
+def make_synthetic_experiment(experiment_num, n_cells, n_genes, sparsity=0.9, n_clusters=8, seed=0,
+                              directory='data', chunk_rows=5000):
+    """
+    Write a synthetic log-normalized count matrix with planted clusters.
+
+    Every cluster scales a shared gene baseline by its own log-normal marker profile.
+    Counts are Poisson draws from the cluster mean, with dropout zeroing a sparsity
+    fraction of the entries, followed by log1p. Rows are generated and written a chunk
+    at a time, so large matrices never have to fit in memory.
+
+    :param experiment_num: Experiment number used in the file name and primary keys.
+    :param n_cells: Number of cells (rows).
+    :param n_genes: Number of genes (columns).
+    :param sparsity: Fraction of entries forced to zero by dropout.
+    :param n_clusters: Number of planted clusters.
+    :param seed: Random seed.
+    :param directory: Directory to write to.
+    :param chunk_rows: Cells generated per chunk.
+    :return: A tuple (filename, labels): the CSV file name inside directory and the
+        planted cluster of every cell.
+    """
+    rng = np.random.default_rng(seed)
+    baseline = rng.gamma(2.0, 1.0, size=n_genes)
+    profiles = baseline * rng.lognormal(0.0, 1.0, size=(n_clusters, n_genes))
+    labels = rng.integers(n_clusters, size=n_cells)
+    keys = experiment_primary_keys(experiment_num, n_cells)
+    genes = [f'gene{i}' for i in range(n_genes)]
+
+    filename = f'ex_{experiment_num}_synthetic.csv'
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, filename), 'w') as fh:
+        for start in range(0, n_cells, chunk_rows):
+            stop = min(start + chunk_rows, n_cells)
+            counts = rng.poisson(profiles[labels[start:stop]]).astype(np.float32)
+            counts[rng.random(counts.shape) < sparsity] = 0
+            chunk = pd.DataFrame(np.log1p(counts), columns=genes)
+            chunk.insert(0, '', keys[start:stop])
+            chunk.to_csv(fh, index=False, header=start == 0, float_format='%.4g')
+    return filename, labels
+
+
+def percentiles(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'calls': len(latencies),
+    }
+
+
+def exact_neighbors(keys, vectors, query_ids, limit):
+    """
+    Brute-force cosine neighbors, the reference recall is measured against.
+    """
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    rows = pd.Index(keys).get_indexer(query_ids)
+    scores = unit[rows] @ unit.T
+    top = np.argsort(-scores, axis=1, kind='stable')[:, :limit]
+    return {query_id: set(keys[row_top].tolist()) for query_id, row_top in zip(query_ids, top)}
+
+
+def bench_ingest(collection, filenames, n_cells):
+    start = time.perf_counter()
+    for filename in filenames:
+        if insert_data(collection, filename) != 0:
+            raise RuntimeError(f'Ingest of {filename} failed')
+    seconds = time.perf_counter() - start
+    return {'rows': n_cells, 'files': len(filenames), 'seconds': seconds, 'rows_per_s': n_cells / seconds}
+
+
+def bench_search(collection, keys, batch_sizes, limits, repeats, rng):
+    results = []
+    for limit in limits:
+        for batch_size in batch_sizes:
+            latencies = []
+            for _ in range(repeats):
+                query_ids = rng.choice(keys, size=batch_size, replace=False).tolist()
+                start = time.perf_counter()
+                find_similarities(collection, query_ids, limit=limit, use_cache=False)
+                latencies.append(time.perf_counter() - start)
+            results.append({'limit': limit, 'batch_size': batch_size, **percentiles(latencies)})
+    return results
+
+
+def bench_partitions(collection, keys, n_experiments, batch_size, limit, repeats, rng):
+    """
+    Latency of find_similarities restricted to the first 1, 2, ... experiments,
+    and over the whole collection. Queries are drawn from every experiment.
+    """
+    results = []
+    for n_searched in list(range(1, n_experiments + 1)) + [None]:
+        experiments = None if n_searched is None else list(range(1, n_searched + 1))
+        latencies = []
+        for _ in range(repeats):
+            query_ids = rng.choice(keys, size=min(batch_size, len(keys)), replace=False).tolist()
+            start = time.perf_counter()
+            find_similarities(collection, query_ids, limit=limit, use_cache=False, experiments=experiments)
+            latencies.append(time.perf_counter() - start)
+        results.append({'partitions': n_searched or 'all', 'limit': limit, 'batch_size': batch_size,
+                        **percentiles(latencies)})
+    return results
+
+
+def bench_recall(collection, keys, vectors, limits, n_queries, rng):
+    results = []
+    query_ids = rng.choice(keys, size=min(n_queries, len(keys)), replace=False).tolist()
+    for limit in limits:
+        found = find_similarities(collection, list(query_ids), limit=limit, use_cache=False)
+        exact = exact_neighbors(keys, vectors, query_ids, limit)
+        recall = [len(exact[q] & {match[0] for match in found.get(q, [])}) / len(exact[q]) for q in query_ids]
+        results.append({'limit': limit, 'queries': len(query_ids), 'recall': float(np.mean(recall))})
+    return results
+
+
+def bench_quantization(keys, vectors, limits, n_queries, refine_ks, rng):
+    """
+    Recall@k, latency and memory of the quantized local indexes against exact search,
+    each built in memory from the exported collection vectors.
+    """
+    results = []
+    query_ids = rng.choice(keys, size=min(n_queries, len(keys)), replace=False)
+    queries = vectors[pd.Index(keys).get_indexer(query_ids)]
+    exact = {limit: exact_neighbors(keys, vectors, query_ids.tolist(), limit) for limit in limits}
+    for index_type, params in [('FLAT', {}), ('IVF_SQ8', {}), ('IVF_PQ', {'m': pq_subvectors(vectors.shape[1])})]:
+        collection = LocalCollection('quantization', vectors.shape[1], index_type=index_type, index_params=params)
+        collection.insert_columns(keys, vectors)
+        start = time.perf_counter()
+        collection.build_index()
+        build_seconds = time.perf_counter() - start
+        memory = collection.memory_usage()
+        index_bytes = memory.get('codes', memory['vectors']) + memory.get('codebooks', 0)
+        for refine_k in (refine_ks if index_type != 'FLAT' else [1]):
+            for limit in limits:
+                start = time.perf_counter()
+                rows, _ = collection.search(queries, limit, refine_k=refine_k)
+                seconds = time.perf_counter() - start
+                recall = [len(exact[limit][q] & set(keys[r].tolist())) / len(exact[limit][q])
+                          for q, r in zip(query_ids.tolist(), rows)]
+                results.append({'index_type': index_type, 'params': params, 'refine_k': refine_k, 'limit': limit,
+                                'recall': float(np.mean(recall)), 'ms_per_query': 1000 * seconds / len(queries),
+                                'build_seconds': build_seconds, 'index_bytes': index_bytes,
+                                'memory_reduction': memory['vectors'] / index_bytes})
+    return results
+
+
+def bench_range(collection, keys, thresholds, limit, n_queries, rng):
+    """
+    Result volume and next-frontier size of find_similarities at a fixed limit, without
+    a threshold and with each min_similarity (plain and adaptive range search).
+    """
+    results = []
+    query_ids = rng.choice(keys, size=min(n_queries, len(keys)), replace=False).tolist()
+    for min_similarity in [None, *thresholds]:
+        for adaptive in ([False] if min_similarity is None else [False, True]):
+            start = time.perf_counter()
+            out = find_similarities(collection, query_ids, limit=limit, use_cache=False,
+                                    min_similarity=min_similarity, adaptive=adaptive)
+            seconds = time.perf_counter() - start
+            frontier = {match_id for matches in out.values() for match_id, _ in matches}
+            results.append({'min_similarity': min_similarity, 'adaptive': adaptive, 'limit': limit,
+                            'queries': len(query_ids), 'seconds': seconds,
+                            'results': sum(len(matches) for matches in out.values()),
+                            'frontier': len(frontier)})
+    return results
+
+
+def bench_clusters(collection, keys, iterations_list, limit, n_seeds, rng):
+    results = []
+    seeds = rng.choice(keys, size=n_seeds, replace=False).tolist()
+    for iterations in iterations_list:
+        start = time.perf_counter()
+        out = analysis.find_clusters(collection, seeds, limit=limit, iterations=iterations, use_cache=False)
+        results.append({'method': 'cutoff', 'iterations': iterations, 'limit': limit, 'seeds': n_seeds,
+                        'seconds': time.perf_counter() - start, 'cells_returned': len(out)})
+        start = time.perf_counter()
+        out = analysis.cluster_cells(collection, seeds, limit=limit, hops=iterations, use_cache=False)
+        results.append({'method': 'snn', 'iterations': iterations, 'limit': limit, 'seeds': n_seeds,
+                        'seconds': time.perf_counter() - start, 'cells_returned': len(out),
+                        'communities': int(out['cluster'].nunique())})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(args):
+    rng = np.random.default_rng(args.seed)
+    collection = 'benchmark'
+
+    print(f'Generating {args.cells} x {args.genes} synthetic cells in {args.experiments} experiments...')
+    filenames = []
+    for experiment_num in range(1, args.experiments + 1):
+        n_cells = args.cells // args.experiments + (experiment_num <= args.cells % args.experiments)
+        filename, _ = make_synthetic_experiment(experiment_num, n_cells, args.genes, args.sparsity, args.clusters,
+                                                args.seed + experiment_num)
+        filenames.append(filename)
+
+    report = {
+        'version': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': {'python': sys.version.split()[0], 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'backend': args.backend,
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('out', 'workdir')},
+    }
+    print('Benchmarking ingest...')
+    report['ingest'] = bench_ingest(collection, filenames, args.cells)
+    database_connections.get_client().flush(collection)
+
+    keys, vectors = export_vectors(collection)
+    print('Benchmarking find_similarities...')
+    report['search'] = bench_search(collection, keys, args.batch_sizes, args.limits, args.repeats, rng)
+    report['partitions'] = bench_partitions(collection, keys, args.experiments, max(args.batch_sizes),
+                                            min(args.limits), args.repeats, rng)
+    report['recall'] = bench_recall(collection, keys, vectors, args.limits, args.recall_queries, rng)
+    report['range'] = bench_range(collection, keys, args.min_similarities, max(args.limits), args.recall_queries, rng)
+    print('Benchmarking quantized indexes...')
+    report['quantization'] = bench_quantization(keys, vectors, args.limits, args.recall_queries, args.refine_ks, rng)
+    print('Benchmarking find_clusters...')
+    report['clusters'] = bench_clusters(collection, keys, args.iterations, args.cluster_limit, args.seeds, rng)
+    return report
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingest, search and clustering on synthetic data')
+    parser.add_argument('--cells', type=int, default=5000)
+    parser.add_argument('--genes', type=int, default=1000)
+    parser.add_argument('--experiments', type=int, default=4, help='Experiments (partitions) the cells are split into')
+    parser.add_argument('--sparsity', type=float, default=0.9)
+    parser.add_argument('--clusters', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-sizes', type=int_list, default=[1, 10, 100])
+    parser.add_argument('--limits', type=int_list, default=[10, 100, 1024])
+    parser.add_argument('--repeats', type=int, default=20, help='Calls per (batch size, limit) pair')
+    parser.add_argument('--recall-queries', type=int, default=100)
+    parser.add_argument('--refine-ks', type=int_list, default=[1, 4, 16],
+                        help='Re-ranked shortlist sizes (multiples of the limit) for the quantized indexes')
+    parser.add_argument('--min-similarities', type=float_list, default=[0.5, 0.7, 0.9],
+                        help='Range search thresholds compared against a fixed limit')
+    parser.add_argument('--iterations', type=int_list, default=[1, 2, 3])
+    parser.add_argument('--cluster-limit', type=int, default=64)
+    parser.add_argument('--seeds', type=int, default=5)
+    parser.add_argument('--backend', default='local', choices=['local', 'milvus'])
+    parser.add_argument('--workdir', default=None, help='Scratch directory (default: a new temp directory)')
+    parser.add_argument('--out', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='scmilvus_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    # All data/ paths (CSV, caches, local collections) resolve inside the scratch directory
+    os.chdir(workdir)
+    database_connections.BACKEND = args.backend
+
+    report = run_benchmark(args)
+    with open(out, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Wrote results to {out}')
+
+
+if __name__ == '__main__':
+    main()
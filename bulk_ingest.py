@@ -0,0 +1,227 @@
+"""
+Parallel ingestion of a directory of experiments.
+
+Every ex_N_*.csv (or sparse ex_N_* input) in the directory is loaded, embedded
+with its own PCA and split into batches by a worker process, one experiment per
+worker. The workers put their batches on one bounded queue, and this process
+uploads from it through a single client with a shared rate limit, so parsing
+and PCA use every core while the database sees one steady stream of inserts.
+
+Cells are numbered with the experiment primary key convention (experiment
+digit + 5-digit cell index), so experiments never collide, and each experiment
+goes into its own partition. Every experiment is
+checkpointed as in insert_data and a rerun resumes where it stopped.
+
+Usage:
+    python bulk_ingest.py <collection> <directory> [--processes 8] [--max-rows-per-second 20000]
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from checkpoint import IngestCheckpoint
+from database_connections import (fit_projection, get_client, load_experiment, projection_method,
+                                  verify_ingest)
+from gene_index import ensure_gene_index
+from ingest import PRIMARY_KEY_SCHEME, Batch, RateLimiter, run_pipeline
+from neighbor_cache import get_neighbor_cache
+from projection import save_model
+from schema import ensure_collection, ensure_partition, experiment_partition
+from sparse_io import is_sparse_input
+
+
+class _Stopped(Exception):
+    pass
+
+
+# Set in each worker process by _init_worker
+_batches = None
+_stop = None
+
+
+def experiment_files(directory):
+    """
+    The experiment inputs in a directory, ordered by experiment number.
+
+    :return: A list of (experiment_num, path) tuples.
+    :raises ValueError: If two inputs have the same experiment number, since their
+        primary keys would collide.
+    """
+    found = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        match = re.match(r'ex_(\d+)_', name)
+        if match is None or not (name.endswith('.csv') or is_sparse_input(path)):
+            continue
+        experiment_num = int(match.group(1))
+        if experiment_num in found:
+            raise ValueError(f'{found[experiment_num]} and {path} are both experiment {experiment_num}; '
+                             f'their primary keys would collide')
+        found[experiment_num] = path
+    return sorted(found.items())
+
+
+def _init_worker(batches, stop):
+    global _batches, _stop
+    _batches = batches
+    _stop = stop
+
+
+def _put(message):
+    # Give up instead of blocking forever once the uploader has failed
+    while not _stop.is_set():
+        try:
+            _batches.put(message, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+    raise _Stopped()
+
+
+def _embed_experiment(collection_name, path, settings, partition):
+    """
+    Worker: load one experiment, fit or reload its projection and queue its batches.
+    Every message is a tuple (kind, file_name, payload).
+    """
+    file_name = os.path.basename(path.rstrip(os.sep))
+    chunk_size = settings['chunk_size']
+    try:
+        checkpoint = IngestCheckpoint.open(collection_name, path, settings)
+        data_ids, data_values, genes = load_experiment(path)
+        projection = checkpoint.load_projection()
+        if projection is None:
+            projection = fit_projection(data_values, settings['projection'], settings['n_components'], genes)
+            checkpoint.save_projection(projection)
+        save_model(collection_name, file_name, projection)
+        ensure_gene_index(collection_name, file_name, data_ids, data_values, genes,
+                          source=checkpoint.manifest['source'], primary_keys=settings['primary_keys'])
+        _put(('start', file_name, (checkpoint.manifest_path, data_values.shape[0])))
+
+        for start in range(0, data_values.shape[0], chunk_size):
+            if checkpoint.is_acked(start):
+                continue
+            stop = start + chunk_size
+            vectors = np.ascontiguousarray(projection.transform(data_values[start:stop]), dtype=np.float32)
+            _put(('batch', file_name, Batch(start, data_ids[start:stop], vectors, file_name, partition)))
+        _put(('done', file_name, None))
+    except _Stopped:
+        pass
+    except Exception as e:
+        _put(('done', file_name, f'{type(e).__name__}: {e}'))
+
+
+def ingest_directory(collection_name, directory, processes=None, workers=4, chunk_size=1000,
+                     max_rows_per_second=None, metric_type='COSINE', index_type='HNSW'):
+    """
+    Ingest every experiment in a directory, one worker process per experiment.
+
+    :param collection_name: The name of the collection to insert into.
+    :param directory: Directory holding the ex_N_*.csv (or sparse ex_N_*) inputs.
+    :param processes: Worker processes loading and embedding experiments. Defaults to
+        the number of CPUs (at most one per experiment).
+    :param workers: Insert requests kept in flight at once, shared by all experiments.
+    :param chunk_size: Rows per insert request.
+    :param max_rows_per_second: Upload rate limit over all experiments. None is unlimited.
+    :param metric_type: Metric of the collection if it has to be created ('COSINE', 'IP' or 'L2').
+    :param index_type: Index of the collection if it has to be created ('FLAT', 'IVF_FLAT' or 'HNSW').
+    :return: 0 if every experiment was stored completely, 1 otherwise.
+    """
+    files = experiment_files(directory)
+    if not files:
+        print(f'No ex_N_* inputs found in {directory}')
+        return 1
+    n_components = 50
+    client = get_client()
+    # Cached neighbor results for this collection are stale once new rows arrive
+    get_neighbor_cache().invalidate(collection_name)
+    ensure_collection(client, collection_name, n_components, metric_type=metric_type, index_type=index_type,
+                      provenance={'source_dir': os.path.abspath(directory), 'pca_components': n_components,
+                                  'projection': 'per-experiment PCA'})
+
+    context = multiprocessing.get_context()
+    batches = context.Queue(maxsize=4 * workers)
+    stop = context.Event()
+    checkpoints = {}
+    rows = {}
+    failures = {}
+
+    def received(futures):
+        remaining = set(futures)
+        while remaining:
+            try:
+                kind, file_name, payload = batches.get(timeout=1.0)
+            except queue.Empty:
+                # A worker that died (e.g. killed for memory) never sends 'done'
+                for file_name, future in futures.items():
+                    if file_name in remaining and future.done() and future.exception() is not None:
+                        failures[file_name] = repr(future.exception())
+                        remaining.discard(file_name)
+                continue
+            if kind == 'start':
+                manifest_path, rows[file_name] = payload
+                checkpoints[file_name] = IngestCheckpoint.attach(manifest_path)
+            elif kind == 'batch':
+                yield payload
+            else:
+                if payload is not None:
+                    failures[file_name] = payload
+                remaining.discard(file_name)
+
+    processes = min(processes or os.cpu_count(), len(files))
+    print(f'Ingesting {len(files)} experiments from {directory} with {processes} processes...')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker,
+                             initargs=(batches, stop)) as pool:
+        futures = {}
+        for experiment_num, path in files:
+            settings = {'chunk_size': chunk_size, 'n_components': n_components,
+                        'projection': projection_method(path), 'primary_keys': PRIMARY_KEY_SCHEME}
+            partition = experiment_partition(experiment_num)
+            ensure_partition(client, collection_name, partition)
+            futures[os.path.basename(path.rstrip(os.sep))] = pool.submit(_embed_experiment, collection_name,
+                                                                         path, settings, partition)
+        try:
+            stats = run_pipeline(client, collection_name, received(futures), workers=workers, upsert=True,
+                                 on_success=lambda batch: checkpoints[batch.file_name].ack(batch.start),
+                                 rate_limiter=RateLimiter(max_rows_per_second) if max_rows_per_second else None)
+        except Exception as e:
+            stop.set()
+            print(f'Could not send data to Milvus: {e}. Run again to resume from the checkpoints')
+            return 1
+        finally:
+            # Searches that ran during the upload cached results over part of the rows
+            get_neighbor_cache().invalidate(collection_name)
+    stats.report()
+
+    status = 0
+    for file_name in futures:
+        if file_name in failures:
+            print(f'{file_name} failed: {failures[file_name]}')
+            status = 1
+        elif verify_ingest(client, collection_name, file_name, rows[file_name], checkpoints[file_name]) != 0:
+            status = 1
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest every experiment in a directory in parallel')
+    parser.add_argument('collection', help='Collection to insert into')
+    parser.add_argument('directory', help='Directory of ex_N_*.csv (or sparse ex_N_*) inputs')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: all CPUs)')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent insert requests')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per insert request')
+    parser.add_argument('--max-rows-per-second', type=float, default=None, help='Upload rate limit')
+    parser.add_argument('--metric-type', default='COSINE')
+    parser.add_argument('--index-type', default='HNSW')
+    args = parser.parse_args()
+    raise SystemExit(ingest_directory(args.collection, args.directory, args.processes, args.workers,
+                                      args.chunk_size, args.max_rows_per_second, args.metric_type,
+                                      args.index_type))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Checkpoint manifests that make ingestion resumable.
+
+One manifest per (collection, source file) lives under CHECKPOINT_PATH:
+    <collection>__<file>.json  source size, mtime and sha256, the ingest settings, the
+                               acknowledged batches and whether the run completed
+    <collection>__<file>.npz   the fitted projection
+Batches are identified by their start row. A batch is acknowledged once the
+server accepted it, so an interrupted run resumes by skipping acknowledged
+batches and re-sending the rest with upsert, which cannot duplicate primary keys
+that did make it across before the interruption.
+"""
+import json
+import os
+import threading
+import time
+
+from global_variables import CHECKPOINT_PATH
+from matrix_cache import file_sha256
+from projection import Projection
+
+
+MANIFEST_VERSION = 1
+
+
+def _file_signature(path, previous=None):
+    stat = os.stat(path)
+    # Like matrix_cache.is_cache_valid: an unchanged size and mtime is trusted, only
+    # otherwise are the contents hashed
+    if previous is not None and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        sha256 = previous['sha256']
+    else:
+        sha256 = file_sha256(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+
+def source_signature(path, previous=None):
+    """
+    Size, mtime and sha256 of a source file. A directory (10x output) is signed file by file.
+
+    :param previous: Signature recorded by an earlier run. The hash of every file whose size
+        and mtime still match it is reused instead of being computed again.
+    """
+    if not os.path.isdir(path):
+        return _file_signature(path, previous)
+    previous_files = (previous or {}).get('files') or {}
+    files = {name: _file_signature(os.path.join(path, name), previous_files.get(name))
+             for name in sorted(os.listdir(path))}
+    return {
+        'size': sum(signature['size'] for signature in files.values()),
+        'sha256': {name: signature['sha256'] for name, signature in files.items()},
+        'files': files,
+    }
+
+
+def same_source(signature, other):
+    """
+    Whether two source signatures describe the same contents (the mtimes may differ).
+    """
+    return (signature is not None and other is not None and signature['size'] == other['size']
+            and signature['sha256'] == other['sha256'])
+
+
+class IngestCheckpoint:
+    """
+    Progress of one source file's ingestion into one collection.
+
+    ack() is safe to call from the upload worker threads; every call rewrites the
+    manifest atomically, so it is never left half written.
+    """
+
+    def __init__(self, manifest_path, manifest):
+        self.manifest_path = manifest_path
+        self.manifest = manifest
+        self.acked = set(manifest['acked'])
+        self.resumed = bool(self.acked) or manifest.get('complete', False)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, collection_name, source_path, settings, directory=None):
+        """
+        Load the checkpoint of a previous run, or start a new one.
+
+        The previous checkpoint is reused only if the source file is unchanged and it
+        was written with the same settings; otherwise ingestion starts from scratch.
+
+        :param collection_name: Collection being ingested into.
+        :param source_path: Path of the source file.
+        :param settings: Dictionary of everything that decides how rows are split and
+            embedded (chunk size, number of components, projection method, ...).
+        :param directory: Directory of the manifests. Defaults to global_variables.CHECKPOINT_PATH.
+        """
+        directory = directory or CHECKPOINT_PATH
+        os.makedirs(directory, exist_ok=True)
+        name = f'{collection_name}__{os.path.basename(source_path.rstrip(os.sep))}'
+        manifest_path = os.path.join(directory, f'{name}.json')
+
+        try:
+            with open(manifest_path) as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            manifest = None
+        signature = source_signature(source_path, manifest['source'] if manifest is not None else None)
+        if manifest is not None and (manifest.get('version') != MANIFEST_VERSION
+                                     or not same_source(manifest['source'], signature)
+                                     or manifest['settings'] != settings):
+            print(f'Checkpoint {manifest_path} is for a different source or settings; starting over')
+            manifest = None
+        if manifest is not None:
+            # Record the current mtimes so the next run takes the fast path again
+            manifest['source'] = signature
+        if manifest is None:
+            manifest = {
+                'version': MANIFEST_VERSION,
+                'collection': collection_name,
+                'source_file': os.path.abspath(source_path),
+                'source': signature,
+                'settings': settings,
+                'projection': None,
+                'acked': [],
+                'complete': False,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+        checkpoint = cls(manifest_path, manifest)
+        checkpoint._write()
+        return checkpoint
+
+    @classmethod
+    def attach(cls, manifest_path):
+        """
+        Open a manifest that another process has just opened or created with open(),
+        without hashing the source again.
+        """
+        with open(manifest_path) as fh:
+            return cls(manifest_path, json.load(fh))
+
+    @property
+    def projection_path(self):
+        return os.path.splitext(self.manifest_path)[0] + '.npz'
+
+    def load_projection(self):
+        """
+        The projection fitted by an earlier run, or None if none was saved.
+        """
+        if self.manifest['projection'] is None or not os.path.exists(self.projection_path):
+            return None
+        return Projection.load(self.projection_path)
+
+    def save_projection(self, projection):
+        """
+        Persist the fitted projection so a resumed run embeds the remaining rows
+        exactly like the rows that were already sent.
+        """
+        projection.save(self.projection_path)
+        with self._lock:
+            self.manifest['projection'] = os.path.basename(self.projection_path)
+            self._write()
+
+    def is_acked(self, start):
+        return start in self.acked
+
+    def ack(self, start):
+        """
+        Record that the batch starting at row start was accepted by the server.
+        """
+        with self._lock:
+            self.acked.add(start)
+            self.manifest['acked'] = sorted(self.acked)
+            self._write()
+
+    def complete(self, rows):
+        """
+        Mark the run as finished after rows were verified in the collection.
+        """
+        with self._lock:
+            self.manifest['complete'] = True
+            self.manifest['verified_rows'] = rows
+            self.manifest['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            self._write()
+
+    def reset(self):
+        """
+        Forget every acknowledgement so the next run re-sends all batches. The
+        projection is kept.
+        """
+        with self._lock:
+            self.acked.clear()
+            self.manifest['acked'] = []
+            self.manifest['complete'] = False
+            self._write()
+
+    def _write(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.manifest, fh)
+        os.replace(tmp, self.manifest_path)
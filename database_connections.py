@@ -4,7 +4,8 @@ Contains function that query our Milvus collections
 import json
 import math
 import os
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -12,16 +13,60 @@ from pymilvus import MilvusClient, DataType
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 
-from global_variables import TOKEN, CLUSTER_ENDPOINT
+import metrics
+from global_variables import TOKEN, CLUSTER_ENDPOINT, BACKEND, LOCAL_DB_PATH
+from checkpoint import IngestCheckpoint
+from gene_index import ensure_gene_index
+from ingest import PRIMARY_KEY_SCHEME, Batch, experiment_primary_keys, experiment_rows, prefetch, run_pipeline
+from local_backend import LocalMilvusClient
+from matrix_cache import CachedMatrix, load_matrix
+from neighbor_cache import get_neighbor_cache
+from projection import (Projection, fit_incremental_pca, fit_sparse_pca, load_model, model_file_name,
+                        save_model, variance_shortfall)
+from schema import ensure_collection, ensure_partition, experiment_number, experiment_partition
+from sparse_io import is_sparse_input, read_sparse_matrix
 
 
-def insert_PCA_data(collection_name, filename):
+# Adaptive range search starts at this limit and multiplies it by ADAPTIVE_GROWTH for the
+# queries whose results all stayed above the threshold
+ADAPTIVE_START_LIMIT = 32
+ADAPTIVE_GROWTH = 4
+
+# One client per backend, reused so each call does not pay for connection setup
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(backend=None):
+    """
+    Create a client for the configured vector search backend.
+
+    :param backend: 'milvus' for the hosted Zilliz cluster, 'local' for the in-process
+        exact search engine. Defaults to global_variables.BACKEND.
+    :return: A MilvusClient or a LocalMilvusClient. Both answer the same
+        get/search/insert calls. The client is created once per backend and shared by
+        every caller (both are safe to use from several threads).
+    """
+    backend = backend or BACKEND
+    with _clients_lock:
+        if backend not in _clients:
+            if backend == 'local':
+                _clients[backend] = LocalMilvusClient(path=LOCAL_DB_PATH)
+            elif backend == 'milvus':
+                _clients[backend] = MilvusClient(uri=CLUSTER_ENDPOINT, token=TOKEN)
+            else:
+                raise ValueError(f'Unknown backend {backend}. Expected "milvus" or "local"')
+        return _clients[backend]
+
+
+def insert_PCA_data(collection_name, filename, chunk_size=1000, workers=4, metric_type='COSINE', index_type='HNSW'):
     """
     This function will read a cell/gene matrix and perform the following:
         1. Read the data into memory
         2. Normalize the data to have mean 0, standard deviation 1.
         3. Fit a PCA that keeps 85% of the variance.
-        4. Pad the PCA vector with zeroes so it is 1000 elements long.
+        4. Store the PCA vector at its native length in a collection created
+            for that dimension (inserts of any other dimension are refused).
         5. Send the PCA vector to Milvus along with the cell name, file name
             the data came from, and cell id (i.e. the index into the list
             of PCA vectors)
@@ -31,95 +76,67 @@ def insert_PCA_data(collection_name, filename):
                 - The remaining 5 digits are reversed for cell_ids within the experiment.
                  i.e. cell id 0 will look like 100000, cell_id 1 = 100001,
                  cell_id 2 = 100002
+    Progress is checkpointed; see insert_data.
 
     :param collection_name: The name of the Milvus cloud collection to be inserted to.
     :param: filename: The file in the data directory that contains the cell/gene matrix
         to be inserted into the collection.
+    :param chunk_size: Rows per insert request.
+    :param workers: Number of insert requests kept in flight at once.
+    :param metric_type: Metric of the collection if it has to be created ('COSINE', 'IP' or 'L2').
+    :param index_type: Index of the collection if it has to be created ('FLAT', 'IVF_FLAT' or 'HNSW').
     :return: 0 on success, 1 on failure (data could not be sent to Milvus)
     """
-
     # Set up a Milvus client
-    print(f'Connecting to Milvus...')
-    client = MilvusClient(uri=CLUSTER_ENDPOINT, token=TOKEN)
+    client = get_client()
+    # Cached neighbor results for this collection are stale once new rows arrive
+    get_neighbor_cache().invalidate(collection_name)
 
-    # Read data from CSV file
-    experiment_num = int(re.search(r'ex_\d+_', filename).group()[3:-1])
-    print(f'Loading data from experiment {experiment_num}...')
+    # Read data from CSV file. It is already normalized and projected by R
+    experiment_num = experiment_number(filename)
+    partition = experiment_partition(experiment_num)
     path = os.path.join('data', filename)
-    data = pd.read_csv(path, delimiter=',')
-    data_values = data.iloc[:, :].values
-
-    print(f'Data already normalized from R...')
-    # sc = StandardScaler()
-    # sc_data = sc.fit_transform(data_values)
-    # sc_data = data_values
-
-    print(f'PCA already fit from R...')
-    # sc_data = data_values
-    # pca = PCA(n_components=50, svd_solver='arpack')
-    # pca_data = pca.fit_transform(sc_data)
-
-    # Exclude the first column (cell identifiers)
-    # matrix_values = pca_data[:, 1:]
-
-    # Extract gene expression values
-    # gene_values = pca_data[:, :].tolist()
+    data_values = load_matrix(path, id_column=False).values
+    checkpoint = _open_checkpoint(collection_name, path, {'chunk_size': chunk_size, 'projection': 'R',
+                                                          'primary_keys': PRIMARY_KEY_SCHEME})
 
     # Prepare data
-    max_vec_length = 50
-    chunk_size = 1000
-
-    i = 0
-    counter = chunk_size
-    while i < len(data_values):
-        data = []
-        while i < counter and i < len(data_values):
-            vals = data_values[i, :].tolist()
-            num_vals = len(vals)
-            if num_vals < max_vec_length:
-                to_add = max_vec_length - num_vals
-                for _ in range(to_add):
-                    vals.append(0.0)
-
-            elif num_vals > max_vec_length:
-                print(f'Vector size of {num_vals} > {max_vec_length}. Cannot upload to Milvus')
-
-            # Create primary key
-            # primary_key = int(f'{experiment_num}00000')
-            # if i > 0:
-            #     num_digits = math.floor(np.log10(i)) + 1
-            #     primary_key = f'{experiment_num}'
-            #     for _ in range(5 - num_digits):
-            #         primary_key += '0'
-            #     primary_key += f'{i}'
-            #     primary_key = int(primary_key)
-
-            row_data = {
-                'primary_key': i+724,
-                'vector': vals,
-                'cell_name': 'na',
-                'file_name': filename
-            }
-
-            data.append(row_data)
-            i += 1
-
-        print(f'Sending rows {counter-chunk_size} to {i} to Milvus (of {len(data_values)})...')
-        res = client.insert(
-            collection_name=collection_name,
-            data=data
-        )
-        print(res)
-        counter += chunk_size
-
-
-def insert_data(collection_name, filename):
+    keys = experiment_primary_keys(experiment_num, len(data_values))
+
+    def batches():
+        for start in range(0, len(data_values), chunk_size):
+            if checkpoint.is_acked(start):
+                continue
+            stop = start + chunk_size
+            vectors = np.ascontiguousarray(data_values[start:stop], dtype=np.float32)
+            yield Batch(start, keys[start:stop], vectors, filename, partition)
+
+    try:
+        ensure_collection(client, collection_name, data_values.shape[1], metric_type=metric_type,
+                          index_type=index_type,
+                          provenance={'source_file': filename, 'pca_components': data_values.shape[1],
+                                      'projection': 'R'})
+        ensure_partition(client, collection_name, partition)
+        stats = run_pipeline(client, collection_name, prefetch(batches()), workers=workers, upsert=True,
+                             on_success=lambda batch: checkpoint.ack(batch.start))
+    except Exception as e:
+        print(f'Could not send data to Milvus: {e}. Run again to resume from the checkpoint')
+        return 1
+    finally:
+        # Searches that ran during the upload cached results over part of the rows
+        get_neighbor_cache().invalidate(collection_name)
+    stats.report()
+    return verify_ingest(client, collection_name, filename, len(data_values), checkpoint)
+
+
+def insert_data(collection_name, filename, chunk_size=1000, workers=4, metric_type='COSINE', index_type='HNSW'):
     """
     This function will read a cell/gene matrix and perform the following:
         1. Read the data into memory
         2. Normalize the data to have mean 0, standard deviation 1.
         3. Fit a PCA that keeps 85% of the variance.
-        4. Pad the PCA vector with zeroes so it is 1000 elements long.
+        4. Store the PCA vector at its native length in a collection created
+            for that dimension (inserts of any other dimension are refused).
         5. Send the PCA vector to Milvus along with the cell name, file name
             the data came from, and cell id (i.e. the index into the list
             of PCA vectors)
@@ -130,88 +147,549 @@ def insert_data(collection_name, filename):
                  i.e. cell id 0 will look like 100000, cell_id 1 = 100001,
                  cell_id 2 = 100002
 
+    The cells go into the partition of their experiment (see schema.experiment_partition),
+    so searches can be restricted to some experiments.
+
+    Progress is recorded in a checkpoint manifest (see checkpoint.py): the source
+    file's hash, the fitted projection and every batch the server acknowledged. If
+    the upload is interrupted, calling insert_data again with the same arguments
+    skips the PCA fit and the acknowledged batches. Batches are sent as upserts,
+    so rows re-sent after an interruption are never duplicated. At the end the rows
+    stored for the file are counted and compared with the source.
+
     :param collection_name: The name of the Milvus cloud collection to be inserted to.
     :param: filename: The file in the data directory that contains the cell/gene matrix
+        to be inserted into the collection. Either a dense CSV with cell ids in the
+        first column, or a sparse matrix: a 10x directory / .mtx file or an .h5ad file.
+    :param chunk_size: Rows per insert request.
+    :param workers: Number of insert requests kept in flight at once.
+    :param metric_type: Metric of the collection if it has to be created ('COSINE', 'IP' or 'L2').
+    :param index_type: Index of the collection if it has to be created ('FLAT', 'IVF_FLAT' or 'HNSW').
+    :return: 0 on success, 1 on failure (data could not be sent to Milvus, or fewer
+        rows than expected are stored)
+    """
+    # Set up a Milvus client
+    client = get_client()
+    # Cached neighbor results for this collection are stale once new rows arrive
+    get_neighbor_cache().invalidate(collection_name)
+
+    path = os.path.join('data', filename)
+    partition = experiment_partition(experiment_number(filename))
+    n_components = 50
+    method = projection_method(path)
+    checkpoint = _open_checkpoint(collection_name, path,
+                                  {'chunk_size': chunk_size, 'n_components': n_components, 'projection': method,
+                                   'primary_keys': PRIMARY_KEY_SCHEME})
+    data_ids, data_values, genes = load_experiment(path)
+    pca = checkpoint.load_projection()
+    if pca is None:
+        pca = fit_projection(data_values, method, n_components, genes)
+        checkpoint.save_projection(pca)
+    # Kept so new cells can later be projected into this collection (see search_new_cells)
+    save_model(collection_name, filename, pca)
+    # Top genes of every cell, so get_similar_genes never re-ranks the matrix
+    ensure_gene_index(collection_name, filename, data_ids, data_values, genes, source=checkpoint.manifest['source'],
+                      primary_keys=PRIMARY_KEY_SCHEME)
+
+    def batches():
+        # The PCA transform of each chunk overlaps with the upload of the previous ones
+        for start in range(0, data_values.shape[0], chunk_size):
+            if checkpoint.is_acked(start):
+                continue
+            stop = start + chunk_size
+            with metrics.span('pca.transform', rows=min(stop, data_values.shape[0]) - start):
+                vectors = np.ascontiguousarray(pca.transform(data_values[start:stop]), dtype=np.float32)
+            yield Batch(start, data_ids[start:stop], vectors, filename, partition)
+
+    try:
+        ensure_collection(client, collection_name, n_components, metric_type=metric_type,
+                          index_type=index_type,
+                          provenance={'source_file': filename, 'pca_components': n_components,
+                                      'projection': method})
+        ensure_partition(client, collection_name, partition)
+        stats = run_pipeline(client, collection_name, prefetch(batches()), workers=workers, upsert=True,
+                             on_success=lambda batch: checkpoint.ack(batch.start))
+    except Exception as e:
+        print(f'Could not send data to Milvus: {e}. Run again to resume from the checkpoint')
+        return 1
+    finally:
+        # Searches that ran during the upload cached results over part of the rows
+        get_neighbor_cache().invalidate(collection_name)
+    stats.report()
+    return verify_ingest(client, collection_name, filename, data_values.shape[0], checkpoint)
+
+
+def projection_method(path):
+    """
+    The embedding insert_data uses for a source: a randomized sparse PCA for sparse
+    inputs, an ARPACK PCA for dense CSVs.
+    """
+    return 'randomized_sparse_pca' if is_sparse_input(path) else 'pca_arpack'
+
+
+def load_experiment(path):
+    """
+    Read one experiment's cell/gene matrix.
+
+    :param path: A dense CSV with cell ids in the first column, or a sparse matrix
+        (10x directory / .mtx file or .h5ad file).
+    :return: A tuple (data_ids, data_values, genes). data_ids are the primary keys of the
+        cells (ingest.PRIMARY_KEY_SCHEME), not the ids in a CSV's first column. data_values
+        is a memory-mapped array for CSVs and a CSR matrix for sparse inputs.
+    """
+    experiment_num = experiment_number(path)
+    if is_sparse_input(path):
+        _, genes, data_values = read_sparse_matrix(path)
+    else:
+        # Read data from the binary cache of the CSV file. It is already normalized by R
+        matrix = load_matrix(path)
+        data_values, genes = matrix.values, matrix.genes
+    return experiment_primary_keys(experiment_num, data_values.shape[0]), data_values, genes
+
+
+def load_source_matrix(path):
+    """
+    The expression matrix of a source file in any input format: the binary cache of a
+    CSV, or for sparse inputs a CachedMatrix whose values are the CSR matrix (rows are
+    gathered the same way from both).
+    """
+    if is_sparse_input(path):
+        cells, genes, matrix = read_sparse_matrix(path)
+        return CachedMatrix(matrix, cells, genes, path)
+    return load_matrix(path)
+
+
+def source_rows(file_name, matrix, keys):
+    """
+    Row of every primary key in the matrix of its source file, -1 for keys not in it.
+
+    Keys follow ingest.PRIMARY_KEY_SCHEME. Collections ingested before that scheme was
+    used everywhere are keyed by the ids in the CSV's first column instead, so keys that
+    are not experiment keys of this file are looked up among those ids.
+
+    :param file_name: Source file of the matrix.
+    :param matrix: The file's CachedMatrix (see load_source_matrix).
+    :param keys: Primary keys of cells.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    rows = experiment_rows(experiment_number(file_name), keys, matrix.shape[0])
+    unmatched = rows < 0
+    if unmatched.any() and matrix.cell_ids.dtype.kind in 'iu':
+        rows[unmatched] = pd.Index(matrix.cell_ids).get_indexer(keys[unmatched])
+    return rows
+
+
+def fit_projection(data_values, method, n_components=50, genes=None):
+    """
+    Fit the PCA projection named by projection_method.
+
+    :param genes: Gene names of the columns, stored with the projection.
+    :return: A Projection.
+    """
+    with metrics.span('pca.fit', rows=data_values.shape[0], method=method):
+        if method == 'randomized_sparse_pca':
+            # Randomized SVD with implicit centering, never densified
+            projection = fit_sparse_pca(data_values, n_components=n_components)
+            projection.genes = None if genes is None else np.asarray(genes, dtype=str)
+            return projection
+        return Projection.from_estimator(PCA(n_components=n_components, svd_solver='arpack').fit(data_values),
+                                         genes=genes)
+
+
+def insert_data_streaming(collection_name, filename, chunk_size=1000, read_rows=10000, workers=4,
+                          metric_type='COSINE', index_type='HNSW'):
+    """
+    Out-of-core version of insert_data for matrices that do not fit in memory.
+
+    The matrix is read twice from its binary cache, read_rows cells at a time:
+        1. An IncrementalPCA is fit chunk by chunk.
+        2. Each chunk is transformed with the fitted projection and uploaded.
+    Peak memory is bounded by read_rows (plus the batches in flight), not by the
+    number of cells. Use check_streaming_pca to confirm the incremental fit agrees
+    with the one-shot PCA of insert_data for a given file. Progress is checkpointed
+    and resumable as in insert_data.
+
+    :param collection_name: The name of the Milvus cloud collection to be inserted to.
+    :param filename: The file in the data directory that contains the cell/gene matrix
         to be inserted into the collection.
-    :return: 0 on success, 1 on failure (data could not be sent to Milvus)
+    :param chunk_size: Rows per insert request.
+    :param read_rows: Cells parsed from the CSV at a time.
+    :param workers: Number of insert requests kept in flight at once.
+    :param metric_type: Metric of the collection if it has to be created ('COSINE', 'IP' or 'L2').
+    :param index_type: Index of the collection if it has to be created ('FLAT', 'IVF_FLAT' or 'HNSW').
+    :return: 0 on success, 1 on failure (data could not be sent to Milvus, or fewer
+        rows than expected are stored)
     """
+    client = get_client()
+    # Cached neighbor results for this collection are stale once new rows arrive
+    get_neighbor_cache().invalidate(collection_name)
+
+    path = os.path.join('data', filename)
+    experiment_num = experiment_number(filename)
+    partition = experiment_partition(experiment_num)
+
+    # Building the cache is itself chunked, so this stays within bounded memory
+    matrix = load_matrix(path)
+    keys = experiment_primary_keys(experiment_num, matrix.shape[0])
+
+    n_components = 50
+    checkpoint = _open_checkpoint(collection_name, path, {'chunk_size': chunk_size, 'read_rows': read_rows,
+                                                          'n_components': n_components,
+                                                          'projection': 'incremental_pca',
+                                                          'primary_keys': PRIMARY_KEY_SCHEME})
+    pca = checkpoint.load_projection()
+    if pca is None:
+        with metrics.span('pca.fit', rows=matrix.shape[0], method='incremental_pca'):
+            pca = Projection.from_estimator(
+                fit_incremental_pca(prefetch(matrix.iter_chunks(read_rows)), n_components=n_components),
+                genes=matrix.genes)
+        checkpoint.save_projection(pca)
+    save_model(collection_name, filename, pca)
+    # Ranked chunk by chunk from the memory map, so this also stays within bounded memory
+    ensure_gene_index(collection_name, filename, keys, matrix.values, matrix.genes,
+                      source=checkpoint.manifest['source'], primary_keys=PRIMARY_KEY_SCHEME)
+
+    def batches():
+        # Chunk reads run on the prefetch thread, transform here, upload on the workers
+        offset = 0
+        for _, data_values in prefetch(matrix.iter_chunks(read_rows)):
+            starts = [start for start in range(0, len(data_values), chunk_size)
+                      if not checkpoint.is_acked(offset + start)]
+            if starts:
+                with metrics.span('pca.transform', rows=len(data_values)):
+                    vectors = np.ascontiguousarray(pca.transform(data_values), dtype=np.float32)
+            for start in starts:
+                # The last chunk of a read block can be shorter than chunk_size
+                chunk = vectors[start:start + chunk_size]
+                yield Batch(offset + start, keys[offset + start:offset + start + len(chunk)], chunk, filename,
+                            partition)
+            offset += len(data_values)
+
+    try:
+        ensure_collection(client, collection_name, n_components, metric_type=metric_type,
+                          index_type=index_type,
+                          provenance={'source_file': filename, 'pca_components': n_components,
+                                      'projection': 'incremental_pca'})
+        ensure_partition(client, collection_name, partition)
+        stats = run_pipeline(client, collection_name, batches(), workers=workers, upsert=True,
+                             on_success=lambda batch: checkpoint.ack(batch.start))
+    except Exception as e:
+        print(f'Could not send data to Milvus: {e}. Run again to resume from the checkpoint')
+        return 1
+    finally:
+        # Searches that ran during the upload cached results over part of the rows
+        get_neighbor_cache().invalidate(collection_name)
+    stats.report()
+    return verify_ingest(client, collection_name, filename, matrix.shape[0], checkpoint)
+
+
+def _open_checkpoint(collection_name, path, settings):
+    checkpoint = IngestCheckpoint.open(collection_name, path, settings)
+    if checkpoint.manifest['complete']:
+        print(f'{os.path.basename(path)} was already ingested into {collection_name}; only verifying the row count')
+    elif checkpoint.resumed:
+        print(f'Resuming {os.path.basename(path)} from its checkpoint: '
+              f'{len(checkpoint.acked)} batches already acknowledged')
+    return checkpoint
+
+
+def count_rows(collection_name, file_name=None, client=None):
+    """
+    Count the rows stored in a collection, optionally only those from one source file.
+
+    :param collection_name: The name of the collection to count.
+    :param file_name: Only count rows whose file_name is this.
+    :param client: Client to use. Defaults to the shared client from get_client().
+    :return: The number of rows.
+    """
+    client = client or get_client()
+    res = client.query(collection_name=collection_name,
+                       filter=f'file_name == "{file_name}"' if file_name else '',
+                       output_fields=['count(*)'], consistency_level='Strong')
+    return int(res[0]['count(*)'])
 
-    # Set up a Milvus client
-    print(f'Connecting to Milvus...')
-    client = MilvusClient(uri=CLUSTER_ENDPOINT, token=TOKEN)
 
-    # Read data from CSV file
-    experiment_num = int(re.search(r'ex_\d+_', filename).group()[3:-1])
-    print(f'Loading data from experiment {experiment_num}...')
+def verify_ingest(client, collection_name, filename, expected, checkpoint):
+    """
+    Compare the rows stored for filename with the rows in the source and close the checkpoint.
+
+    :return: 0 if every row is stored, 1 otherwise. On failure the checkpoint is reset
+        so the next run re-sends every batch (upserts, so nothing is duplicated).
+    """
+    stored = count_rows(collection_name, filename, client)
+    if stored < expected:
+        print(f'{collection_name} holds {stored} of the {expected} rows from {filename}. '
+              f'The checkpoint was reset; run again to re-send every batch')
+        checkpoint.reset()
+        return 1
+    if stored > expected:
+        print(f'{collection_name} holds {stored} rows from {filename} but the file has {expected}; '
+              f'rows from an older version of the file may remain')
+    checkpoint.complete(stored)
+    return 0
+
+
+def check_streaming_pca(filename, tolerance=0.02, leading=10, read_rows=10000, max_rows=None):
+    """
+    Compare the incremental PCA used by insert_data_streaming against the one-shot
+    ARPACK PCA used by insert_data on the same cells.
+
+    The fits are compared on the variance their leading components capture (see
+    projection.variance_shortfall). Calibrated on the synthetic matrices of
+    benchmark.py (2000 to 5000 cells, 200 to 1000 genes, a nearly flat spectrum):
+        - incremental fits from 500-row chunks or larger: 0.001 to 0.012
+          (0.019 at worst from 100-row chunks),
+        - faulty fits: 0.033 to 0.055 for an uncentered SVD, 0.04 to 0.09 for a PCA of
+          half the cells, 0.24 to 0.38 for a PCA of the first tenth, about 0.7 for random
+          components.
+    The default tolerance of 0.02 leaves a margin of over 1.5x on both sides for chunks
+    of 500 rows or more.
+
+    :param filename: The file in the data directory that contains the cell/gene matrix.
+    :param tolerance: Largest acceptable variance_shortfall.
+    :param leading: Number of leading components compared.
+    :param read_rows: Chunk size for the incremental fit.
+    :param max_rows: Only compare the first max_rows cells (the one-shot fit needs them
+        all in memory). None uses the whole file.
+    :return: A tuple (passed, shortfall).
+    """
     path = os.path.join('data', filename)
-    data = pd.read_csv(path, delimiter=',')
-    data_values = data.iloc[:, 1:].values
-    data_ids = data.iloc[:, :1].values
+    data_values = np.asarray(load_matrix(path).values[:max_rows])
 
-    print(f'Data already normalized from R...')
-    # sc = StandardScaler()
-    # sc_data = sc.fit_transform(data_values)
-    # sc_data = data_values
+    one_shot = PCA(n_components=50, svd_solver='arpack').fit(data_values)
+    chunks = ((None, data_values[i:i + read_rows]) for i in range(0, len(data_values), read_rows))
+    streamed = fit_incremental_pca(chunks, n_components=50)
 
-    print(f'Fitting PCA...')
-    sc_data = data_values
-    pca = PCA(n_components=50, svd_solver='arpack')
-    pca_data = pca.fit_transform(sc_data)
+    shortfall = variance_shortfall(data_values, one_shot.components_, streamed.components_, n_components=leading)
+    print(f'Streaming PCA: the leading {leading} components capture {shortfall:.2%} less variance than '
+          f'the one-shot fit (tolerance {tolerance:.0%})')
+    return bool(shortfall <= tolerance), float(shortfall)
 
-    # Exclude the first column (cell identifiers)
-    # matrix_values = pca_data[:, 1:]
 
-    # Extract gene expression values
-    gene_values = pca_data[:, :].tolist()
+def fetch_vectors(collection_name, ids, client=None):
+    """
+    Get the stored vectors for a list of primary keys in one request.
 
-    # Prepare data
-    max_vec_length = 5880
-    chunk_size = 1000
-
-    i = 0
-    counter = chunk_size
-    while i < len(gene_values):
-        data = []
-        while i < counter and i < len(gene_values):
-            num_vals = len(gene_values[i])
-            if num_vals < max_vec_length:
-                to_add = max_vec_length - num_vals
-                for _ in range(to_add):
-                    gene_values[i].append(0.0)
-
-            elif len(gene_values[i]) > max_vec_length:
-                print(f'Vector size of {num_vals} > {max_vec_length}. Cannot upload to Milvus')
-
-            # Create primary key
-            # primary_key = int(f'{experiment_num}00000')
-            # if i > 0:
-            #     num_digits = math.floor(np.log10(i)) + 1
-            #     primary_key = f'{experiment_num}'
-            #     for _ in range(5 - num_digits):
-            #         primary_key += '0'
-            #     primary_key += f'{i}'
-            #     primary_key = int(primary_key)
-
-            row_data = {
-                'primary_key': data_ids[i][0],
-                'vector': gene_values[i],
-                'cell_name': 'na',
-                'file_name': filename
-            }
-
-            data.append(row_data)
-            i += 1
-
-        print(f'Sending rows {counter-chunk_size} to {i} to Milvus (of {len(gene_values)})...')
-        res = client.insert(
-            collection_name=collection_name,
-            data=data
+    :param collection_name: The name of the collection to query.
+    :param ids: List of primary keys.
+    :param client: Client to use. Defaults to the shared client from get_client().
+    :return: A dictionary of primary key -> vector. Keys that are not stored are left out.
+    """
+    client = client or get_client()
+    ids = list(ids)
+    with metrics.span('rpc.get', ids=len(ids)) as span:
+        res = client.get(collection_name=collection_name, ids=ids, output_fields=['vector'])
+        span.set(rows=len(res))
+    return {item['primary_key']: item['vector'] for item in res}
+
+
+def fetch_file_names(collection_name, ids, client=None):
+    """
+    Get the source file names of a list of primary keys in one request.
+
+    :return: A dictionary of primary key -> file name. Keys that are not stored are left out.
+    """
+    client = client or get_client()
+    ids = list(ids)
+    with metrics.span('rpc.get', ids=len(ids)) as span:
+        res = client.get(collection_name=collection_name, ids=ids, output_fields=['file_name'])
+        span.set(rows=len(res))
+    return {item['primary_key']: item['file_name'] for item in res}
+
+
+def experiment_partitions(experiments):
+    """
+    Partition names of a list of experiment numbers, or None (search every partition) for None.
+    """
+    if experiments is None:
+        return None
+    return sorted({experiment_partition(experiment_num) for experiment_num in experiments})
+
+
+def _cache_metric(partition_names, min_similarity=None):
+    # Results restricted to some partitions or to a similarity range are cached apart from
+    # unrestricted ones. A range result shorter than its limit holds every match above its
+    # threshold, so within one threshold it still serves any limit
+    metric = 'COSINE'
+    if partition_names is not None:
+        metric += ':' + ','.join(partition_names)
+    if min_similarity is not None:
+        metric += f'>={float(min_similarity)!r}'
+    return metric
+
+
+def range_search_params(min_similarity):
+    """
+    Milvus range search parameters that only return matches more similar than min_similarity.
+
+    For COSINE and IP the radius is the lower bound of the returned distances. The upper
+    bound range_filter is left unset: a cell's similarity to itself can round to just
+    above 1.0, and it must not be dropped.
+    """
+    return {'params': {'radius': float(min_similarity)}}
+
+
+def search_vectors(collection_name, query_ids, query_vectors, limit=10, with_vectors=False, client=None,
+                   partition_names=None, min_similarity=None):
+    """
+    Search with vectors the caller already holds, skipping the get() round trip.
+
+    :param collection_name: The name of the collection to query.
+    :param query_ids: Primary keys the query vectors belong to (used to key the output).
+    :param query_vectors: The query vectors, in the same order as query_ids.
+    :param limit: The number of similar vectors to find per query.
+    :param with_vectors: Also return the vectors of every match, fetched by the search itself.
+    :param client: Client to use. Defaults to the shared client from get_client().
+    :param partition_names: Only search these partitions (see experiment_partitions). None
+        searches the whole collection.
+    :param min_similarity: Range search: only return matches with at least this cosine
+        similarity, so a query may get fewer than limit matches. Sent to the server as
+        range search parameters and enforced again here.
+    :return: A tuple (output, vectors). output is a dictionary of query id -> list of
+        (vector_id, cosine_similarity_value) tuples ordered by most to least similar.
+        vectors is a dictionary of matched id -> vector (empty unless with_vectors).
+    """
+    client = client or get_client()
+    if not len(query_ids):
+        return {}, {}
+
+    output_fields = ['file_name', 'vector'] if with_vectors else ['file_name']
+    options = {} if partition_names is None else {'partition_names': partition_names}
+    if min_similarity is not None:
+        options['search_params'] = range_search_params(min_similarity)
+    with metrics.span('rpc.search', queries=len(query_ids), limit=limit, partitions=partition_names) as span:
+        res = client.search(
+            collection_name=collection_name,  # target collection
+            data=query_vectors,  # query vectors
+            limit=limit,  # number of returned entities
+            output_fields=output_fields,
+            **options
         )
-        print(res)
-        counter += chunk_size
+        span.set(rows=sum(len(query) for query in res))
 
+    output = {}
+    vectors = {}
+    for query_id, query in zip(query_ids, res):
+        results = []
+        for match in query:
+            if min_similarity is not None and match['distance'] < min_similarity:
+                continue
+            results.append((match['id'], match['distance']))
+            if with_vectors:
+                vectors[match['id']] = match['entity']['vector']
+
+        # Sort results by cosine similarity value (descending order)
+        results.sort(key=lambda x: x[1], reverse=True)
+        output[query_id] = results
+
+    return output, vectors
+
+
+def search_in_batches(collection_name, query_ids, query_vectors, limit=10, batch_size=100, parallelism=4,
+                      with_vectors=False, client=None, partition_names=None, min_similarity=None,
+                      adaptive=False):
+    """
+    search_vectors over many queries: batch_size queries per request with up to
+    parallelism requests in flight, all over one shared client.
+
+    :param min_similarity: Range search threshold, see search_vectors.
+    :param adaptive: With min_similarity, start every query at ADAPTIVE_START_LIMIT
+        neighbors and only search again, with ADAPTIVE_GROWTH times the limit (at most
+        limit), the queries whose results all stayed above the threshold. Queries in sparse
+        regions then stop after one small request instead of pulling back limit neighbors.
+    :return: A tuple (output, vectors) as returned by search_vectors, merged over all batches.
+    """
+    client = client or get_client()
+
+    def search_all(ids, vectors_, search_limit):
+        def search(start):
+            stop = start + batch_size
+            return search_vectors(collection_name, ids[start:stop], vectors_[start:stop],
+                                  limit=search_limit, with_vectors=with_vectors, client=client,
+                                  partition_names=partition_names, min_similarity=min_similarity)
+
+        found = {}
+        found_vectors = {}
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            for batch_output, batch_vectors in executor.map(search, range(0, len(ids), batch_size)):
+                found.update(batch_output)
+                found_vectors.update(batch_vectors)
+        return found, found_vectors
+
+    if not adaptive or min_similarity is None:
+        return search_all(query_ids, query_vectors, limit)
 
-def find_similarities(collection_name, root_vector_ids, limit=10):
+    output = {}
+    vectors = {}
+    pending = list(range(len(query_ids)))
+    search_limit = min(limit, ADAPTIVE_START_LIMIT)
+    while pending:
+        ids = [query_ids[i] for i in pending]
+        found, found_vectors = search_all(ids, [query_vectors[i] for i in pending], search_limit)
+        vectors.update(found_vectors)
+        saturated = []
+        for i, query_id in zip(pending, ids):
+            results = found.get(query_id, [])
+            if len(results) >= search_limit and search_limit < limit:
+                # Every match cleared the threshold, so there may be more
+                saturated.append(i)
+            else:
+                output[query_id] = results
+        metrics.count('search.adaptive_repeats', len(saturated))
+        pending = saturated
+        search_limit = min(limit, search_limit * ADAPTIVE_GROWTH)
+    return output, vectors
+
+
+def expand_frontier(collection_name, query_ids, vectors, limit=10, batch_size=100, parallelism=4,
+                    use_cache=True, experiments=None, min_similarity=None, adaptive=False):
+    """
+    Search every id in a frontier, batch_size ids per request with up to parallelism
+    requests in flight, all over one shared client.
+
+    Searches ask for the vectors of their matches, so the caller can run the next
+    frontier without fetching them again. Only ids missing from vectors (e.g. the
+    seeds) cost an extra get(), issued once for the whole frontier.
+
+    :param collection_name: The name of the collection to query.
+    :param query_ids: Iterable of primary keys to search.
+    :param vectors: Dictionary of primary key -> vector already known to the caller.
+        Vectors fetched for missing ids are added to it.
+    :param limit: The number of similar vectors to find per query.
+    :param batch_size: Query vectors per search request.
+    :param parallelism: Maximum number of concurrent search requests.
+    :param use_cache: Serve ids from the neighbor cache when possible and store new results in it.
+    :param experiments: Only search the partitions of these experiment numbers. None
+        searches the whole collection.
+    :param min_similarity: Only return matches with at least this cosine similarity (see search_vectors).
+    :param adaptive: Grow the number of neighbors per query only while they stay above
+        min_similarity, up to limit (see search_in_batches).
+    :return: A tuple (output, match_vectors) as returned by search_vectors, merged over
+        all batches. Ids answered from the cache have no entries in match_vectors.
+    """
+    client = get_client()
+    partition_names = experiment_partitions(experiments)
+    metric = _cache_metric(partition_names, min_similarity)
+    query_ids = list(query_ids)
+    cached = {}
+    if use_cache:
+        cached, query_ids = get_neighbor_cache().get_many(collection_name, query_ids, limit, metric)
+    missing = [cell_id for cell_id in query_ids if cell_id not in vectors]
+    if missing:
+        vectors.update(fetch_vectors(collection_name, missing, client))
+    query_ids = [cell_id for cell_id in query_ids if cell_id in vectors]
+    output, match_vectors = search_in_batches(collection_name, query_ids, [vectors[cell_id] for cell_id in query_ids],
+                                              limit, batch_size, parallelism, with_vectors=True, client=client,
+                                              partition_names=partition_names, min_similarity=min_similarity,
+                                              adaptive=adaptive)
+    if use_cache:
+        get_neighbor_cache().put_many(collection_name, output, limit, metric)
+    output.update(cached)
+    return output, match_vectors
+
+
+def find_similarities(collection_name, root_vector_ids, limit=10, use_cache=True, experiments=None,
+                      min_similarity=None, adaptive=False):
     """
     This function will query the Milvus database for vectors that have the highest
         cosine similarity to the root vector.
@@ -219,11 +697,17 @@ def find_similarities(collection_name, root_vector_ids, limit=10):
     :param: collection_name: The name of the collection to query.
     :param root_vector_ids: The vector or list of vectors to find similarities to.
     :param limit: The number of similar vectors to find
-    :return: A tuple where the first element is:
-                A dictionary with keys [query_vector_id], where query_vector_id points to a
-                list of (vector_id, cosine_similarity_value, filename) tuples
+    :param use_cache: Serve ids from the neighbor cache when possible and store new results in it.
+    :param experiments: Only return cells of these experiment numbers. Only their
+        partitions are searched, so this also makes the search cheaper. The root
+        vectors may belong to any experiment. None searches the whole collection.
+    :param min_similarity: Range search: only return matches with at least this cosine
+        similarity, so a cell may get fewer than limit matches.
+    :param adaptive: With min_similarity, ask for a few neighbors first and only ask for
+        more (up to limit) for the cells whose matches all cleared the threshold.
+    :return: A dictionary with keys [query_vector_id], where query_vector_id points to a
+                list of (vector_id, cosine_similarity_value) tuples
                 ordered by most to least similar.
-            And the second element is a list of file names the vectors originate from
     """
 
     # Ensure that root_vector_id is always a list
@@ -231,49 +715,94 @@ def find_similarities(collection_name, root_vector_ids, limit=10):
         print(f'Error: root_vector_ids must be a list.')
         return
 
-    #print(f'** Finding similarities function **')
+    partition_names = experiment_partitions(experiments)
+    metric = _cache_metric(partition_names, min_similarity)
+    cached = {}
+    to_search = root_vector_ids
+    if use_cache:
+        cached, to_search = get_neighbor_cache().get_many(collection_name, root_vector_ids, limit, metric)
 
-    # Set up a Milvus client
-    #print(f'Connecting to Milvus...')
-    client = MilvusClient(uri=CLUSTER_ENDPOINT, token=TOKEN)
-
-    # Get the root vectors from Milvus
-    root_vector_ids.sort()
-    #print(f'Retrieving vectors...')
-    res = client.get(collection_name=collection_name, ids=root_vector_ids)
-    res.sort(key=lambda x: x['primary_key'], reverse=False)
-    # Extract query vectors
-    query_vectors = []
-    for item in res:
-        query_vectors.append(item['vector'])
-
-    # Perform search
-    #print(f'Performing cosine similarity query...')
-    res = client.search(
-        collection_name=collection_name,  # target collection
-        data=query_vectors,  # query vectors
-        limit=limit,  # number of returned entities
-        output_fields=['file_name']
-    )
-
-    # Process results
-    #print(f'Processing results...')
+    # Get the root vectors from Milvus, then search with them
     output = {}
-    # filenames = set()
-    for i, query in enumerate(res):
-        results = []
-        for match in query:
-            vector_id = match['id']  # Accessing the first element of the list
-            cosine_similarity_value = match['distance']
-            # file_name = match['entity']['file_name']
-            # filenames.add(file_name)
-
-            # Append the tuple (vector_id, cell_name, file_name, cosine_similarity_value) to the results list
-            results.append((vector_id, cosine_similarity_value))
+    if to_search:
+        client = get_client()
+        vectors = fetch_vectors(collection_name, to_search, client)
+        query_ids = sorted(cell_id for cell_id in to_search if cell_id in vectors)
+        # One request for all of them, repeated only for the saturated ones when adaptive
+        output, _ = search_in_batches(collection_name, query_ids, [vectors[cell_id] for cell_id in query_ids],
+                                      limit=limit, batch_size=max(len(query_ids), 1), parallelism=1, client=client,
+                                      partition_names=partition_names, min_similarity=min_similarity,
+                                      adaptive=adaptive)
+        if use_cache:
+            get_neighbor_cache().put_many(collection_name, output, limit, metric)
+
+    output.update(cached)
+    return {cell_id: output[cell_id] for cell_id in sorted(output)}
+
+
+def read_cells(source):
+    """
+    Read new cells to search with.
 
-        # Sort results by cosine similarity value (descending order)
-        results.sort(key=lambda x: x[1], reverse=True)
+    :param source: A pandas DataFrame (rows are cells, columns are genes), or the path
+        of a cell/gene CSV with cell ids in the first column, a 10x directory / .mtx
+        file or an .h5ad file.
+    :return: A tuple (cell_ids, values, genes).
+    """
+    if isinstance(source, pd.DataFrame):
+        return source.index.to_numpy(), source.to_numpy(dtype=np.float32), source.columns.to_numpy(dtype=str)
+    if is_sparse_input(source):
+        cells, genes, matrix = read_sparse_matrix(source)
+        return cells, matrix, genes
+    matrix = load_matrix(source)
+    return matrix.cell_ids, matrix.values, matrix.genes
 
-        output[root_vector_ids[i]] = results
 
+def search_new_cells(collection_name, cells, genes=None, file_name=None, limit=10, batch_size=100,
+                     parallelism=4, projection=None):
+    """
+    Find the stored cells most similar to cells that are not in the collection,
+    without inserting them.
+
+    The new cells are aligned to the gene order of the projection the collection's
+    cells were embedded with, projected with one matrix multiply and searched in
+    concurrent batches. Nothing is refit and nothing is written.
+
+    Only the partition of the projection's source file is searched: every experiment
+    is embedded with its own PCA, so its coordinates are meaningless next to the
+    vectors of other experiments. To compare against several experiments, search
+    each one with its own file_name.
+
+    :param collection_name: The name of the collection to search.
+    :param cells: A DataFrame or file path as accepted by read_cells, or a
+        (n_cells, n_genes) array / scipy.sparse matrix of raw expression rows, in
+        which case genes is required.
+    :param genes: Gene names of the columns when cells is an array.
+    :param file_name: Source file whose projection to use and whose cells to search.
+        May be omitted when the collection has a single stored projection.
+    :param limit: The number of similar cells to find per new cell.
+    :param batch_size: New cells per search request.
+    :param parallelism: Maximum number of concurrent search requests.
+    :param projection: The Projection to use, when the caller already holds it. Defaults
+        to the stored one of collection_name and file_name.
+    :return: A dictionary of new cell id (row number for arrays) -> list of
+        (vector_id, cosine_similarity_value) tuples ordered by most to least similar.
+    """
+    if isinstance(cells, (str, pd.DataFrame)):
+        cell_ids, values, genes = read_cells(cells)
+    else:
+        if genes is None:
+            raise ValueError('genes is required when cells is an array')
+        values = cells
+        cell_ids = np.arange(values.shape[0])
+
+    file_name = model_file_name(collection_name, file_name)
+    projection = projection or load_model(collection_name, file_name)
+    with metrics.span('pca.transform', rows=values.shape[0]):
+        vectors, missing = projection.transform_genes(values, genes)
+    if missing:
+        print(f'{missing} of the {len(projection.genes)} genes of the projection are missing from the '
+              f'new cells and were treated as average')
+    output, _ = search_in_batches(collection_name, list(cell_ids.tolist()), vectors, limit, batch_size, parallelism,
+                                  partition_names=[experiment_partition(experiment_number(file_name))])
     return output
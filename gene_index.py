@@ -0,0 +1,300 @@
+"""
+Per-cell top-gene index built at ingest time.
+
+Ingestion ranks every cell's genes once and stores its top_n in a sidecar under
+<GENE_INDEX_PATH>/<collection>/<file>/:
+    keys.npy      int64 primary key of every row, as inserted into the collection
+    genes.npy     (n_cells, top_n) gene column indices, most to least expressed
+                  (uint16, or uint32 for more than 65536 genes)
+    values.npy    (n_cells, top_n) float16 expression of those genes
+    postings.npy  positions in the flattened genes.npy grouped by gene, and
+    indptr.npy    where each gene's positions start (n_genes + 1), together the
+                  gene -> cells inverted index for marker queries
+    gene_names.npy, meta.json
+The matrices are opened as read-only memory maps, so the top genes of search
+results are a gather over their rows instead of a reload and re-rank of the
+expression matrix. 327 genes per cell take 1.3 KB.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+import metrics
+from checkpoint import same_source
+from global_variables import GENE_INDEX_PATH
+from ingest import PRIMARY_KEY_SCHEME
+
+
+# 2: ties broken by column (see top_n_columns)
+INDEX_VERSION = 2
+
+# Genes kept per cell; get_similar_genes asks for this many by default
+DEFAULT_TOP_N = 327
+
+
+def top_n_columns(values, top_n):
+    """
+    Column indices and values of the top_n largest entries in every row, ordered
+    most to least expressed.
+
+    Ties are broken by column: the lower column ranks first and is the one kept at the
+    cutoff, so the top genes of a cell are the same whether they come from the index
+    or are ranked from the matrix, and for every top_n. argpartition finds the top_n in
+    linear time per row; only those top_n are then sorted.
+
+    :param values: (n_cells, n_genes) array or scipy.sparse matrix (densified, so pass blocks of rows).
+    :param top_n: Number of columns to keep per row.
+    :return: A tuple (indices, top_values), both of shape (n_cells, min(top_n, n_genes)).
+    """
+    values = values.toarray() if sp.issparse(values) else np.asarray(values)
+    top_n = min(top_n, values.shape[1])
+    if top_n == 0:
+        return np.empty((len(values), 0), dtype=np.int64), np.empty((len(values), 0), dtype=values.dtype)
+    n_genes = values.shape[1]
+    indices = np.argpartition(values, n_genes - top_n, axis=1)[:, n_genes - top_n:]
+    top_values = np.take_along_axis(values, indices, axis=1)
+    # argpartition keeps arbitrary columns among values tied at the cutoff; redo those rows
+    cutoff = top_values.min(axis=1, keepdims=True)
+    straddling = np.flatnonzero((values == cutoff).sum(axis=1) > (top_values == cutoff).sum(axis=1))
+    if len(straddling):
+        rows, row_cutoff = values[straddling], cutoff[straddling]
+        above = rows > row_cutoff
+        at_cutoff = rows == row_cutoff
+        # Every entry above the cutoff, then the lowest columns at it until top_n are taken
+        keep = above | (at_cutoff & (np.cumsum(at_cutoff, axis=1) <= top_n - above.sum(axis=1, keepdims=True)))
+        indices[straddling] = np.nonzero(keep)[1].reshape(len(straddling), top_n)
+        top_values[straddling] = np.take_along_axis(rows, indices[straddling], axis=1)
+    order = np.lexsort((indices, -top_values), axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_values, order, axis=1)
+
+
+def index_dir(collection_name, file_name, index_path=None):
+    return os.path.join(index_path or GENE_INDEX_PATH, collection_name, os.path.basename(file_name.rstrip(os.sep)))
+
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def has_gene_index(collection_name, file_name, top_n=DEFAULT_TOP_N, source=None, index_path=None,
+                   primary_keys=PRIMARY_KEY_SCHEME):
+    """
+    Whether an index of at least top_n genes per cell exists for the file.
+
+    :param source: Source signature the index must have been built from (see
+        checkpoint.source_signature). None accepts any.
+    :param primary_keys: Key scheme the index's keys must follow (see ingest.PRIMARY_KEY_SCHEME).
+    """
+    meta = _read_meta(index_dir(collection_name, file_name, index_path))
+    return (meta is not None and meta.get('version') == INDEX_VERSION
+            and meta['top_n'] >= min(top_n, meta['shape'][1])
+            and meta.get('primary_keys') == primary_keys
+            and (source is None or same_source(meta.get('source'), source)))
+
+
+def build_gene_index(collection_name, file_name, keys, values, genes, top_n=DEFAULT_TOP_N, source=None,
+                     chunk_rows=4096, index_path=None, primary_keys=PRIMARY_KEY_SCHEME):
+    """
+    Rank the genes of every cell of one source file and write its index.
+
+    :param collection_name: Collection the cells were inserted into.
+    :param file_name: Source file of the cells.
+    :param keys: Primary key of every row, as inserted.
+    :param values: (n_cells, n_genes) expression matrix (array, memory map or scipy.sparse),
+        read chunk_rows rows at a time.
+    :param genes: Gene names of the columns.
+    :param top_n: Genes kept per cell.
+    :param source: Signature of the source file, recorded so a changed file is re-indexed.
+    :param chunk_rows: Rows ranked at a time.
+    :param primary_keys: Key scheme of keys, recorded so an index keyed otherwise is rebuilt.
+    :return: The index directory.
+    """
+    directory = index_dir(collection_name, file_name, index_path)
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    n_cells, n_genes = values.shape
+    top_n = min(top_n, n_genes)
+    gene_dtype = np.uint16 if n_genes <= np.iinfo(np.uint16).max + 1 else np.uint32
+    with metrics.span('genes.index', rows=n_cells, top_n=top_n):
+        top_genes = np.lib.format.open_memmap(os.path.join(tmp, 'genes.npy'), mode='w+', dtype=gene_dtype,
+                                              shape=(n_cells, top_n))
+        top_values = np.lib.format.open_memmap(os.path.join(tmp, 'values.npy'), mode='w+', dtype=np.float16,
+                                               shape=(n_cells, top_n))
+        counts = np.zeros(n_genes, dtype=np.int64)
+        for start in range(0, n_cells, chunk_rows):
+            block = values[start:start + chunk_rows]
+            block = block.toarray() if sp.issparse(block) else np.asarray(block)
+            indices, block_values = top_n_columns(block, top_n)
+            top_genes[start:start + len(block)] = indices
+            top_values[start:start + len(block)] = block_values
+            counts += np.bincount(indices.ravel(), minlength=n_genes)
+        indptr = np.zeros(n_genes + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        # Inverted index: every (cell, rank) position grouped by gene. Each chunk is sorted
+        # on its own and scattered behind the positions of earlier chunks, which leaves every
+        # gene's positions in increasing order without sorting the whole index at once.
+        size = n_cells * top_n
+        position_dtype = np.uint32 if size <= np.iinfo(np.uint32).max else np.int64
+        postings = np.lib.format.open_memmap(os.path.join(tmp, 'postings.npy'), mode='w+', dtype=position_dtype,
+                                             shape=(size,))
+        cursor = indptr[:-1].copy()
+        for start in range(0, n_cells, chunk_rows):
+            flat = top_genes[start:start + chunk_rows].reshape(-1).astype(np.int64)
+            order = np.argsort(flat, kind='stable')
+            chunk_genes = flat[order]
+            chunk_counts = np.bincount(flat, minlength=n_genes)
+            # Offset of every position among the chunk's positions of the same gene
+            group_starts = np.cumsum(chunk_counts) - chunk_counts
+            within = np.arange(len(flat), dtype=np.int64) - group_starts[chunk_genes]
+            postings[cursor[chunk_genes] + within] = order + start * top_n
+            cursor += chunk_counts
+        postings.flush()
+        top_genes.flush()
+        top_values.flush()
+        del top_genes, top_values, postings
+
+    np.save(os.path.join(tmp, 'indptr.npy'), indptr)
+    np.save(os.path.join(tmp, 'keys.npy'), np.asarray(keys, dtype=np.int64))
+    np.save(os.path.join(tmp, 'gene_names.npy'), np.asarray(genes, dtype=str))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+        json.dump({
+            'version': INDEX_VERSION,
+            'collection': collection_name,
+            'source_file': file_name,
+            'source': source,
+            'primary_keys': primary_keys,
+            'top_n': top_n,
+            'shape': [n_cells, n_genes],
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, fh)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return directory
+
+
+def ensure_gene_index(collection_name, file_name, keys, values, genes, top_n=DEFAULT_TOP_N, source=None,
+                      index_path=None, primary_keys=PRIMARY_KEY_SCHEME):
+    """
+    build_gene_index unless an index of the same source and key scheme with enough genes
+    per cell exists.
+    """
+    if has_gene_index(collection_name, file_name, top_n, source, index_path, primary_keys):
+        return index_dir(collection_name, file_name, index_path)
+    print(f'Indexing the top {top_n} genes of every cell of {os.path.basename(file_name)}...')
+    return build_gene_index(collection_name, file_name, keys, values, genes, top_n, source, index_path=index_path,
+                            primary_keys=primary_keys)
+
+
+class GeneIndex:
+    """
+    The top-gene index of one source file, memory-mapped.
+
+    :ivar keys: Primary key of every row.
+    :ivar genes: (n_cells, top_n) gene column indices, most to least expressed.
+    :ivar values: (n_cells, top_n) float16 expression of those genes.
+    :ivar gene_names: Name of every gene column.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        meta = _read_meta(directory)
+        if meta is None:
+            raise ValueError(f'No gene index in {directory}')
+        self.top_n = meta['top_n']
+        self.source_file = meta['source_file']
+        self.keys = np.load(os.path.join(directory, 'keys.npy'))
+        self.genes = np.load(os.path.join(directory, 'genes.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(directory, 'values.npy'), mmap_mode='r')
+        self.postings = np.load(os.path.join(directory, 'postings.npy'), mmap_mode='r')
+        self.indptr = np.load(os.path.join(directory, 'indptr.npy'))
+        self.gene_names = np.load(os.path.join(directory, 'gene_names.npy'))
+        self._order = np.argsort(self.keys, kind='stable')
+        self._sorted_keys = self.keys[self._order]
+        self._gene_columns = None
+
+    @classmethod
+    def open(cls, collection_name, file_name, index_path=None):
+        return cls(index_dir(collection_name, file_name, index_path))
+
+    def rows(self, keys):
+        """
+        Row of every primary key, -1 for keys not in the index.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_keys, keys), max(len(self._sorted_keys) - 1, 0))
+        found = (self._sorted_keys[positions] == keys) if len(self._sorted_keys) else np.zeros(len(keys), bool)
+        return np.where(found, self._order[positions], -1)
+
+    def top_genes(self, keys, top_n=None):
+        """
+        Top genes of cells, gathered from the index.
+
+        :param keys: Primary keys of the cells.
+        :param top_n: Genes per cell, at most the indexed number. Defaults to all indexed.
+        :return: A tuple (found, gene_columns, values): a boolean mask of the keys in the
+            index, and the (n_found, top_n) gene columns and values of those keys.
+        """
+        top_n = self.top_n if top_n is None else min(top_n, self.top_n)
+        rows = self.rows(keys)
+        found = rows >= 0
+        rows = rows[found]
+        with metrics.span('genes.gather', rows=len(rows), top_n=top_n):
+            return found, self.genes[rows, :top_n].astype(np.int64), self.values[rows, :top_n].astype(np.float32)
+
+    def gene_column(self, gene):
+        if self._gene_columns is None:
+            self._gene_columns = {name: column for column, name in enumerate(self.gene_names.tolist())}
+        if gene not in self._gene_columns:
+            raise ValueError(f'Unknown gene {gene}')
+        return self._gene_columns[gene]
+
+    def cells_with_gene(self, gene, max_rank=None):
+        """
+        Cells that have a gene among their top genes (gene -> cells inverted lookup).
+
+        :param gene: Gene name.
+        :param max_rank: Only cells with the gene among their max_rank most expressed.
+        :return: A tuple (keys, ranks, values), ordered by decreasing expression.
+        """
+        column = self.gene_column(gene)
+        positions = np.asarray(self.postings[self.indptr[column]:self.indptr[column + 1]], dtype=np.int64)
+        rows, ranks = np.divmod(positions, self.genes.shape[1])
+        if max_rank is not None:
+            keep = ranks < max_rank
+            rows, ranks = rows[keep], ranks[keep]
+        values = np.asarray(self.values[rows, ranks], dtype=np.float32)
+        order = np.argsort(-values, kind='stable')
+        return self.keys[rows[order]], ranks[order], values[order]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_gene_index(collection_name, file_name, index_path=None):
+    """
+    The GeneIndex of a file, opened once per process and reopened after it is rebuilt.
+    """
+    directory = index_dir(collection_name, file_name, index_path)
+    try:
+        version = os.stat(os.path.join(directory, 'meta.json')).st_mtime_ns
+    except OSError:
+        raise ValueError(f'No gene index for {file_name} in collection {collection_name}')
+    with _indexes_lock:
+        cached = _indexes.get(directory)
+        if cached is None or cached[0] != version:
+            cached = _indexes[directory] = (version, GeneIndex(directory))
+        return cached[1]
@@ -2,4 +2,32 @@ import os
 
 CLUSTER_ENDPOINT = "https://in03-d3226d3522b7074.api.gcp-us-west1.zillizcloud.com"
 
-TOKEN = os.getenv('Zilliz_API_Key')
\ No newline at end of file
+TOKEN = os.getenv('Zilliz_API_Key')
+
+# Which vector search backend to use: 'milvus' for the hosted Zilliz cluster above,
+# 'local' for the in-process exact search engine in local_backend.py
+BACKEND = os.getenv('SCMILVUS_BACKEND', 'milvus')
+
+# Where the local backend persists its collections
+LOCAL_DB_PATH = os.getenv('SCMILVUS_LOCAL_DB', os.path.join('data', 'local_db'))
+
+# Where parsed expression matrices are cached as memory-mappable binaries
+MATRIX_CACHE_PATH = os.getenv('SCMILVUS_MATRIX_CACHE', os.path.join('data', '.cache'))
+
+# SQLite file backing the persistent tier of the neighbor search cache
+NEIGHBOR_CACHE_PATH = os.getenv('SCMILVUS_NEIGHBOR_CACHE', os.path.join('data', 'neighbor_cache.sqlite'))
+
+# Metrics output: a .jsonl trace file, a .prom Prometheus snapshot, or unset to disable
+METRICS_PATH = os.getenv('SCMILVUS_METRICS')
+
+# Where ingestion checkpoint manifests and their fitted projections are kept
+CHECKPOINT_PATH = os.getenv('SCMILVUS_CHECKPOINTS', os.path.join('data', '.checkpoints'))
+
+# Where the projection fitted for each collection and source file is stored
+MODEL_PATH = os.getenv('SCMILVUS_MODELS', os.path.join('data', 'models'))
+
+# Where the per-cell top-gene index built at ingest is stored (see gene_index.py)
+GENE_INDEX_PATH = os.getenv('SCMILVUS_GENE_INDEX', os.path.join('data', 'gene_index'))
+
+# Unix socket the query service (service.py) listens on and service_client.py connects to
+SERVICE_SOCKET = os.getenv('SCMILVUS_SOCKET', os.path.join('data', 'scmilvus.sock'))
@@ -0,0 +1,270 @@
+"""
+Batch building and pipelined upload used by the insert functions in
+database_connections.py.
+
+Batches are kept as NumPy arrays (int64 primary keys, float32 vectors) from the
+moment they are produced until a worker thread hands them to the client, so the
+producer never touches individual rows. Uploads run on a bounded thread pool:
+while the workers wait on the network, the producer is already parsing and
+transforming the next chunk.
+"""
+import queue
+import resource
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+
+
+# partition is the partition the rows are inserted into; None is the default partition
+Batch = namedtuple('Batch', ['start', 'keys', 'vectors', 'file_name', 'partition'], defaults=[None])
+
+
+class IngestStats:
+    """
+    Thread-safe counters for one ingest run.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, rows, retries=0):
+        with self._lock:
+            self.rows += rows
+            self.batches += 1
+            self.retries += retries
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.start_time
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def report(self):
+        """
+        Print rows/s and peak resident memory for the run.
+        """
+        print(f'Inserted {self.rows} rows in {self.batches} batches in {self.seconds:.2f}s '
+              f'({self.rows_per_second:.0f} rows/s, {self.retries} retries, '
+              f'peak RSS {peak_rss_mb():.0f} MB)')
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rows uploaded per second, shared by every producer.
+    """
+
+    def __init__(self, rows_per_second, burst=None):
+        """
+        :param rows_per_second: Sustained upload rate.
+        :param burst: Rows that may be sent at once after an idle period. Defaults to
+            one second's worth.
+        """
+        self.rate = float(rows_per_second)
+        self.capacity = float(burst or rows_per_second)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, rows):
+        """
+        Block until rows may be sent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Go into debt and sleep it off, so a batch larger than the bucket still passes
+            self.tokens -= rows
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Every ingest path numbers cells with experiment_primary_keys, whatever ids the source
+# file carries, so a file gets the same keys however it is ingested. Recorded in
+# checkpoint settings and gene-index metadata so data keyed otherwise is never resumed.
+PRIMARY_KEY_SCHEME = 'experiment'
+
+
+def experiment_primary_keys(experiment_num, n_cells):
+    """
+    Primary keys following the experiment digit + 5-digit cell index convention,
+    i.e. experiment 1 gets 100000, 100001, 100002, ...
+
+    :param experiment_num: The experiment number.
+    :param n_cells: Number of cells in the experiment.
+    :return: int64 array of n_cells primary keys.
+    """
+    if n_cells > 100000:
+        raise ValueError(f'Experiment {experiment_num} has {n_cells} cells; the primary key '
+                         f'convention only leaves room for 100000 per experiment')
+    return np.arange(n_cells, dtype=np.int64) + np.int64(experiment_num) * 100000
+
+
+def experiment_of(keys):
+    """
+    Experiment numbers of primary keys following the experiment_primary_keys convention.
+    """
+    return np.asarray(keys, dtype=np.int64) // 100000
+
+
+def experiment_rows(experiment_num, keys, n_cells):
+    """
+    Row of every primary key within its experiment's source file, -1 for keys that are
+    not among the experiment's n_cells.
+    """
+    rows = np.asarray(keys, dtype=np.int64) - np.int64(experiment_num) * 100000
+    return np.where((rows >= 0) & (rows < n_cells), rows, -1)
+
+
+def batch_rows(batch, cell_name='na'):
+    """
+    Convert a Batch into the list of row dictionaries MilvusClient.insert expects.
+    Vectors are passed as float32 array views, not Python lists.
+    """
+    keys = batch.keys.tolist()
+    return [
+        {'primary_key': key, 'vector': vector, 'cell_name': cell_name, 'file_name': batch.file_name}
+        for key, vector in zip(keys, batch.vectors)
+    ]
+
+
+def send_batch(client, collection_name, batch, max_retries=5, backoff=0.5, upsert=False):
+    """
+    Insert one batch, retrying failed requests with exponential backoff.
+
+    :param upsert: Replace rows whose primary key is already stored instead of adding
+        duplicates, so re-sending a batch is harmless.
+    :return: The number of retries that were needed.
+    """
+    partition = {'partition_name': batch.partition} if batch.partition else {}
+    if hasattr(client, 'insert_columns'):
+        # The local backend always replaces existing keys, so this is also an upsert
+        def send():
+            client.insert_columns(collection_name, batch.keys, batch.vectors,
+                                  {'cell_name': 'na', 'file_name': batch.file_name}, **partition)
+    else:
+        with metrics.span('batch.build', rows=len(batch.keys)):
+            rows = batch_rows(batch)
+
+        request = client.upsert if upsert else client.insert
+
+        def send():
+            request(collection_name=collection_name, data=rows, **partition)
+
+    for attempt in range(max_retries + 1):
+        try:
+            with metrics.span('rpc.insert', rows=len(batch.keys), bytes=batch.vectors.nbytes + batch.keys.nbytes):
+                send()
+            return attempt
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            metrics.count('ingest.retries')
+            delay = backoff * 2 ** attempt
+            print(f'Insert of rows {batch.start} to {batch.start + len(batch.keys)} failed ({e}). '
+                  f'Retrying in {delay:.1f}s...')
+            time.sleep(delay)
+
+
+def prefetch(iterable, depth=2):
+    """
+    Run an iterator on a background thread, keeping up to depth items ready.
+    Used to overlap CSV parsing with the PCA transform that consumes it.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def run_pipeline(client, collection_name, batches, workers=4, max_retries=5, backoff=0.5, upsert=False,
+                 on_success=None, rate_limiter=None):
+    """
+    Upload batches through a bounded pool of insert workers.
+
+    At most 2 * workers batches are held in memory at once; the producer blocks
+    until a slot frees up.
+
+    :param client: A MilvusClient or LocalMilvusClient.
+    :param collection_name: Collection to insert into.
+    :param batches: Iterable of Batch tuples. It is consumed lazily, so any parsing
+        or transform work it does overlaps with the uploads already in flight.
+    :param workers: Number of concurrent insert requests.
+    :param max_retries: Attempts per batch after the first before giving up.
+    :param backoff: Initial retry delay in seconds, doubled after each failure.
+    :param upsert: Send the batches as upserts (see send_batch).
+    :param on_success: Called with each Batch once the server has accepted it, from a
+        worker thread (e.g. IngestCheckpoint.ack).
+    :param rate_limiter: A RateLimiter every batch waits on before it is sent.
+    :return: An IngestStats for the run. Raises the first batch error after retries.
+    """
+    stats = IngestStats()
+    slots = threading.BoundedSemaphore(2 * workers)
+    errors = []
+    span = metrics.span('ingest.pipeline', collection=collection_name, workers=workers)
+
+    def finished(future, batch):
+        try:
+            if future.exception() is None:
+                stats.add(len(batch.keys), future.result())
+                if on_success is not None:
+                    on_success(batch)
+            else:
+                errors.append(future.exception())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            slots.release()
+
+    with span, ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            slots.acquire()
+            if errors:
+                # Stop producing as soon as a batch has failed for good
+                slots.release()
+                break
+            if rate_limiter is not None:
+                rate_limiter.acquire(len(batch.keys))
+            future = executor.submit(send_batch, client, collection_name, batch, max_retries, backoff, upsert)
+            future.add_done_callback(lambda f, b=batch: finished(f, b))
+    span.set(rows=stats.rows, batches=stats.batches)
+    if errors:
+        raise errors[0]
+    return stats
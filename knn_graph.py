@@ -0,0 +1,276 @@
+"""
+Offline k-nearest-neighbor graph of a collection.
+
+The vectors of a collection (or one experiment in it) are exported once, every
+cell's k nearest neighbors are found in a blocked all-pairs pass, and the result
+is stored on disk as a compressed CSR adjacency matrix. find_clusters can then
+expand seeds over the stored graph instead of querying the database.
+
+snn_clusters partitions any kNN graph (stored, or collected from searches by
+analysis.cluster_cells) into shared-nearest-neighbor communities.
+
+Usage:
+    python knn_graph.py <collection> --k 1024 [--file-name ex_2_pool_b.csv] [--out path.npz]
+"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from database_connections import get_client
+
+
+def export_vectors(collection_name, file_name=None, batch_size=1000, client=None):
+    """
+    Read every vector of a collection with a query iterator.
+
+    :param collection_name: The name of the collection to export.
+    :param file_name: Only export the cells that came from this source file.
+    :param batch_size: Rows fetched per request.
+    :param client: Client to use. Defaults to the shared client from get_client().
+    :return: A tuple (keys, vectors): int64 primary keys and a float32 matrix, sorted by key.
+    """
+    client = client or get_client()
+    expression = f'file_name == "{file_name}"' if file_name else 'primary_key >= 0'
+    iterator = client.query_iterator(collection_name=collection_name, batch_size=batch_size,
+                                     filter=expression, output_fields=['primary_key', 'vector'])
+    keys = []
+    vectors = []
+    while True:
+        batch = iterator.next()
+        if not batch:
+            break
+        keys.extend(item['primary_key'] for item in batch)
+        vectors.extend(item['vector'] for item in batch)
+    iterator.close()
+
+    keys = np.asarray(keys, dtype=np.int64)
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+    order = np.argsort(keys, kind='stable')
+    return keys[order], vectors[order]
+
+
+def build_knn_graph(vectors, k, block_size=1024, n_jobs=None, max_block_floats=1 << 26):
+    """
+    Exact cosine kNN graph from one blocked all-pairs pass.
+
+    Each block of rows is scored against every vector with one matrix multiply and
+    its top k is selected with argpartition. Blocks run on a thread pool (BLAS and
+    argpartition release the GIL), so all cores are used.
+
+    :param vectors: (n, dimension) array.
+    :param k: Neighbors per cell. Every cell is its own first neighbor, matching what
+        a database search for a stored cell returns.
+    :param block_size: Rows scored per matrix multiply.
+    :param n_jobs: Worker threads. Defaults to the number of CPUs.
+    :param max_block_floats: Cap, in 4-byte words, on the scratch memory of all blocks
+        in flight together: each running block holds its float32 score matrix and the
+        int64 argpartition of it. block_size is reduced for large collections or many
+        workers so memory stays bounded.
+    :return: An (n, n) CSR matrix. Row i holds the similarities of cell i's k nearest
+        neighbors, with the column indices ordered from most to least similar.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n = len(vectors)
+    k = min(k, n)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms > 0, norms, 1.0)
+    n_jobs = n_jobs or os.cpu_count() or 1
+    # A block row costs n float32 scores plus n int64 argpartition indices
+    block_size = max(1, min(block_size, max_block_floats // (3 * max(n, 1) * n_jobs)))
+
+    indices = np.empty((n, k), dtype=np.int32 if n < 2 ** 31 else np.int64)
+    data = np.empty((n, k), dtype=np.float32)
+
+    def score_block(start):
+        stop = min(start + block_size, n)
+        scores = unit[start:stop] @ unit.T
+        top = np.argpartition(scores, n - k, axis=1)[:, n - k:]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        indices[start:stop] = np.take_along_axis(top, order, axis=1)
+        data[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(score_block, range(0, n, block_size)))
+
+    indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+    # Built directly from the arrays so the per-row neighbor order is preserved
+    return sp.csr_matrix((data.ravel(), indices.ravel(), indptr), shape=(n, n))
+
+
+def save_knn_graph(path, keys, graph):
+    """
+    Save a kNN graph and the primary keys of its rows as a compressed .npz file.
+    """
+    np.savez_compressed(path, keys=keys, data=graph.data, indices=graph.indices,
+                        indptr=graph.indptr, shape=np.asarray(graph.shape))
+
+
+def load_knn_graph(path):
+    """
+    Load a graph written by save_knn_graph.
+
+    :return: A tuple (keys, graph).
+    """
+    with np.load(path) as arrays:
+        graph = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                              shape=tuple(arrays['shape']))
+        return arrays['keys'], graph
+
+
+def default_graph_path(collection_name, file_name=None):
+    suffix = f'_{file_name}' if file_name else ''
+    return os.path.join('data', f'knn_{collection_name}{suffix}.npz')
+
+
+def expand_over_graph(keys, graph, seed_ids, limit, iterations):
+    """
+    Run the seed expansion of find_clusters as sparse matrix traversal.
+
+    Each iteration "queries" the frontier by multiplying its indicator vector with
+    the adjacency matrix: a cell's hit count grows by one for every frontier cell
+    that lists it among its first limit neighbors. The next frontier is every cell
+    reached that has not been queried yet.
+
+    :param keys: Primary keys of the graph rows.
+    :param graph: CSR kNN graph from build_knn_graph with at least limit neighbors per row.
+    :param seed_ids: Primary keys to start from.
+    :param limit: Neighbors per query, as in find_clusters.
+    :param iterations: Expansion rounds, as in find_clusters.
+    :return: A tuple (counts, queried_cells): counts is a dictionary of primary key ->
+        number of hits, for every cell that was reached.
+    """
+    k = int(np.diff(graph.indptr).max()) if graph.nnz else 0
+    if limit > k and k < graph.shape[0]:
+        raise ValueError(f'The graph only stores {k} neighbors per cell; limit={limit} needs a graph '
+                         f'built with k >= {limit}')
+    if limit < k:
+        # Keep the first limit neighbors of every row; rows are ordered by similarity
+        lengths = np.diff(graph.indptr)
+        kept = np.minimum(lengths, limit)
+        position = np.arange(graph.nnz) - np.repeat(graph.indptr[:-1], lengths)
+        mask = position < np.repeat(kept, lengths)
+        graph = sp.csr_matrix((graph.data[mask], graph.indices[mask], np.concatenate([[0], np.cumsum(kept)])),
+                              shape=graph.shape)
+    # Unit weights: an edge counts once even if its similarity happens to be 0
+    adjacency = sp.csr_matrix((np.ones(graph.nnz, dtype=np.int32), graph.indices, graph.indptr),
+                              shape=graph.shape)
+
+    rows = pd.Index(keys).get_indexer(list(seed_ids))
+    frontier = np.zeros(len(keys), dtype=bool)
+    frontier[rows[rows >= 0]] = True
+    queried = np.zeros(len(keys), dtype=bool)
+    counts = np.zeros(len(keys), dtype=np.int64)
+    queried_cells = 0
+    for _ in range(iterations):
+        if not frontier.any():
+            break
+        hits = adjacency.T @ frontier.astype(np.int32)
+        counts += hits
+        queried |= frontier
+        queried_cells += int(frontier.sum())
+        frontier = (hits > 0) & ~queried
+
+    reached = np.flatnonzero(counts)
+    return dict(zip(keys[reached].tolist(), counts[reached].tolist())), queried_cells
+
+
+def snn_clusters(graph, prune=0.15, min_size=10, searched=None):
+    """
+    Shared-nearest-neighbor communities of a kNN graph.
+
+    A searched cell's neighborhood is itself plus the cells it lists and the searched
+    cells that list it. Two searched cells are linked when the Jaccard index of their
+    neighborhoods is at least prune (the SNN pruning Seurat uses), and communities are
+    the connected components of those links. A few weak links are enough to chain two
+    populations together, so prune is stricter than Seurat's 1/15; the cells it strands
+    in components smaller than min_size then join the community they share the most
+    neighbors with. Cells that were reached but not searched only have the few edges
+    pointing at them, which would make their Jaccard indexes meaningless, so they take
+    the community of the searched cells that list them instead.
+    Everything is sparse matrix arithmetic: the shared neighbor counts of all pairs
+    are one product A @ A.T.
+
+    :param graph: (n, n) sparse kNN graph; any stored entry (i, j) means j is a neighbor of i.
+    :param prune: Smallest Jaccard index that links two cells.
+    :param min_size: Components smaller than this are dissolved into their neighbors' communities.
+    :param searched: Boolean array marking the rows whose neighbors are known. Defaults to
+        every row, as for graphs from build_knn_graph.
+    :return: int array of n community labels, numbered by size (0 is the largest).
+    """
+    graph = sp.csr_matrix(graph)
+    n = graph.shape[0]
+    searched = np.ones(n, dtype=bool) if searched is None else np.asarray(searched, dtype=bool)
+    # Unit weights: an edge counts once even if its similarity happens to be 0
+    knn = sp.csr_matrix((np.ones(graph.nnz, dtype=np.float32), graph.indices, graph.indptr), shape=graph.shape)
+    knn = sp.diags(searched.astype(np.float32)) @ knn
+    neighborhoods = (knn + knn.T + sp.identity(n, dtype=np.float32, format='csr')).astype(bool).astype(np.float32)
+
+    core = np.flatnonzero(searched)
+    core_neighborhoods = neighborhoods[core]
+    sizes = np.asarray(core_neighborhoods.sum(axis=1)).ravel()
+    shared = (core_neighborhoods @ core_neighborhoods.T).tocoo()
+    jaccard = shared.data / (sizes[shared.row] + sizes[shared.col] - shared.data)
+    keep = jaccard >= prune
+    links = sp.csr_matrix((jaccard[keep], (shared.row[keep], shared.col[keep])), shape=(len(core), len(core)))
+    _, core_labels = connected_components(links, directed=False)
+
+    similarity = sp.csr_matrix((jaccard, (shared.row, shared.col)), shape=(len(core), len(core)))
+    for _ in range(3):
+        small = np.bincount(core_labels)[core_labels] < min_size
+        if not small.any() or small.all():
+            break
+        # Summed Jaccard of each small-component cell to every large community
+        large = np.flatnonzero(~small)
+        membership = sp.csr_matrix((np.ones(len(large), dtype=np.float32), (large, core_labels[large])),
+                                   shape=(len(core), core_labels.max() + 1))
+        votes = similarity[small] @ membership
+        voted = np.asarray(votes.sum(axis=1)).ravel() > 0
+        core_labels[np.flatnonzero(small)[voted]] = np.asarray(votes[voted].argmax(axis=1)).ravel()
+
+    labels = np.full(n, -1, dtype=np.int64)
+    labels[core] = core_labels
+    rest = np.flatnonzero(~searched)
+    if len(rest) and len(core):
+        membership = sp.csr_matrix((np.ones(len(core), dtype=np.float32), (core, core_labels)),
+                                   shape=(n, core_labels.max() + 1))
+        votes = knn.T.tocsr()[rest] @ membership
+        voted = np.asarray(votes.sum(axis=1)).ravel() > 0
+        labels[rest[voted]] = np.asarray(votes[voted].argmax(axis=1)).ravel()
+    # Cells nothing links to are communities of their own
+    unlinked = np.flatnonzero(labels < 0)
+    labels[unlinked] = labels.max() + 1 + np.arange(len(unlinked))
+
+    # Renumber so the largest community is 0
+    counts = np.bincount(labels)
+    rank = np.empty_like(counts)
+    rank[np.argsort(-counts, kind='stable')] = np.arange(len(counts))
+    return rank[labels]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the kNN graph of a collection')
+    parser.add_argument('collection', help='Collection to export')
+    parser.add_argument('--k', type=int, default=1024, help='Neighbors per cell')
+    parser.add_argument('--file-name', default=None, help='Only use cells from this source file')
+    parser.add_argument('--block-size', type=int, default=1024, help='Rows per matrix multiply')
+    parser.add_argument('--jobs', type=int, default=None, help='Worker threads (default: all CPUs)')
+    parser.add_argument('--out', default=None, help='Output .npz path')
+    args = parser.parse_args()
+
+    print(f'Exporting vectors from {args.collection}...')
+    keys, vectors = export_vectors(args.collection, args.file_name)
+    print(f'Building {args.k}-NN graph over {len(keys)} cells...')
+    graph = build_knn_graph(vectors, args.k, args.block_size, args.jobs)
+    out = args.out or default_graph_path(args.collection, args.file_name)
+    save_knn_graph(out, keys, graph)
+    print(f'Saved graph to {out}')
+
+
+if __name__ == '__main__':
+    main()
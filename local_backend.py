@@ -0,0 +1,740 @@
+"""
+In-process exact vector search backend that stands in for a Milvus collection.
+
+The LocalMilvusClient answers the same get/search/insert calls that
+database_connections.py and analysis.py make against MilvusClient, but keeps
+every collection in memory as a contiguous float32 matrix with parallel
+arrays for the primary keys and scalar fields (file_name, cell_name, ...).
+Searches are exact: queries are scored against blocks of the matrix with one
+matrix multiply per block and the top-k is selected with argpartition.
+
+Rows can be placed in named partitions. A search restricted to some partitions
+only scores the row ranges those partitions occupy, so pruning experiments
+reduces the work instead of just masking the results.
+
+A collection created with a quantized index type (IVF_SQ8 or IVF_PQ, see
+quantization.py) also keeps a compact code per row, trained once the collection
+holds MIN_TRAIN_ROWS rows. Searches then score the codes and re-rank a
+shortlist with the exact vectors, and a saved collection is loaded with its
+float32 vectors memory-mapped, so only the codes and the re-ranked rows have to
+be in RAM.
+
+Collections are persisted to <path>/<collection>.npz (plus the vectors in
+<collection>.vectors.npy) when flushed (and at interpreter exit), so data
+inserted in one script run can be searched in the next one without a network
+connection.
+"""
+import ast
+import atexit
+import json
+import math
+import os
+import re
+import threading
+
+import numpy as np
+
+from quantization import (DEFAULT_REFINE_K, MIN_TRAIN_ROWS, QUANTIZED_INDEX_TYPES, TRAIN_ROWS, load_quantizer,
+                          make_quantizer)
+
+
+# Rows scored per matrix multiply, and queries scored per pass over the matrix.
+BLOCK_ROWS = 65536
+QUERY_BLOCK = 1024
+
+DEFAULT_PARTITION = '_default'
+
+# Collections are shared by every client that points at the same path, the same
+# way every MilvusClient sees the same server-side collection.
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+_CONDITION = re.compile(r'^\s*(\w+)\s*(==|!=|>=|<=|>|<|not\s+in|in)\s*(.+?)\s*$')
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+}
+
+
+class LocalCollection:
+    """
+    One collection: a growable float32 vector matrix, int64 primary keys, the
+    partition of every row and a column per scalar field, all indexed by row.
+    """
+
+    def __init__(self, name, dimension=None, metric_type='COSINE', primary_field='primary_key',
+                 vector_field='vector', description='', index_type='FLAT', index_params=None):
+        self.name = name
+        self.description = description
+        self.dimension = dimension
+        self.metric_type = metric_type.upper()
+        self.primary_field = primary_field
+        self.vector_field = vector_field
+        self.size = 0
+        self.keys = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dimension or 0), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.partitions = [DEFAULT_PARTITION]
+        self.partition_codes = np.empty(0, dtype=np.int32)
+        self.fields = {}
+        self.row_of = {}
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        # Untrained until build_index(); codes is None until then
+        self.quantizer = make_quantizer(index_type, self.index_params)
+        self.codes = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _reserve(self, n):
+        """
+        Grow the backing arrays (amortized doubling) so that n more rows fit.
+        """
+        needed = self.size + n
+        capacity = len(self.keys)
+        if needed <= capacity:
+            if not self.vectors.flags.writeable:
+                # Vectors memory-mapped by load() are read into memory before they are written
+                self.vectors = np.array(self.vectors)
+            return
+        capacity = max(needed, 2 * capacity, 1024)
+        keys = np.empty(capacity, dtype=np.int64)
+        keys[:self.size] = self.keys[:self.size]
+        vectors = np.empty((capacity, self.dimension), dtype=np.float32)
+        vectors[:self.size] = self.vectors[:self.size]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[:self.size] = self.norms[:self.size]
+        codes = np.zeros(capacity, dtype=np.int32)
+        codes[:self.size] = self.partition_codes[:self.size]
+        if self.codes is not None:
+            grown = np.empty((capacity, self.codes.shape[1]), dtype=np.uint8)
+            grown[:self.size] = self.codes[:self.size]
+            self.codes = grown
+        for field, column in self.fields.items():
+            grown = np.empty(capacity, dtype=object)
+            grown[:self.size] = column[:self.size]
+            self.fields[field] = grown
+        self.keys, self.vectors, self.norms, self.partition_codes = keys, vectors, norms, codes
+
+    def partition_code(self, partition, create=False):
+        """
+        Index of a partition name in self.partitions.
+        """
+        if partition is None:
+            return 0
+        if partition not in self.partitions:
+            if not create:
+                raise KeyError(f'Collection {self.name} has no partition {partition}')
+            self.partitions.append(partition)
+        return self.partitions.index(partition)
+
+    def insert(self, rows, partition=None):
+        """
+        Insert a list of row dictionaries. A row whose primary key already exists
+        replaces the stored row.
+
+        :param rows: List of dicts with the primary key, vector and scalar fields.
+        :param partition: Partition to place the rows in. Defaults to '_default'.
+        :return: The list of primary keys written.
+        """
+        if not rows:
+            return []
+        vectors = np.asarray([row[self.vector_field] for row in rows], dtype=np.float32)
+        if vectors.ndim != 2:
+            raise ValueError(f'Vectors inserted into {self.name} must all have the same length')
+        keys = np.fromiter((row[self.primary_field] for row in rows), dtype=np.int64, count=len(rows))
+        scalars = {}
+        for field in rows[0].keys():
+            if field not in (self.primary_field, self.vector_field):
+                scalars[field] = [row.get(field) for row in rows]
+        return self.insert_columns(keys, vectors, scalars, partition)
+
+    def insert_columns(self, keys, vectors, scalars=None, partition=None):
+        """
+        Column-oriented insert used by insert() and by callers that already hold
+        NumPy arrays.
+
+        :param keys: int64 array of primary keys.
+        :param vectors: (n, dimension) array of vectors.
+        :param scalars: Dict of field name -> sequence (or single value broadcast to every row).
+        :param partition: Partition name, or an array of partition codes (one per row) when
+            restoring a saved collection. Defaults to '_default'.
+        :return: The list of primary keys written.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scalars = scalars or {}
+        with self.lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                self.vectors = np.empty((0, self.dimension), dtype=np.float32)
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f'Vector dimension {vectors.shape[1]} does not match '
+                                 f'collection {self.name} dimension {self.dimension}')
+
+            # Rows whose key already exists are overwritten in place, the rest are appended.
+            # Only the last occurrence of a key repeated within one batch is kept.
+            last = {}
+            for j, key in enumerate(keys.tolist()):
+                last[key] = j
+            order = np.fromiter(last.values(), dtype=np.int64, count=len(last))
+            targets = np.empty(len(order), dtype=np.int64)
+            n_new = 0
+            for j, key in enumerate(keys[order].tolist()):
+                row = self.row_of.get(key)
+                if row is None:
+                    row = self.size + n_new
+                    self.row_of[key] = row
+                    n_new += 1
+                targets[j] = row
+
+            self._reserve(n_new)
+            for field in scalars:
+                if field not in self.fields:
+                    self.fields[field] = np.empty(len(self.keys), dtype=object)
+            self.keys[targets] = keys[order]
+            self.vectors[targets] = vectors[order]
+            self.norms[targets] = np.linalg.norm(vectors[order], axis=1)
+            if self.codes is not None:
+                self.codes[targets] = self.quantizer.encode(vectors[order])
+            if isinstance(partition, np.ndarray):
+                self.partition_codes[targets] = partition[order]
+            else:
+                self.partition_codes[targets] = self.partition_code(partition, create=True)
+            for field, values in scalars.items():
+                if isinstance(values, (str, bytes, int, float)) or values is None:
+                    self.fields[field][targets] = values
+                else:
+                    self.fields[field][targets] = np.asarray(values, dtype=object)[order]
+            self.size += n_new
+            self.dirty = True
+        return keys[order].tolist()
+
+    def column(self, field):
+        """
+        Values of one field for every stored row.
+        """
+        if field == self.primary_field:
+            return self.keys[:self.size]
+        if field in self.fields:
+            return self.fields[field][:self.size]
+        raise KeyError(f'Collection {self.name} has no scalar field {field}')
+
+    def filter_mask(self, expression):
+        """
+        Evaluate a Milvus boolean filter expression over the stored rows.
+
+        Supports comparisons of a field with a literal (==, !=, >, >=, <, <=, in,
+        not in) joined by "and", e.g. 'file_name == "ex_1_a.csv" and primary_key >= 100000'.
+
+        :return: Boolean array over rows, or None for an empty expression.
+        """
+        if not expression or not expression.strip():
+            return None
+        mask = np.ones(self.size, dtype=bool)
+        for condition in re.split(r'\s+(?:and|AND|&&)\s+', expression.strip()):
+            match = _CONDITION.match(condition)
+            if match is None:
+                raise ValueError(f'Unsupported filter expression for the local backend: {condition}')
+            field, op, literal = match.groups()
+            op = ' '.join(op.split())
+            column = self.column(field)
+            value = ast.literal_eval(literal)
+            if op in ('in', 'not in'):
+                values = set(value)
+                hit = np.fromiter((v in values for v in column.tolist()), dtype=bool, count=len(column))
+                mask &= hit if op == 'in' else ~hit
+            else:
+                mask &= np.asarray(_OPERATORS[op](column, value), dtype=bool)
+        return mask
+
+    def rows_for(self, ids):
+        """
+        Map primary keys to row offsets, dropping keys that are not stored.
+        """
+        rows = [self.row_of.get(int(key)) for key in ids]
+        return np.asarray([row for row in rows if row is not None], dtype=np.int64)
+
+    def entity(self, row, output_fields):
+        """
+        Build the dictionary Milvus returns for one stored row.
+        """
+        out = {}
+        for field in output_fields:
+            if field == self.primary_field:
+                out[field] = int(self.keys[row])
+            elif field == self.vector_field:
+                out[field] = np.array(self.vectors[row])
+            elif field in self.fields:
+                out[field] = self.fields[field][row]
+        return out
+
+    def build_index(self):
+        """
+        Train the quantizer of a quantized index on (a sample of) the stored vectors
+        and encode every row. Rows inserted afterwards are encoded as they arrive.
+        """
+        if self.quantizer is None:
+            return
+        with self.lock:
+            n = self.size
+            sample = np.arange(n)
+            if n > TRAIN_ROWS:
+                sample = np.sort(np.random.default_rng(0).choice(n, TRAIN_ROWS, replace=False))
+            self.quantizer.train(np.asarray(self.vectors[sample]))
+            codes = np.empty((len(self.keys), self.quantizer.code_size(self.dimension)), dtype=np.uint8)
+            for start in range(0, n, BLOCK_ROWS):
+                stop = min(start + BLOCK_ROWS, n)
+                codes[start:stop] = self.quantizer.encode(self.vectors[start:stop])
+            self.codes = codes
+            self.dirty = True
+
+    def _quantized(self):
+        """
+        Whether searches run over the codes, training the quantizer first if enough
+        rows have arrived since the collection was created.
+        """
+        if self.quantizer is None:
+            return False
+        if self.codes is None and self.size >= MIN_TRAIN_ROWS:
+            self.build_index()
+        return self.codes is not None
+
+    def memory_usage(self):
+        """
+        Bytes held by the vectors and, for quantized indexes, by the codes and codebooks.
+        """
+        usage = {'vectors': self.size * (self.dimension or 0) * 4,
+                 'vectors_memory_mapped': isinstance(self.vectors, np.memmap)}
+        if self.codes is not None:
+            usage['codes'] = self.size * self.codes.shape[1]
+            usage['codebooks'] = self.quantizer.nbytes
+        return usage
+
+    def _adjust(self, scores, norms):
+        # Turn inner products into the metric's score. Higher is always better
+        if self.metric_type == 'COSINE':
+            scores /= np.where(norms > 0, norms, 1.0)
+        elif self.metric_type == 'L2':
+            scores *= 2.0
+            scores -= norms ** 2
+        return scores
+
+    def _scores(self, queries, start, stop, quantized=False):
+        """
+        Score a block of queries against rows [start, stop), from the codes if quantized.
+        """
+        if quantized:
+            scores = self.quantizer.inner_products(queries, self.codes[start:stop])
+        else:
+            scores = queries @ self.vectors[start:stop].T
+        return self._adjust(scores, self.norms[start:stop])
+
+    def _row_scores(self, queries, rows):
+        """
+        Exact scores of each query against its own (n_queries, k) candidate rows.
+        """
+        vectors = np.asarray(self.vectors[rows.ravel()]).reshape(*rows.shape, -1)
+        return self._adjust(np.einsum('qd,qkd->qk', queries, vectors), self.norms[rows])
+
+    def partition_ranges(self, partitions=None):
+        """
+        Row ranges to score, at most BLOCK_ROWS long.
+
+        :param partitions: Partition names to restrict to. None covers every row.
+        :return: List of (start, stop) tuples. Rows of one partition inserted together
+            form one contiguous range, so this is usually one range per partition.
+        """
+        n = self.size
+        if partitions is None:
+            runs = [(0, n)] if n else []
+        else:
+            wanted = [self.partition_code(partition) for partition in partitions]
+            selected = np.isin(self.partition_codes[:n], wanted)
+            # Boundaries of the runs of selected rows
+            edges = np.flatnonzero(np.diff(np.concatenate([[False], selected, [False]]).astype(np.int8)))
+            runs = list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+        return [(start, min(start + BLOCK_ROWS, stop)) for run_start, stop in runs
+                for start in range(run_start, stop, BLOCK_ROWS)]
+
+    def search(self, queries, limit, mask=None, partitions=None, refine_k=None):
+        """
+        Top-k search. Exact, or for quantized indexes a scan of the codes whose best
+        refine_k * limit rows are re-ranked with the exact vectors.
+
+        :param queries: (n_queries, dimension) float32 array.
+        :param limit: Number of neighbors to return per query.
+        :param mask: Optional boolean array over rows; rows that are False are never returned.
+        :param partitions: Only score the rows of these partitions. None searches every row.
+        :param refine_k: Shortlist size as a multiple of limit for quantized indexes.
+            Defaults to the index's refine_k parameter, or quantization.DEFAULT_REFINE_K.
+        :return: Tuple (rows, distances), each of shape (n_queries, k) with k <= limit.
+            Distances follow the Milvus convention for the metric (similarity for
+            COSINE/IP, squared distance for L2).
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        n_queries = len(queries)
+        if self.metric_type == 'COSINE':
+            q_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = queries / np.where(q_norms > 0, q_norms, 1.0)
+
+        with self.lock:
+            quantized = self._quantized()
+            ranges = self.partition_ranges(partitions)
+            if mask is None:
+                candidates = sum(stop - start for start, stop in ranges)
+            else:
+                candidates = sum(int(mask[start:stop].sum()) for start, stop in ranges)
+            k = min(limit, candidates)
+            rows = np.empty((n_queries, max(k, 0)), dtype=np.int64)
+            scores = np.empty((n_queries, max(k, 0)), dtype=np.float32)
+            if k <= 0:
+                return rows, scores
+            # Rows kept per query from the scan: the top k, or the shortlist to re-rank
+            shortlist = k
+            if quantized:
+                refine_k = refine_k or self.index_params.get('refine_k', DEFAULT_REFINE_K)
+                shortlist = min(candidates, max(k, math.ceil(k * refine_k)))
+
+            for q_start in range(0, n_queries, QUERY_BLOCK):
+                q = queries[q_start:q_start + QUERY_BLOCK]
+                best_rows = np.empty((len(q), 0), dtype=np.int64)
+                best_scores = np.empty((len(q), 0), dtype=np.float32)
+                for start, stop in ranges:
+                    block_scores = self._scores(q, start, stop, quantized)
+                    if mask is not None:
+                        block_scores[:, ~mask[start:stop]] = -np.inf
+                    block_k = min(shortlist, stop - start)
+                    top = np.argpartition(-block_scores, block_k - 1, axis=1)[:, :block_k]
+                    cand_rows = np.concatenate([best_rows, top + start], axis=1)
+                    cand_scores = np.concatenate(
+                        [best_scores, np.take_along_axis(block_scores, top, axis=1)], axis=1)
+                    if cand_rows.shape[1] > shortlist:
+                        keep = np.argpartition(-cand_scores, shortlist - 1, axis=1)[:, :shortlist]
+                        cand_rows = np.take_along_axis(cand_rows, keep, axis=1)
+                        cand_scores = np.take_along_axis(cand_scores, keep, axis=1)
+                    best_rows, best_scores = cand_rows, cand_scores
+
+                if quantized:
+                    # Re-rank the shortlist with the exact vectors and keep the top k
+                    best_scores = self._row_scores(q, best_rows)
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+                order = np.argsort(-best_scores, axis=1, kind='stable')
+                rows[q_start:q_start + len(q)] = np.take_along_axis(best_rows, order, axis=1)
+                scores[q_start:q_start + len(q)] = np.take_along_axis(best_scores, order, axis=1)
+
+        if self.metric_type == 'L2':
+            # Undo the sign flip: ||q - v||^2 = ||q||^2 - (2 q.v - ||v||^2)
+            scores = (np.einsum('ij,ij->i', queries, queries)[:, None] - scores).astype(np.float32)
+        return rows, scores
+
+    def save(self, path):
+        """
+        Write the collection to <path>/<name>.npz, its vectors to <path>/<name>.vectors.npy
+        and a JSON metadata sidecar.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            arrays = {
+                'keys': self.keys[:self.size],
+                'norms': self.norms[:self.size],
+                'partition_codes': self.partition_codes[:self.size],
+            }
+            if self.codes is not None:
+                arrays['index__codes'] = self.codes[:self.size]
+                for name, value in self.quantizer.state().items():
+                    arrays[f'index__{name}'] = value
+            for field, column in self.fields.items():
+                values = np.asarray(column[:self.size].tolist())
+                arrays[f'field__{field}'] = values.astype(str) if values.dtype == object else values
+            meta = {
+                'dimension': self.dimension,
+                'metric_type': self.metric_type,
+                'primary_field': self.primary_field,
+                'vector_field': self.vector_field,
+                'fields': list(self.fields.keys()),
+                'partitions': self.partitions,
+                'description': self.description,
+                'index_type': self.index_type,
+                'index_params': self.index_params,
+            }
+            # Separate from the npz so load() can memory-map it
+            tmp = os.path.join(path, f'{self.name}.vectors.tmp.npy')
+            np.save(tmp, self.vectors[:self.size])
+            os.replace(tmp, os.path.join(path, f'{self.name}.vectors.npy'))
+            tmp = os.path.join(path, f'{self.name}.tmp.npz')
+            np.savez(tmp, **arrays)
+            os.replace(tmp, os.path.join(path, f'{self.name}.npz'))
+            with open(os.path.join(path, f'{self.name}.json'), 'w') as fh:
+                json.dump(meta, fh)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path, name):
+        """
+        Read a collection written by save(). Returns None if it does not exist.
+
+        The vectors of a collection with a quantized index stay memory-mapped: searches
+        only read the rows they re-rank.
+        """
+        meta_path = os.path.join(path, f'{name}.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        index_type = meta.get('index_type', 'FLAT')
+        collection = cls(name, meta['dimension'], meta['metric_type'], meta['primary_field'], meta['vector_field'],
+                         meta.get('description', ''), index_type, meta.get('index_params'))
+        collection.partitions = meta.get('partitions', [DEFAULT_PARTITION])
+        with np.load(os.path.join(path, f'{name}.npz')) as arrays:
+            keys = arrays['keys']
+            n = len(keys)
+            if 'vectors' in arrays:
+                # Written before the vectors moved to their own file
+                vectors = arrays['vectors']
+            else:
+                vectors = np.load(os.path.join(path, f'{name}.vectors.npy'),
+                                  mmap_mode='r' if index_type in QUANTIZED_INDEX_TYPES else None)
+            norms = arrays['norms'] if 'norms' in arrays else np.linalg.norm(vectors, axis=1).astype(np.float32)
+            scalars = {field: arrays[f'field__{field}'] for field in meta['fields']}
+            codes = arrays['partition_codes'] if 'partition_codes' in arrays else np.zeros(n, np.int32)
+            if 'index__codes' in arrays:
+                collection.codes = arrays['index__codes']
+                collection.quantizer = load_quantizer(
+                    index_type, collection.index_params,
+                    {key[len('index__'):]: arrays[key] for key in arrays.files if key.startswith('index__')})
+        if n:
+            collection.keys = keys
+            collection.vectors = vectors
+            collection.norms = norms
+            collection.partition_codes = codes.astype(np.int32)
+            collection.fields = {field: np.asarray(values, dtype=object) for field, values in scalars.items()}
+            collection.row_of = dict(zip(keys.tolist(), range(n)))
+            collection.size = n
+        collection.dirty = False
+        return collection
+
+
+class LocalMilvusClient:
+    """
+    Drop-in replacement for pymilvus.MilvusClient backed by LocalCollection.
+
+    Only the subset of the MilvusClient API used by this repository is provided.
+    Returned vectors are float32 NumPy arrays rather than Python lists.
+    """
+
+    def __init__(self, path=None, **kwargs):
+        """
+        :param path: Directory collections are persisted to. None keeps everything in memory.
+        """
+        self.path = path
+
+    def _collection(self, collection_name, create=False, dimension=None):
+        key = (self.path, collection_name)
+        with _registry_lock:
+            collection = _registry.get(key)
+            if collection is None and self.path is not None:
+                collection = LocalCollection.load(self.path, collection_name)
+            if collection is None and create:
+                collection = LocalCollection(collection_name, dimension)
+            if collection is None:
+                raise KeyError(f'Collection {collection_name} does not exist')
+            _registry[key] = collection
+        return collection
+
+    def has_collection(self, collection_name, **kwargs):
+        try:
+            self._collection(collection_name)
+        except KeyError:
+            return False
+        return True
+
+    def create_collection(self, collection_name, dimension=None, primary_field_name='primary_key',
+                          vector_field_name='vector', metric_type='COSINE', description='', index_type='FLAT',
+                          index_params=None, **kwargs):
+        """
+        :param index_type: 'IVF_SQ8' or 'IVF_PQ' store quantized codes (see quantization.py).
+            Every other index type is searched exactly.
+        :param index_params: Parameters of the index: m and nbits for IVF_PQ, and refine_k
+            (shortlist size as a multiple of the limit) for both quantized types.
+        """
+        collection = LocalCollection(collection_name, dimension, metric_type, primary_field_name,
+                                     vector_field_name, description, index_type, index_params)
+        # Written on the next flush even while empty, so the schema persists
+        collection.dirty = True
+        with _registry_lock:
+            _registry[(self.path, collection_name)] = collection
+
+    def describe_collection(self, collection_name, **kwargs):
+        """
+        Subset of MilvusClient.describe_collection: name, description, metric and the
+        fields with the vector dimension under params['dim'].
+        """
+        collection = self._collection(collection_name)
+        fields = [{'name': collection.primary_field, 'params': {}, 'is_primary': True},
+                  {'name': collection.vector_field, 'params': {'dim': collection.dimension}}]
+        fields += [{'name': field, 'params': {}} for field in collection.fields]
+        return {'collection_name': collection_name, 'description': collection.description,
+                'metric_type': collection.metric_type, 'fields': fields}
+
+    def create_partition(self, collection_name, partition_name, **kwargs):
+        collection = self._collection(collection_name)
+        with collection.lock:
+            collection.partition_code(partition_name, create=True)
+            collection.dirty = True
+
+    def has_partition(self, collection_name, partition_name, **kwargs):
+        return partition_name in self._collection(collection_name).partitions
+
+    def list_partitions(self, collection_name, **kwargs):
+        return list(self._collection(collection_name).partitions)
+
+    def drop_collection(self, collection_name, **kwargs):
+        with _registry_lock:
+            _registry.pop((self.path, collection_name), None)
+        if self.path is not None:
+            for ext in ('npz', 'vectors.npy', 'json'):
+                file = os.path.join(self.path, f'{collection_name}.{ext}')
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def insert(self, collection_name, data, partition_name=None, **kwargs):
+        if isinstance(data, dict):
+            data = [data]
+        collection = self._collection(collection_name, create=True)
+        ids = collection.insert(data, partition_name)
+        return {'insert_count': len(ids), 'ids': ids}
+
+    def upsert(self, collection_name, data, partition_name=None, **kwargs):
+        """
+        Same as insert: a key that is already stored has its row replaced.
+        """
+        result = self.insert(collection_name, data, partition_name)
+        return {'upsert_count': result['insert_count'], 'ids': result['ids']}
+
+    def insert_columns(self, collection_name, keys, vectors, scalars=None, partition_name=None):
+        """
+        Column-oriented insert that skips building row dictionaries.
+        Not part of the MilvusClient API; see LocalCollection.insert_columns.
+        """
+        collection = self._collection(collection_name, create=True)
+        ids = collection.insert_columns(keys, vectors, scalars, partition_name)
+        return {'insert_count': len(ids), 'ids': ids}
+
+    def get(self, collection_name, ids, output_fields=None, **kwargs):
+        if not isinstance(ids, (list, tuple, np.ndarray)):
+            ids = [ids]
+        collection = self._collection(collection_name)
+        fields = output_fields or [collection.primary_field, collection.vector_field,
+                                   *collection.fields.keys()]
+        if collection.primary_field not in fields:
+            fields = [collection.primary_field, *fields]
+        with collection.lock:
+            return [collection.entity(row, fields) for row in collection.rows_for(ids)]
+
+    def query(self, collection_name, filter='', output_fields=None, ids=None, limit=None, offset=0,
+              partition_names=None, **kwargs):
+        collection = self._collection(collection_name)
+        with collection.lock:
+            if ids is not None:
+                rows = collection.rows_for(ids if isinstance(ids, (list, tuple, np.ndarray)) else [ids])
+            else:
+                mask = collection.filter_mask(filter)
+                rows = np.arange(collection.size) if mask is None else np.flatnonzero(mask)
+            if partition_names is not None:
+                codes = [collection.partition_code(partition) for partition in partition_names]
+                rows = rows[np.isin(collection.partition_codes[rows], codes)]
+            if output_fields == ['count(*)']:
+                return [{'count(*)': int(len(rows))}]
+            rows = rows[offset:None if limit is None or limit < 0 else offset + limit]
+            fields = output_fields or [collection.primary_field, *collection.fields.keys()]
+            if collection.primary_field not in fields:
+                fields = [collection.primary_field, *fields]
+            return [collection.entity(row, fields) for row in rows.tolist()]
+
+    def query_iterator(self, collection_name, batch_size=1000, limit=-1, filter='', output_fields=None,
+                       partition_names=None, **kwargs):
+        return _QueryIterator(self.query(collection_name, filter=filter, output_fields=output_fields,
+                                         limit=limit, partition_names=partition_names), batch_size)
+
+    def search(self, collection_name, data, filter='', limit=10, output_fields=None,
+               search_params=None, partition_names=None, **kwargs):
+        """
+        Top-limit search. search_params['params'] may hold refine_k (quantized indexes)
+        and the Milvus range search bounds radius and range_filter: for COSINE and IP
+        only matches with radius < distance <= range_filter are returned, for L2
+        only matches with range_filter <= distance < radius.
+        """
+        collection = self._collection(collection_name)
+        with collection.lock:
+            mask = collection.filter_mask(filter)
+        params = (search_params or {}).get('params') or {}
+        rows, distances = collection.search(np.asarray(data, dtype=np.float32), limit, mask, partition_names,
+                                            params.get('refine_k'))
+        if 'radius' in params or 'range_filter' in params:
+            if collection.metric_type == 'L2':
+                low, high = params.get('range_filter', -np.inf), params.get('radius', np.inf)
+                in_range = (distances >= low) & (distances < high)
+            else:
+                low, high = params.get('radius', -np.inf), params.get('range_filter', np.inf)
+                in_range = (distances > low) & (distances <= high)
+        else:
+            in_range = np.ones(distances.shape, dtype=bool)
+        output_fields = output_fields or []
+        results = []
+        with collection.lock:
+            for q_rows, q_dist, q_in_range in zip(rows, distances, in_range):
+                hits = []
+                for row, dist in zip(q_rows[q_in_range].tolist(), q_dist[q_in_range].tolist()):
+                    hits.append({
+                        'id': int(collection.keys[row]),
+                        'distance': dist,
+                        'entity': collection.entity(row, output_fields),
+                    })
+                results.append(hits)
+        return results
+
+    def flush(self, collection_name, **kwargs):
+        if self.path is not None:
+            collection = self._collection(collection_name)
+            if collection.dirty:
+                collection.save(self.path)
+
+    def close(self):
+        pass
+
+
+class _QueryIterator:
+    """
+    Mimics the iterator returned by MilvusClient.query_iterator.
+    """
+
+    def __init__(self, rows, batch_size):
+        self._rows = rows
+        self._batch_size = batch_size
+        self._offset = 0
+
+    def next(self):
+        batch = self._rows[self._offset:self._offset + self._batch_size]
+        self._offset += len(batch)
+        return batch
+
+    def close(self):
+        self._rows = []
+
+
+@atexit.register
+def _flush_all():
+    for (path, _), collection in list(_registry.items()):
+        if path is not None and collection.dirty:
+            collection.save(path)
@@ -0,0 +1,190 @@
+"""
+Binary cache of cell/gene CSV matrices.
+
+Each data/ex_N_*.csv is parsed once and written to <MATRIX_CACHE_PATH>/<file>/:
+    values.npy  float32 cells x genes, opened as a read-only memory map
+    cell_ids.npy  the first CSV column (int64 when numeric)
+    genes.npy  the gene names from the CSV header
+    meta.json  size, mtime and sha256 of the source file
+Later readers open the memory map instead of re-parsing the text. The cache is
+rebuilt when the source file's size or contents change.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from global_variables import MATRIX_CACHE_PATH
+
+
+CACHE_VERSION = 1
+
+
+class CachedMatrix:
+    """
+    A cell/gene matrix backed by the binary cache.
+
+    :ivar values: (n_cells, n_genes) read-only float32 memmap.
+    :ivar cell_ids: Array of cell ids, one per row.
+    :ivar genes: Array of gene names, one per column.
+    :ivar source: Path of the CSV the cache was built from.
+    """
+
+    def __init__(self, values, cell_ids, genes, source):
+        self.values = values
+        self.cell_ids = cell_ids
+        self.genes = genes
+        self.source = source
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def iter_chunks(self, rows=10000):
+        """
+        Yield (cell_ids, values) slices of rows cells. The values are memmap views.
+        """
+        for start in range(0, len(self.values), rows):
+            yield self.cell_ids[start:start + rows], self.values[start:start + rows]
+
+
+def file_sha256(path, block_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_dir(path, id_column=True, cache_path=None):
+    """
+    Directory the cache for a source file lives in.
+    """
+    name = os.path.basename(path) + ('' if id_column else '.noid')
+    return os.path.join(cache_path or MATRIX_CACHE_PATH, name)
+
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(directory, meta):
+    with open(os.path.join(directory, 'meta.json'), 'w') as fh:
+        json.dump(meta, fh)
+
+
+def is_cache_valid(path, id_column=True, cache_path=None):
+    """
+    Check whether the cache for path is up to date.
+
+    A matching size and mtime is trusted. If only the mtime moved (e.g. the file was
+    copied or touched) the contents are hashed and the cache is kept if they match.
+    """
+    directory = cache_dir(path, id_column, cache_path)
+    meta = _read_meta(directory)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return False
+    stat = os.stat(path)
+    if meta['size'] != stat.st_size:
+        return False
+    if meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    if meta['sha256'] != file_sha256(path):
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+    _write_meta(directory, meta)
+    return True
+
+
+def build_cache(path, id_column=True, cache_path=None, chunk_rows=10000):
+    """
+    Parse a CSV once into the binary cache, chunk_rows cells at a time so memory
+    stays bounded regardless of the matrix size.
+
+    :param path: Path to the cell/gene CSV.
+    :param id_column: True if the first column holds cell ids rather than expression.
+    :param cache_path: Root cache directory. Defaults to global_variables.MATRIX_CACHE_PATH.
+    :param chunk_rows: Cells parsed at a time.
+    :return: The cache directory.
+    """
+    directory = cache_dir(path, id_column, cache_path)
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    stat = os.stat(path)
+
+    with open(path, 'rb') as fh:
+        n_rows = sum(1 for _ in fh) - 1
+    header = pd.read_csv(path, delimiter=',', nrows=0).columns
+    genes = np.asarray(header[1:] if id_column else header, dtype=str)
+
+    values = np.lib.format.open_memmap(os.path.join(tmp, 'values.npy'), mode='w+',
+                                       dtype=np.float32, shape=(n_rows, len(genes)))
+    cell_ids = []
+    start = 0
+    for chunk in pd.read_csv(path, delimiter=',', chunksize=chunk_rows):
+        if id_column:
+            cell_ids.append(chunk.iloc[:, 0].to_numpy())
+            chunk = chunk.iloc[:, 1:]
+        values[start:start + len(chunk)] = chunk.to_numpy(dtype=np.float32)
+        start += len(chunk)
+    values.flush()
+    del values
+    if start != n_rows:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise ValueError(f'{path} has {start} parsable rows but {n_rows} lines; '
+                         f'multi-line or blank CSV records are not supported')
+
+    if id_column:
+        cell_ids = np.concatenate(cell_ids) if cell_ids else np.empty(0, dtype=np.int64)
+        cell_ids = cell_ids.astype(np.int64) if cell_ids.dtype.kind in 'iu' else cell_ids.astype(str)
+    else:
+        cell_ids = np.arange(n_rows, dtype=np.int64)
+    np.save(os.path.join(tmp, 'cell_ids.npy'), cell_ids)
+    np.save(os.path.join(tmp, 'genes.npy'), genes)
+    _write_meta(tmp, {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_sha256(path),
+        'shape': [n_rows, len(genes)],
+    })
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return directory
+
+
+def load_matrix(path, id_column=True, cache_path=None):
+    """
+    Open a cell/gene CSV through the binary cache, building or rebuilding the cache first
+    if it is missing or stale.
+
+    :param path: Path to the cell/gene CSV.
+    :param id_column: True if the first column holds cell ids rather than expression.
+    :param cache_path: Root cache directory. Defaults to global_variables.MATRIX_CACHE_PATH.
+    :return: A CachedMatrix whose values are a read-only memory map.
+    """
+    if is_cache_valid(path, id_column, cache_path):
+        metrics.count('matrix_cache.hits')
+    else:
+        metrics.count('matrix_cache.misses')
+        print(f'Building binary cache for {path}...')
+        with metrics.span('csv.load', file=os.path.basename(path), bytes=os.path.getsize(path)):
+            build_cache(path, id_column, cache_path)
+    directory = cache_dir(path, id_column, cache_path)
+    with metrics.span('matrix.open', file=os.path.basename(path)) as span:
+        values = np.load(os.path.join(directory, 'values.npy'), mmap_mode='r')
+        cell_ids = np.load(os.path.join(directory, 'cell_ids.npy'))
+        genes = np.load(os.path.join(directory, 'genes.npy'))
+        span.set(rows=values.shape[0])
+    return CachedMatrix(values, cell_ids, genes, path)
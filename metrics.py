@@ -0,0 +1,244 @@
+"""
+Timing spans and counters for the ingest and query paths.
+
+Instrumented code wraps each phase (CSV load, PCA fit/transform, batch
+building, every insert/get/search request, cluster aggregation) in a named
+span and bumps counters for rows, bytes and cache hits:
+
+    with metrics.span('rpc.search', queries=len(batch)) as s:
+        res = client.search(...)
+        s.set(rows=sum(len(r) for r in res))
+
+Metrics are off by default and a disabled span is a shared no-op object, so the
+instrumentation costs one function call. Enable them with configure() or the
+SCMILVUS_METRICS environment variable:
+    trace.jsonl  every finished span is appended as one JSON line, and the
+                 aggregated snapshot is appended at exit
+    metrics.prom a Prometheus text-format snapshot is written at exit
+Any other value (e.g. 1) aggregates in memory only, for snapshot().
+"""
+import atexit
+import json
+import re
+import threading
+import time
+
+from global_variables import METRICS_PATH
+
+
+# Span attributes that measure work done, summed per span name in the snapshot.
+# Others (limit, method, file, ...) only appear in the trace
+SUMMED_ATTRIBUTES = ('rows', 'bytes', 'ids', 'queries', 'frontier', 'nnz', 'batches')
+
+_enabled = False
+_trace = None
+_snapshot_path = None
+_lock = threading.Lock()
+_local = threading.local()
+
+# span name -> [count, total seconds, max seconds]
+_spans = {}
+# (span name, attribute) -> sum of the attribute over every span, for SUMMED_ATTRIBUTES
+_span_totals = {}
+# counter name -> value
+_counters = {}
+
+
+class _NullSpan:
+    """
+    Returned by span() while metrics are disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """
+        Attach attributes known only once the work is done (rows returned, bytes sent).
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                stats = _spans[self.name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            for key in SUMMED_ATTRIBUTES:
+                if key in self.attrs:
+                    _span_totals[(self.name, key)] = _span_totals.get((self.name, key), 0) + self.attrs[key]
+            if _trace is not None:
+                event = {'ts': time.time(), 'span': self.name, 'seconds': seconds,
+                         'thread': threading.current_thread().name, 'parent': self.parent, **self.attrs}
+                if exc_type is not None:
+                    event['error'] = exc_type.__name__
+                _trace.write(json.dumps(event, default=str) + '\n')
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def span(name, **attrs):
+    """
+    Time a block of code under name.
+
+    :param name: Dotted phase name, e.g. 'pca.fit' or 'rpc.insert'.
+    :param attrs: Attributes recorded with the span. The ones in SUMMED_ATTRIBUTES
+        (rows, bytes, ...) are also summed per span name in the snapshot.
+    :return: A context manager whose value has a set(**attrs) method.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, attrs)
+
+
+def count(name, value=1):
+    """
+    Add value to the counter name (e.g. 'neighbor_cache.hits').
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def configure(path=None, enable=True):
+    """
+    Turn metrics on or off.
+
+    :param path: A .jsonl file to append the trace to, a .prom file to write the
+        Prometheus snapshot to at exit, or None to aggregate in memory only.
+    :param enable: False turns metrics off and closes the trace file.
+    """
+    global _enabled, _trace, _snapshot_path
+    with _lock:
+        if _trace is not None:
+            _trace.close()
+        _trace = None
+        _snapshot_path = None
+        _enabled = enable
+        if enable and path:
+            if path.endswith('.prom'):
+                _snapshot_path = path
+            else:
+                _trace = open(path, 'a', buffering=1 << 16)
+
+
+def reset():
+    """
+    Clear every recorded span and counter.
+    """
+    with _lock:
+        _spans.clear()
+        _span_totals.clear()
+        _counters.clear()
+
+
+def snapshot():
+    """
+    Aggregated metrics recorded so far.
+
+    :return: A dictionary with 'spans' (name -> count, seconds, max_seconds and the
+        summed SUMMED_ATTRIBUTES), 'counters', and 'hit_rates' for every counter
+        pair named <prefix>.hits / <prefix>.misses.
+    """
+    with _lock:
+        spans = {name: {'count': count_, 'seconds': total, 'max_seconds': peak}
+                 for name, (count_, total, peak) in _spans.items()}
+        for (name, key), value in _span_totals.items():
+            spans[name][key] = value
+        counters = dict(_counters)
+    hit_rates = {}
+    for name, hits in counters.items():
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            total = hits + counters.get(f'{prefix}.misses', 0)
+            hit_rates[prefix] = hits / total if total else 0.0
+    return {'spans': spans, 'counters': counters, 'hit_rates': hit_rates}
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def prometheus_text():
+    """
+    The current snapshot in the Prometheus text exposition format.
+    """
+    data = snapshot()
+    lines = ['# TYPE scmilvus_span_seconds summary']
+    for name, stats in sorted(data['spans'].items()):
+        lines.append(f'scmilvus_span_seconds_count{{span="{name}"}} {stats["count"]}')
+        lines.append(f'scmilvus_span_seconds_sum{{span="{name}"}} {stats["seconds"]:.9g}')
+    lines.append('# TYPE scmilvus_span_seconds_max gauge')
+    for name, stats in sorted(data['spans'].items()):
+        lines.append(f'scmilvus_span_seconds_max{{span="{name}"}} {stats["max_seconds"]:.9g}')
+    lines.append('# TYPE scmilvus_span_attribute_total counter')
+    for name, stats in sorted(data['spans'].items()):
+        for key, value in sorted(stats.items()):
+            if key not in ('count', 'seconds', 'max_seconds'):
+                lines.append(f'scmilvus_span_attribute_total{{span="{name}",attribute="{key}"}} {value}')
+    for name, value in sorted(data['counters'].items()):
+        metric = f'scmilvus_{_metric_name(name)}_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    lines.append('# TYPE scmilvus_hit_rate gauge')
+    for name, rate in sorted(data['hit_rates'].items()):
+        lines.append(f'scmilvus_hit_rate{{cache="{name}"}} {rate:.6g}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(path):
+    """
+    Write the current snapshot to path: Prometheus text for .prom, JSON otherwise.
+    """
+    with open(path, 'w') as fh:
+        fh.write(prometheus_text() if path.endswith('.prom') else json.dumps(snapshot(), indent=2))
+
+
+@atexit.register
+def _finish():
+    if not _enabled:
+        return
+    if _snapshot_path is not None:
+        write_snapshot(_snapshot_path)
+    if _trace is not None:
+        summary = snapshot()
+        with _lock:
+            _trace.write(json.dumps({'ts': time.time(), 'snapshot': summary}, default=str) + '\n')
+            _trace.close()
+
+
+if METRICS_PATH:
+    configure(None if METRICS_PATH in ('1', 'true') else METRICS_PATH)
@@ -0,0 +1,193 @@
+"""
+Two-tier cache of nearest neighbor search results.
+
+Results are keyed by (collection, cell_id, metric) and remember the limit they
+were searched with, so a request for a smaller limit is served by truncating a
+cached larger result. The first tier is an in-memory LRU bounded by the total
+number of cached neighbors; the second is a SQLite file that survives across
+runs. Every collection has a generation number in the SQLite file: re-ingesting
+the collection bumps it, which invalidates its results in every process.
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from global_variables import NEIGHBOR_CACHE_PATH
+
+
+class NeighborCache:
+    """
+    In-memory LRU in front of an on-disk SQLite store of neighbor lists.
+    """
+
+    def __init__(self, path=NEIGHBOR_CACHE_PATH, max_neighbors=20_000_000):
+        """
+        :param path: SQLite file for the persistent tier. None keeps the cache in memory only.
+        :param max_neighbors: Total (id, distance) pairs the in-memory tier may hold.
+        """
+        self.path = path
+        self.max_neighbors = max_neighbors
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lru_size = 0
+        self._generations = {}
+        self._lock = threading.RLock()
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS neighbors (
+                collection TEXT, cell_id INTEGER, metric TEXT, generation INTEGER,
+                search_limit INTEGER, ids BLOB, distances BLOB,
+                PRIMARY KEY (collection, cell_id, metric));
+            CREATE TABLE IF NOT EXISTS generations (collection TEXT PRIMARY KEY, generation INTEGER);
+        ''')
+        self._db.commit()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _generation(self, collection):
+        row = self._db.execute('SELECT generation FROM generations WHERE collection = ?',
+                               (collection,)).fetchone()
+        return row[0] if row else 0
+
+    def _remember(self, key, entry):
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._lru_size -= len(old[2])
+        self._lru[key] = entry
+        self._lru_size += len(entry[2])
+        while self._lru_size > self.max_neighbors and self._lru:
+            _, evicted = self._lru.popitem(last=False)
+            self._lru_size -= len(evicted[2])
+
+    @staticmethod
+    def _serves(entry, generation, limit):
+        entry_generation, entry_limit, ids, _ = entry
+        # A result shorter than its limit was the whole collection, so it serves any limit
+        return entry_generation == generation and (entry_limit >= limit or len(ids) < entry_limit)
+
+    def get_many(self, collection, cell_ids, limit, metric='COSINE'):
+        """
+        Look up cached neighbors for several cells.
+
+        :param collection: Collection name.
+        :param cell_ids: Primary keys of the query cells.
+        :param limit: Number of neighbors wanted per cell.
+        :param metric: Metric the results were searched with.
+        :return: A tuple (found, missing). found is a dictionary of cell id -> list of
+            (vector_id, distance) tuples; missing lists the ids that need a search.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            # Read once per call so re-ingests from other processes are noticed
+            generation = self._generation(collection)
+            self._generations[collection] = generation
+            for cell_id in cell_ids:
+                cell_id = int(cell_id)
+                key = (collection, cell_id, metric)
+                entry = self._lru.get(key)
+                if entry is not None and self._serves(entry, generation, limit):
+                    self._lru.move_to_end(key)
+                else:
+                    entry = self._load(key)
+                    if entry is not None and self._serves(entry, generation, limit):
+                        self._remember(key, entry)
+                    else:
+                        entry = None
+                if entry is None:
+                    missing.append(cell_id)
+                    continue
+                _, _, ids, distances = entry
+                found[cell_id] = list(zip(ids[:limit].tolist(), distances[:limit].tolist()))
+            self.hits += len(found)
+            self.misses += len(missing)
+        metrics.count('neighbor_cache.hits', len(found))
+        metrics.count('neighbor_cache.misses', len(missing))
+        return found, missing
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        row = self._db.execute(
+            'SELECT generation, search_limit, ids, distances FROM neighbors '
+            'WHERE collection = ? AND cell_id = ? AND metric = ?', key).fetchone()
+        if row is None:
+            return None
+        generation, limit, ids, distances = row
+        return generation, limit, np.frombuffer(ids, dtype=np.int64), np.frombuffer(distances, dtype=np.float32)
+
+    def put_many(self, collection, results, limit, metric='COSINE'):
+        """
+        Store search results. An existing entry searched with a larger limit is kept.
+
+        :param collection: Collection name.
+        :param results: Dictionary of cell id -> list of (vector_id, distance) tuples,
+            as returned by find_similarities.
+        :param limit: The limit the results were searched with.
+        :param metric: Metric the results were searched with.
+        """
+        rows = []
+        with self._lock:
+            generation = self._generations.get(collection)
+            if generation is None:
+                generation = self._generations[collection] = self._generation(collection)
+            for cell_id, matches in results.items():
+                cell_id = int(cell_id)
+                key = (collection, cell_id, metric)
+                current = self._lru.get(key)
+                if current is not None and self._serves(current, generation, limit) and current[1] >= limit:
+                    continue
+                ids = np.fromiter((m[0] for m in matches), dtype=np.int64, count=len(matches))
+                distances = np.fromiter((m[1] for m in matches), dtype=np.float32, count=len(matches))
+                self._remember(key, (generation, limit, ids, distances))
+                rows.append((collection, cell_id, metric, generation, limit, ids.tobytes(), distances.tobytes(),
+                             limit))
+            if rows and self.path is not None:
+                self._db.executemany(
+                    'INSERT INTO neighbors VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (collection, cell_id, metric) DO UPDATE SET '
+                    'generation = excluded.generation, search_limit = excluded.search_limit, '
+                    'ids = excluded.ids, distances = excluded.distances '
+                    'WHERE neighbors.generation != excluded.generation OR neighbors.search_limit < ?',
+                    rows)
+                self._db.commit()
+
+    def invalidate(self, collection):
+        """
+        Drop every cached result for a collection, in this process and on disk.
+        Call this whenever the collection's data changes.
+        """
+        with self._lock:
+            generation = self._generation(collection) + 1
+            self._db.execute('INSERT INTO generations VALUES (?, ?) ON CONFLICT (collection) '
+                             'DO UPDATE SET generation = excluded.generation', (collection, generation))
+            self._db.execute('DELETE FROM neighbors WHERE collection = ?', (collection,))
+            self._db.commit()
+            self._generations[collection] = generation
+            for key in [key for key in self._lru if key[0] == collection]:
+                self._lru_size -= len(self._lru.pop(key)[2])
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_neighbor_cache():
+    """
+    The process-wide NeighborCache, created on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = NeighborCache()
+        return _cache
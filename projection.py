@@ -0,0 +1,294 @@
+"""
+Fitting, storage and application of the PCA projection used to embed cells.
+
+The projection fitted at ingest is saved per collection and source file under
+MODEL_PATH, together with the gene order it was fitted on, so new cells can be
+projected into an existing collection's embedding space without refitting.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.decomposition import IncrementalPCA
+
+from global_variables import MODEL_PATH
+
+
+class Projection:
+    """
+    A fitted linear projection: x -> (x / scale - mean) @ components.T.
+
+    transform() never centers X explicitly, so sparse input stays sparse, and the
+    scaling is folded into the components, so projecting is one matrix multiply.
+
+    :ivar genes: Gene names in the column order the projection was fitted on, or None.
+    :ivar scale_: Per-gene divisor applied before centering (a StandardScaler's scale_), or None.
+    """
+
+    def __init__(self, mean, components, explained_variance=None, scale=None, genes=None):
+        self.mean_ = np.asarray(mean, dtype=np.float32)
+        self.components_ = np.asarray(components, dtype=np.float32)
+        self.explained_variance_ = explained_variance
+        self.scale_ = None if scale is None else np.asarray(scale, dtype=np.float32)
+        self.genes = None if genes is None else np.asarray(genes, dtype=str)
+        self._scaled_components = None
+
+    @classmethod
+    def from_estimator(cls, estimator, scaler=None, genes=None):
+        """
+        Wrap a fitted sklearn PCA or IncrementalPCA (without whitening).
+
+        :param scaler: The fitted StandardScaler the PCA input went through, if any.
+        :param genes: Gene names of the columns the estimator was fitted on.
+        """
+        mean = np.asarray(estimator.mean_, dtype=np.float64)
+        scale = None
+        if scaler is not None:
+            scale = scaler.scale_ if scaler.with_std else np.ones_like(mean)
+            if scaler.with_mean:
+                # (x - mu) / sigma - mean == x / sigma - (mu / sigma + mean)
+                mean = mean + scaler.mean_ / scale
+        return cls(mean, estimator.components_, estimator.explained_variance_, scale, genes)
+
+    @property
+    def n_components(self):
+        return self.components_.shape[0]
+
+    @property
+    def scaled_components(self):
+        """
+        components / scale, the matrix raw expression rows are multiplied with.
+        """
+        if self._scaled_components is None:
+            self._scaled_components = (self.components_ if self.scale_ is None
+                                       else self.components_ / self.scale_)
+        return self._scaled_components
+
+    def save(self, path):
+        """
+        Write the projection to an .npz file.
+        """
+        arrays = {'mean': self.mean_, 'components': self.components_}
+        for key, value in (('explained_variance', self.explained_variance_), ('scale', self.scale_),
+                           ('genes', self.genes)):
+            if value is not None:
+                arrays[key] = np.asarray(value)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a projection written by save().
+        """
+        with np.load(path) as arrays:
+            optional = {key: arrays[key] if key in arrays else None
+                        for key in ('explained_variance', 'scale', 'genes')}
+            return cls(arrays['mean'], arrays['components'], optional['explained_variance'],
+                       optional['scale'], optional['genes'])
+
+    def transform(self, values):
+        """
+        :param values: (n_cells, n_genes) dense array or scipy.sparse matrix, with the
+            genes in the order the projection was fitted on.
+        :return: (n_cells, n_components) float32 embedding.
+        """
+        projected = np.asarray(values @ self.scaled_components.T, dtype=np.float32)
+        projected -= self.mean_ @ self.components_.T
+        return projected
+
+    def transform_genes(self, values, genes):
+        """
+        Project rows whose columns are in some other gene order.
+
+        Columns are matched to the fitted genes by name. Genes the projection was
+        fitted on but the input lacks are treated as sitting at their mean, so they
+        add nothing; genes the projection does not know are ignored.
+
+        :param values: (n_cells, len(genes)) dense array or scipy.sparse matrix.
+        :param genes: Gene names of the columns of values.
+        :return: A tuple (embedding, n_missing): the (n_cells, n_components) float32
+            embedding and the number of fitted genes missing from the input.
+        """
+        if self.genes is None:
+            raise ValueError('This projection was saved without its gene order; '
+                             'only transform() with identically ordered columns is possible')
+        columns = pd.Index(np.asarray(genes, dtype=str)).get_indexer(self.genes)
+        present = columns >= 0
+        if present.all() and len(genes) == len(self.genes) and (columns == np.arange(len(columns))).all():
+            return self.transform(values), 0
+        if sp.issparse(values):
+            values = sp.csr_matrix(values)[:, columns[present]]
+        else:
+            values = np.asarray(values)[:, columns[present]]
+        projected = np.asarray(values @ self.scaled_components[:, present].T, dtype=np.float32)
+        projected -= self.mean_[present] @ self.components_[:, present].T
+        return projected, int((~present).sum())
+
+
+def model_path(collection_name, file_name):
+    return os.path.join(MODEL_PATH, collection_name, f'{file_name}.npz')
+
+
+def save_model(collection_name, file_name, projection):
+    """
+    Store the projection used to embed file_name's cells into a collection.
+    """
+    path = model_path(collection_name, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp.npz'
+    projection.save(tmp)
+    os.replace(tmp, path)
+
+
+def list_models(collection_name):
+    """
+    Source files of a collection that have a stored projection.
+    """
+    directory = os.path.join(MODEL_PATH, collection_name)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len('.npz')] for name in os.listdir(directory)
+                  if name.endswith('.npz') and not name.endswith('.tmp.npz'))
+
+
+def model_file_name(collection_name, file_name=None):
+    """
+    The source file whose projection load_model uses: file_name, or else the only one
+    the collection has.
+
+    :raises ValueError: If file_name is not given and the collection does not have exactly one model.
+    """
+    if file_name is None:
+        models = list_models(collection_name)
+        if len(models) != 1:
+            raise ValueError(f'Collection {collection_name} has {len(models)} stored projections '
+                             f'({", ".join(models) or "none"}); pass file_name to choose one')
+        file_name = models[0]
+    return file_name
+
+
+def load_model(collection_name, file_name=None):
+    """
+    Load the projection of a collection.
+
+    Every source file is embedded with its own PCA, so a collection ingested from
+    several files has several models; file_name picks one of them.
+
+    :param collection_name: The collection.
+    :param file_name: Source file whose projection to load. May be omitted when the
+        collection has a single model.
+    :return: A Projection.
+    :raises ValueError: If there is no model, or several and file_name is not given.
+    """
+    file_name = model_file_name(collection_name, file_name)
+    path = model_path(collection_name, file_name)
+    if not os.path.exists(path):
+        raise ValueError(f'No stored projection for {file_name} in collection {collection_name}')
+    return Projection.load(path)
+
+
+def fit_incremental_pca(chunks, n_components=50):
+    """
+    Fit a PCA one chunk at a time so the full matrix never has to be in memory.
+
+    Chunks smaller than n_components are held back and merged with the next one,
+    since IncrementalPCA needs at least n_components rows in its first batch.
+
+    :param chunks: Iterable of (cell_ids, values) tuples, values being a 2D float array.
+    :param n_components: Number of principal components to keep.
+    :return: The fitted IncrementalPCA.
+    """
+    ipca = IncrementalPCA(n_components=n_components)
+    pending = []
+    pending_rows = 0
+    fitted = False
+    for _, values in chunks:
+        pending.append(values)
+        pending_rows += len(values)
+        if pending_rows < n_components and not fitted:
+            continue
+        ipca.partial_fit(np.vstack(pending) if len(pending) > 1 else pending[0])
+        fitted = True
+        pending = []
+        pending_rows = 0
+    if pending:
+        if not fitted and pending_rows < n_components:
+            raise ValueError(f'Need at least {n_components} cells to fit {n_components} components, '
+                             f'got {pending_rows}')
+        ipca.partial_fit(np.vstack(pending))
+    return ipca
+
+
+def fit_sparse_pca(matrix, n_components=50, n_oversamples=10, n_iter=4, random_state=0):
+    """
+    Randomized PCA (Halko et al.) of a sparse cells x genes matrix with implicit centering.
+
+    The centered matrix A = X - 1 mean^T is never formed. Products with it are
+    computed as A @ M = X @ M - 1 (mean @ M) and A^T @ M = X^T @ M - mean (1^T M),
+    so every step costs O(nonzeros * (n_components + n_oversamples)).
+
+    :param matrix: (n_cells, n_genes) scipy.sparse matrix (dense arrays also work).
+    :param n_components: Number of principal components to keep.
+    :param n_oversamples: Extra random directions sampled for accuracy.
+    :param n_iter: Power iterations; more iterations sharpen a slowly decaying spectrum.
+    :param random_state: Seed for the random test matrix.
+    :return: A fitted Projection.
+    """
+    if sp.issparse(matrix):
+        matrix = sp.csr_matrix(matrix, dtype=np.float32)
+    n_cells, n_genes = matrix.shape
+    if n_components > min(n_cells, n_genes):
+        raise ValueError(f'Cannot fit {n_components} components to a {n_cells} x {n_genes} matrix')
+    mean = np.asarray(matrix.mean(axis=0), dtype=np.float64).ravel()
+
+    def a_dot(m):
+        return np.asarray(matrix @ m) - np.outer(np.ones(n_cells), mean @ m)
+
+    def at_dot(m):
+        return np.asarray(matrix.T @ m) - np.outer(mean, m.sum(axis=0))
+
+    rng = np.random.default_rng(random_state)
+    size = min(n_components + n_oversamples, n_genes)
+    q, _ = np.linalg.qr(a_dot(rng.standard_normal((n_genes, size))))
+    for _ in range(n_iter):
+        q, _ = np.linalg.qr(at_dot(q))
+        q, _ = np.linalg.qr(a_dot(q))
+
+    b = at_dot(q).T
+    u_b, s, vt = np.linalg.svd(b, full_matrices=False)
+    u = q @ u_b
+
+    # Deterministic signs: the largest loading of each cell-space vector is positive
+    signs = np.sign(u[np.argmax(np.abs(u), axis=0), np.arange(u.shape[1])])
+    signs[signs == 0] = 1
+    vt *= signs[:, None]
+
+    explained_variance = s[:n_components] ** 2 / (n_cells - 1)
+    return Projection(mean, vt[:n_components], explained_variance)
+
+
+def variance_shortfall(values, reference, other, n_components=10):
+    """
+    How much less of the data's variance the leading components of one fit capture
+    than those of a reference fit.
+
+    This compares what PCA actually identifies, the leading subspace: signs, and
+    rotations among components of nearly equal variance, do not change it, and the
+    trailing components (a flat noise spectrum in expression data) are left out.
+
+    :param values: (n_cells, n_genes) data both fits were made on.
+    :param reference: (n_components, n_genes) components of the reference fit, e.g. the one-shot PCA.
+    :param other: (n_components, n_genes) components of the fit to check, e.g. the incremental PCA.
+    :param n_components: Number of leading components compared.
+    :return: 1 - (variance captured by other's subspace) / (variance captured by reference's),
+        0 for the same subspace. The reference is the optimum, so this is not negative.
+    """
+    centered = np.asarray(values, dtype=np.float64)
+    centered = centered - centered.mean(axis=0)
+
+    def captured(components):
+        basis, _ = np.linalg.qr(np.asarray(components, dtype=np.float64)[:n_components].T)
+        return np.linalg.norm(centered @ basis) ** 2
+
+    return max(0.0, 1.0 - captured(other) / captured(reference))
@@ -0,0 +1,179 @@
+"""
+Compressed vector codes for the local backend's quantized indexes.
+
+Two quantizers, trained from the stored PCA embeddings:
+    ScalarQuantizer   one uint8 per dimension (a per-dimension offset and step),
+                      4x smaller than float32
+    ProductQuantizer  the vector is cut into m sub-vectors and each is replaced by
+                      the index of its nearest of 2**nbits k-means centroids, so
+                      a 50-dimensional vector with m=10 takes 10 bytes (20x smaller)
+
+A quantized search scores every candidate row from its code and then re-ranks a
+shortlist of refine_k * limit rows with the exact float32 vectors (see
+LocalCollection.search), so returned distances are always exact.
+
+The index type names follow their Milvus counterparts (IVF_SQ8, IVF_PQ) so the
+same collection settings work on both backends. The local versions have no
+coarse IVF partitioning: every row's code is scored.
+"""
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+# Index types the local backend stores codes for; every other type is searched exactly
+QUANTIZED_INDEX_TYPES = ('IVF_SQ8', 'IVF_PQ')
+
+# Rows a quantizer is trained on at most, and rows needed before one is trained at all
+TRAIN_ROWS = 65536
+MIN_TRAIN_ROWS = 1024
+
+# Shortlist size, as a multiple of the limit, re-ranked with the exact vectors
+DEFAULT_REFINE_K = 4
+
+
+class ScalarQuantizer:
+    """
+    Per-dimension uint8 quantization: x ~ offset + code * step.
+    """
+    index_type = 'IVF_SQ8'
+
+    def __init__(self, offset=None, step=None):
+        self.offset = offset
+        self.step = step
+
+    @property
+    def trained(self):
+        return self.offset is not None
+
+    def code_size(self, dimension):
+        return dimension
+
+    def train(self, vectors):
+        low = vectors.min(axis=0)
+        high = vectors.max(axis=0)
+        self.offset = low.astype(np.float32)
+        self.step = np.maximum((high - low) / 255.0, 1e-12).astype(np.float32)
+        return self
+
+    def encode(self, vectors):
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.step)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.offset + codes.astype(np.float32) * self.step
+
+    def inner_products(self, queries, codes):
+        """
+        Approximate queries @ vectors.T from the codes of the vectors.
+        """
+        # q . (offset + code * step) = q . offset + (q * step) . code
+        return (queries * self.step) @ codes.T.astype(np.float32) + (queries @ self.offset)[:, None]
+
+    @property
+    def nbytes(self):
+        return self.offset.nbytes + self.step.nbytes
+
+    def state(self):
+        return {'offset': self.offset, 'step': self.step}
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        return cls(arrays['offset'], arrays['step'])
+
+
+class ProductQuantizer:
+    """
+    Product quantization: m sub-vectors, each coded by its nearest of 2**nbits centroids.
+    """
+    index_type = 'IVF_PQ'
+
+    def __init__(self, m, nbits=8, codebooks=None):
+        """
+        :param m: Number of sub-vectors. Must divide the vector dimension.
+        :param nbits: Bits per sub-vector code (at most 8).
+        :param codebooks: (m, 2**nbits, dimension // m) centroids of a trained quantizer.
+        """
+        if not 1 <= nbits <= 8:
+            raise ValueError(f'nbits must be between 1 and 8, got {nbits}')
+        self.m = int(m)
+        self.nbits = int(nbits)
+        self.codebooks = codebooks
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    def code_size(self, dimension):
+        return self.m
+
+    def _split(self, vectors):
+        n, dimension = vectors.shape
+        if dimension % self.m:
+            raise ValueError(f'IVF_PQ needs m to divide the dimension; {self.m} does not divide {dimension}')
+        return np.asarray(vectors, dtype=np.float32).reshape(n, self.m, dimension // self.m)
+
+    def train(self, vectors, seed=0):
+        sub_vectors = self._split(vectors)
+        n_centroids = min(2 ** self.nbits, len(vectors))
+        codebooks = np.zeros((self.m, 2 ** self.nbits, sub_vectors.shape[2]), dtype=np.float32)
+        for j in range(self.m):
+            kmeans = MiniBatchKMeans(n_clusters=n_centroids, n_init=1, max_iter=25, batch_size=4096,
+                                     random_state=seed)
+            codebooks[j, :n_centroids] = kmeans.fit(sub_vectors[:, j]).cluster_centers_
+        self.codebooks = codebooks
+        return self
+
+    def encode(self, vectors):
+        sub_vectors = self._split(vectors)
+        codes = np.empty((len(sub_vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            # Nearest centroid by ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, dropping ||x||^2
+            centroids = self.codebooks[j]
+            distances = (centroids ** 2).sum(axis=1)[None, :] - 2 * sub_vectors[:, j] @ centroids.T
+            codes[:, j] = distances.argmin(axis=1)
+        return codes
+
+    def decode(self, codes):
+        return self.codebooks[np.arange(self.m), codes].reshape(len(codes), -1)
+
+    def inner_products(self, queries, codes):
+        """
+        Approximate queries @ vectors.T from the codes of the vectors.
+        """
+        # Decoding the block and doing one matrix multiply is much faster in NumPy than
+        # summing m lookup-table gathers of (n_queries, rows) each
+        return queries @ self.decode(codes).T
+
+    @property
+    def nbytes(self):
+        return self.codebooks.nbytes
+
+    def state(self):
+        return {'codebooks': self.codebooks}
+
+    @classmethod
+    def from_state(cls, params, arrays):
+        return cls(params['m'], params.get('nbits', 8), arrays['codebooks'])
+
+
+def make_quantizer(index_type, params=None):
+    """
+    The untrained quantizer of a quantized index type, or None for the exact types.
+    """
+    params = params or {}
+    if index_type == 'IVF_SQ8':
+        return ScalarQuantizer()
+    if index_type == 'IVF_PQ':
+        if 'm' not in params:
+            raise ValueError('IVF_PQ needs the number of sub-vectors m in its index params')
+        return ProductQuantizer(params['m'], params.get('nbits', 8))
+    return None
+
+
+def load_quantizer(index_type, params, arrays):
+    """
+    Rebuild a trained quantizer from the arrays returned by its state().
+    """
+    if index_type == 'IVF_SQ8':
+        return ScalarQuantizer.from_state(params, arrays)
+    return ProductQuantizer.from_state(params, arrays)
@@ -0,0 +1,198 @@
+"""
+Columnar storage of similarity search results.
+
+Results are kept as one long table with a row per (query, neighbor) pair:
+
+    query_id     int64    primary key of the query cell
+    neighbor_id  int64    primary key of the matched cell
+    similarity   float32  cosine similarity of the match
+    rank         int32    0 for the best match of a query, 1 for the next, ...
+    file_name    string   source file of the matched cell (null when unknown)
+
+The columns are built from flat NumPy arrays, never row by row, and written as
+Parquet partitioned by the experiment of the matched cell (hive style, e.g.
+data/similar_cells/experiment=2/part-<session>.parquet): the N of its ex_N_*
+file_name, or, when the file name is unknown, the experiment its primary key
+encodes (ingest.PRIMARY_KEY_SCHEME). Reading one
+experiment's matches only opens its files. A ResultsWriter keeps one file open
+per experiment and appends every batch it is given as a new row group; each
+writer session adds new part files next to those of earlier sessions.
+"""
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from ingest import experiment_of
+from schema import experiment_number
+
+
+RESULT_SCHEMA = pa.schema([
+    ('query_id', pa.int64()),
+    ('neighbor_id', pa.int64()),
+    ('similarity', pa.float32()),
+    ('rank', pa.int32()),
+    ('file_name', pa.string()),
+])
+
+
+def similarity_columns(similarity_obj):
+    """
+    Flatten a find_similarities dictionary into the arrays of the long table.
+
+    :param similarity_obj: A dictionary of query id -> list of (neighbor_id, similarity)
+        tuples ordered by most to least similar.
+    :return: A dictionary of column name -> array (query_id, neighbor_id, similarity, rank).
+    """
+    counts = np.fromiter((len(matches) for matches in similarity_obj.values()), dtype=np.int64,
+                         count=len(similarity_obj))
+    total = int(counts.sum())
+    query_ids = np.repeat(np.fromiter(similarity_obj.keys(), dtype=np.int64, count=len(similarity_obj)), counts)
+    neighbor_ids = np.fromiter((match[0] for matches in similarity_obj.values() for match in matches),
+                               dtype=np.int64, count=total)
+    similarities = np.fromiter((match[1] for matches in similarity_obj.values() for match in matches),
+                               dtype=np.float32, count=total)
+    # Position of every row within its query's matches
+    starts = np.cumsum(counts) - counts
+    ranks = (np.arange(total, dtype=np.int64) - np.repeat(starts, counts)).astype(np.int32)
+    return {'query_id': query_ids, 'neighbor_id': neighbor_ids, 'similarity': similarities, 'rank': ranks}
+
+
+def similarity_table(similarity_obj, file_names=None):
+    """
+    The long-format Arrow table of a find_similarities dictionary.
+
+    :param similarity_obj: A dictionary of query id -> list of (neighbor_id, similarity) tuples.
+    :param file_names: Optional dictionary of neighbor id -> source file name.
+    :return: A pyarrow.Table with the RESULT_SCHEMA columns.
+    """
+    columns = similarity_columns(similarity_obj)
+    if file_names:
+        names = pd.Series(columns['neighbor_id']).map(file_names)
+        file_column = pa.array(names.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    else:
+        file_column = pa.nulls(len(columns['neighbor_id']), type=pa.string())
+    return pa.Table.from_arrays([pa.array(columns[name]) for name in RESULT_SCHEMA.names[:-1]] + [file_column],
+                                schema=RESULT_SCHEMA)
+
+
+class ResultsWriter:
+    """
+    Appends similarity results to a Parquet dataset partitioned by experiment.
+
+    Use it as a context manager, or call close() when done: files are only complete
+    once closed.
+
+    Example:
+    with ResultsWriter('data/similar_cells') as writer:
+        for batch in batches:
+            writer.write(find_similarities(collection, batch))
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the dataset. Created if needed; existing part files are kept.
+        """
+        self.path = path
+        self.session = uuid.uuid4().hex[:12]
+        self.rows = 0
+        self._writers = {}
+
+    def write(self, similarity_obj, file_names=None):
+        """
+        Append the results of some queries.
+
+        :param similarity_obj: A dictionary of query id -> list of (neighbor_id, similarity) tuples.
+        :param file_names: Optional dictionary of neighbor id -> source file name.
+        :return: The number of rows written.
+        """
+        return self.write_table(similarity_table(similarity_obj, file_names))
+
+    def write_table(self, table):
+        """
+        Append a table with the RESULT_SCHEMA columns, split by experiment.
+        """
+        if not table.num_rows:
+            return 0
+        experiments = self._experiments(table)
+        # Group the rows by experiment with one stable sort instead of a mask per experiment
+        order = np.argsort(experiments, kind='stable')
+        experiments = experiments[order]
+        table = table.take(pa.array(order))
+        boundaries = np.flatnonzero(np.diff(experiments)) + 1
+        for start, stop in zip(np.r_[0, boundaries], np.r_[boundaries, len(experiments)]):
+            self._writer(int(experiments[start])).write_table(table.slice(start, stop - start))
+        self.rows += table.num_rows
+        return table.num_rows
+
+    @staticmethod
+    def _experiments(table):
+        """
+        Experiment of every row: from its file_name, or from its neighbor_id when that is null.
+        """
+        experiments = experiment_of(table.column('neighbor_id').to_numpy())
+        file_names = table.column('file_name')
+        if file_names.null_count == len(file_names):
+            return experiments
+        # Parse each distinct file name once, then map the rows through the dictionary
+        encoded = pc.dictionary_encode(file_names.combine_chunks())
+        indices = encoded.indices.to_numpy(zero_copy_only=False)
+        numbers = np.asarray([experiment_number(name) for name in encoded.dictionary.to_pylist()], dtype=np.int64)
+        known = encoded.indices.is_valid().to_numpy(zero_copy_only=False)
+        experiments[known] = numbers[indices[known].astype(np.int64)]
+        return experiments
+
+    def _writer(self, experiment_num):
+        writer = self._writers.get(experiment_num)
+        if writer is None:
+            directory = os.path.join(self.path, f'experiment={experiment_num}')
+            os.makedirs(directory, exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(directory, f'part-{self.session}.parquet'), RESULT_SCHEMA)
+            self._writers[experiment_num] = writer
+        return writer
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_results(path, similarity_obj, file_names=None):
+    """
+    Append one dictionary of results to the dataset at path (see ResultsWriter).
+
+    :return: The number of rows written.
+    """
+    with ResultsWriter(path) as writer:
+        return writer.write(similarity_obj, file_names)
+
+
+def read_results(path, experiments=None, query_ids=None):
+    """
+    Read a results dataset back as a DataFrame.
+
+    :param path: Directory written by a ResultsWriter.
+    :param experiments: Only read the matches in these experiments (only their files are opened).
+    :param query_ids: Only read the rows of these queries.
+    :return: A DataFrame with the RESULT_SCHEMA columns plus experiment, sorted by query and rank.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    condition = None
+    if experiments is not None:
+        condition = ds.field('experiment').isin([int(experiment_num) for experiment_num in experiments])
+    if query_ids is not None:
+        queries = ds.field('query_id').isin([int(query_id) for query_id in query_ids])
+        condition = queries if condition is None else condition & queries
+    table = dataset.to_table(filter=condition)
+    return table.to_pandas().sort_values(['query_id', 'rank'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,246 @@
+"""
+Creation and inspection of the collections cells are stored in.
+
+Collections are created at the real embedding dimension with an explicit metric
+and index, and carry a JSON description recording where their embeddings came
+from (source file, number of PCA components). Inserts are checked against the
+stored dimension, and migrate_padded_collection converts the older collections
+whose vectors were zero-padded to 5880 into compact ones.
+
+Every experiment's cells are inserted into their own partition (experiment_<N>),
+so searches restricted to some experiments only scan those partitions.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from pymilvus import DataType, MilvusClient
+
+from ingest import Batch, run_pipeline
+from local_backend import LocalMilvusClient
+from neighbor_cache import get_neighbor_cache
+
+
+# Build parameters used when none are given for an index type. IVF_PQ also gets
+# m = pq_subvectors(dimension)
+DEFAULT_INDEX_PARAMS = {
+    'FLAT': {},
+    'IVF_FLAT': {'nlist': 1024},
+    'HNSW': {'M': 16, 'efConstruction': 200},
+    'IVF_SQ8': {'nlist': 1024},
+    'IVF_PQ': {'nlist': 1024, 'nbits': 8},
+}
+
+_dimensions = {}
+_dimensions_lock = threading.Lock()
+
+
+def pq_subvectors(dimension, dims_per_subvector=5):
+    """
+    Number of IVF_PQ sub-vectors for a dimension: the largest divisor of the dimension
+    that leaves at least dims_per_subvector dimensions per sub-vector.
+    """
+    return max(m for m in range(1, max(dimension // dims_per_subvector, 1) + 1) if dimension % m == 0)
+
+
+def create_collection(client, collection_name, dimension, metric_type='COSINE', index_type='HNSW',
+                      index_params=None, provenance=None):
+    """
+    Create a collection for embeddings of a given dimension.
+
+    :param client: A MilvusClient or LocalMilvusClient.
+    :param collection_name: Name of the collection to create.
+    :param dimension: Length of the stored vectors (e.g. the number of PCA components).
+    :param metric_type: 'COSINE', 'IP' or 'L2'.
+    :param index_type: 'FLAT', 'IVF_FLAT', 'HNSW', or the quantized 'IVF_SQ8' (int8 per
+        dimension) and 'IVF_PQ' (product quantization). The local backend searches the
+        quantized types over their codes and re-ranks with the exact vectors; it is exact
+        for the others.
+    :param index_params: Index build parameters. Defaults to DEFAULT_INDEX_PARAMS[index_type].
+    :param provenance: Dictionary describing the embedding (source_file, pca_components, ...),
+        stored as JSON in the collection description.
+    """
+    if index_type not in DEFAULT_INDEX_PARAMS:
+        raise ValueError(f'Unsupported index type {index_type}. Expected one of {list(DEFAULT_INDEX_PARAMS)}')
+    description = json.dumps({
+        **(provenance or {}),
+        'dimension': dimension,
+        'metric_type': metric_type,
+        'index_type': index_type,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    if index_params is None:
+        index_params = dict(DEFAULT_INDEX_PARAMS[index_type])
+        if index_type == 'IVF_PQ':
+            index_params['m'] = pq_subvectors(dimension)
+
+    if isinstance(client, LocalMilvusClient):
+        client.create_collection(collection_name, dimension=dimension, metric_type=metric_type,
+                                 description=description, index_type=index_type, index_params=index_params)
+    else:
+        schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=False, description=description)
+        schema.add_field(field_name='primary_key', datatype=DataType.INT64, is_primary=True)
+        schema.add_field(field_name='vector', datatype=DataType.FLOAT_VECTOR, dim=dimension)
+        schema.add_field(field_name='cell_name', datatype=DataType.VARCHAR, max_length=256)
+        schema.add_field(field_name='file_name', datatype=DataType.VARCHAR, max_length=512)
+
+        index = client.prepare_index_params()
+        index.add_index(field_name='vector', index_type=index_type, metric_type=metric_type,
+                        params=index_params)
+        client.create_collection(collection_name=collection_name, schema=schema, index_params=index)
+
+    with _dimensions_lock:
+        _dimensions[collection_name] = dimension
+    print(f'Created collection {collection_name} ({dimension} dimensions, {metric_type}, {index_type})')
+
+
+def collection_info(client, collection_name):
+    """
+    Dimension and provenance of an existing collection.
+
+    :return: A dictionary with 'dimension' and 'provenance' (the decoded description,
+        empty for collections created before provenance was recorded).
+    """
+    description = client.describe_collection(collection_name=collection_name)
+    dimension = None
+    for field in description['fields']:
+        if 'dim' in field.get('params', {}):
+            dimension = int(field['params']['dim'])
+    try:
+        provenance = json.loads(description.get('description') or '{}')
+    except ValueError:
+        provenance = {}
+    return {'dimension': dimension, 'provenance': provenance}
+
+
+def ensure_collection(client, collection_name, dimension, provenance=None, **create_args):
+    """
+    Create the collection if it does not exist, otherwise check that it stores vectors
+    of the given dimension.
+
+    :param create_args: Passed to create_collection (metric_type, index_type, index_params).
+    :raises ValueError: If the collection exists with a different dimension.
+    """
+    if not client.has_collection(collection_name=collection_name):
+        create_collection(client, collection_name, dimension, provenance=provenance, **create_args)
+    check_dimension(client, collection_name, dimension)
+
+
+def experiment_number(filename):
+    """
+    The experiment number N of an ex_N_* source file.
+    """
+    return int(re.search(r'ex_(\d+)_', os.path.basename(filename.rstrip(os.sep))).group(1))
+
+
+def experiment_partition(experiment_num):
+    """
+    Name of the partition holding an experiment's cells.
+    """
+    return f'experiment_{int(experiment_num)}'
+
+
+def ensure_partition(client, collection_name, partition_name):
+    """
+    Create a partition of the collection if it does not exist.
+    """
+    if not client.has_partition(collection_name=collection_name, partition_name=partition_name):
+        client.create_partition(collection_name=collection_name, partition_name=partition_name)
+
+
+def check_dimension(client, collection_name, dimension):
+    """
+    Refuse vectors whose dimension does not match the collection.
+
+    :raises ValueError: If the dimensions differ.
+    """
+    with _dimensions_lock:
+        stored = _dimensions.get(collection_name)
+    if stored is None:
+        stored = collection_info(client, collection_name)['dimension']
+        with _dimensions_lock:
+            _dimensions[collection_name] = stored
+    if stored is not None and stored != dimension:
+        raise ValueError(f'Collection {collection_name} stores {stored}-dimensional vectors; refusing to insert '
+                         f'{dimension}-dimensional vectors')
+
+
+def migrate_padded_collection(client, source_collection, target_collection, dimension=None,
+                              batch_size=1000, workers=4, **create_args):
+    """
+    Copy a collection whose vectors were zero-padded (e.g. to 5880) into a compact
+    collection at the embedding's real dimension.
+
+    Padding was appended after the PCA components, so truncating the vectors is an
+    exact re-projection. The trailing columns are checked to be all zero first.
+
+    :param client: A MilvusClient or LocalMilvusClient.
+    :param source_collection: The padded collection.
+    :param target_collection: The compact collection to create.
+    :param dimension: Embedding dimension to keep. Defaults to the last column with a
+        nonzero value in any vector.
+    :param batch_size: Rows read and written per request.
+    :param workers: Number of insert requests kept in flight at once.
+    :param create_args: Passed to create_collection (metric_type, index_type, index_params).
+    :return: The IngestStats of the copy.
+
+    Every row is written to the partition of its source file's experiment, as ingestion does.
+    """
+    def read_batches():
+        iterator = client.query_iterator(collection_name=source_collection, batch_size=batch_size,
+                                         filter='primary_key >= 0',
+                                         output_fields=['primary_key', 'vector', 'file_name'])
+        while True:
+            batch = iterator.next()
+            if not batch:
+                break
+            keys = np.fromiter((item['primary_key'] for item in batch), dtype=np.int64, count=len(batch))
+            vectors = np.asarray([item['vector'] for item in batch], dtype=np.float32)
+            yield keys, vectors, np.asarray([item['file_name'] for item in batch])
+        iterator.close()
+
+    def last_used_column(vectors):
+        used = np.flatnonzero(np.any(vectors != 0, axis=0))
+        return int(used[-1]) + 1 if len(used) else 0
+
+    if dimension is None:
+        print(f'Scanning {source_collection} for the embedding dimension...')
+        dimension = max((last_used_column(vectors) for _, vectors, _ in read_batches()), default=0)
+    print(f'Compacting {source_collection} to {dimension} dimensions...')
+
+    provenance = collection_info(client, source_collection)['provenance']
+    provenance = {**provenance, 'migrated_from': source_collection, 'pca_components': dimension}
+    provenance.pop('dimension', None)
+    ensure_collection(client, target_collection, dimension, provenance=provenance, **create_args)
+
+    partitions = set()
+
+    def batches():
+        offset = 0
+        for keys, vectors, file_names in read_batches():
+            if last_used_column(vectors) > dimension:
+                raise ValueError(f'{source_collection} has nonzero values past column {dimension}; '
+                                 f'truncating would lose data')
+            compact = np.ascontiguousarray(vectors[:, :dimension])
+            # file_name is one value per Batch, so split batches that mix source files
+            for name in np.unique(file_names):
+                rows = np.flatnonzero(file_names == name)
+                partition = experiment_partition(experiment_number(str(name)))
+                if partition not in partitions:
+                    ensure_partition(client, target_collection, partition)
+                    partitions.add(partition)
+                yield Batch(offset + int(rows[0]), keys[rows], compact[rows], str(name), partition)
+            offset += len(keys)
+
+    # The target name may have been used before; its cached neighbors are stale either way
+    get_neighbor_cache().invalidate(target_collection)
+    try:
+        stats = run_pipeline(client, target_collection, batches(), workers=workers)
+    finally:
+        # Searches that ran during the copy cached results over part of the rows
+        get_neighbor_cache().invalidate(target_collection)
+    stats.report()
+    return stats
@@ -0,0 +1,382 @@
+"""
+Long-running query service that keeps the client, models and caches warm.
+
+A script that calls find_similarities pays for importing pandas, sklearn and
+pymilvus and for connecting (or, on the local backend, loading the collection)
+before it does any work. The service does that once and then answers JSON
+requests over a Unix socket (default) or a local TCP port:
+
+    GET  /health
+    POST /similar    {"collection", "ids", "limit", "experiments", "min_similarity", "adaptive"}
+    POST /clusters   {"collection", "seed_ids", "limit", "iterations", "experiments", "min_similarity",
+                      "adaptive"}
+    POST /genes      {"file", "ids", "top_n", "collection"}
+    POST /markers    {"collection", "file", "gene", "max_rank"}
+    POST /new_cells  {"collection", "cells", "genes", "file_name", "limit"}
+
+Concurrent /similar requests with the same settings are coalesced: the ones
+arriving within a few milliseconds of each other are answered by one search
+over the union of their ids, so an id asked for by several clients is searched
+once. Identical /clusters requests in flight share one expansion. Projection
+models and expression matrices are kept loaded after their first use (or
+preloaded with --collection / --matrix). /genes with a collection and /markers
+read the top-gene index ingestion built (see gene_index.py) instead of a matrix.
+
+service_client.py is a thin command line client for it.
+
+Usage:
+    python service.py [--socket data/scmilvus.sock | --port 8765] [--collection NAME ...] [--matrix FILE ...]
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+
+import metrics
+from analysis import find_clusters, find_marker_cells
+from database_connections import (find_similarities, get_client, load_source_matrix, search_new_cells,
+                                  source_rows)
+from gene_index import DEFAULT_TOP_N, get_gene_index, has_gene_index, top_n_columns
+from global_variables import SERVICE_SOCKET
+from neighbor_cache import get_neighbor_cache
+from projection import list_models, load_model
+from schema import collection_info
+
+
+# How long the first /similar request of a batch waits for others to join it, and
+# the number of ids that sends a batch without waiting any longer
+COALESCE_WINDOW = 0.005
+COALESCE_MAX_IDS = 1000
+
+
+class _Pending:
+    def __init__(self):
+        self.ids = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """
+    Merges concurrent requests with the same key into one call over the union of their ids.
+
+    The first request for a key waits up to window seconds (less if max_ids ids are
+    collected) and then calls search(key, ids) once for every request that joined it.
+    """
+
+    def __init__(self, search, window=COALESCE_WINDOW, max_ids=COALESCE_MAX_IDS):
+        """
+        :param search: Function (key, sorted list of ids) -> dictionary keyed by id.
+        :param window: Seconds the first request waits for others.
+        :param max_ids: Number of ids that sends the batch right away.
+        """
+        self.search = search
+        self.window = window
+        self.max_ids = max_ids
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, ids):
+        """
+        :return: The search results of ids (ids that were not found are left out).
+        """
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = _Pending()
+            batch.ids.update(ids)
+            if len(batch.ids) >= self.max_ids:
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                del self._pending[key]
+            metrics.count('service.coalesced_ids', len(batch.ids))
+            try:
+                batch.result = self.search(key, sorted(batch.ids))
+            except Exception as error:
+                batch.error = error
+            batch.done.set()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return {cell_id: batch.result[cell_id] for cell_id in ids if cell_id in batch.result}
+
+
+class SingleFlight:
+    """
+    Runs a call once for all identical requests in flight at the same time.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Pending()
+        if leader:
+            try:
+                call.result = function()
+            except Exception as error:
+                call.error = error
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        else:
+            metrics.count('service.shared_calls')
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+def _experiments_key(experiments):
+    return None if experiments is None else tuple(sorted(int(experiment_num) for experiment_num in experiments))
+
+
+def _matches(results):
+    return {str(cell_id): [[int(match_id), float(similarity)] for match_id, similarity in matches]
+            for cell_id, matches in results.items()}
+
+
+class Service:
+    """
+    The request handlers, holding the warm client, models and expression matrices.
+    """
+
+    def __init__(self, collections=(), matrices=()):
+        """
+        :param collections: Collections to open and load the projection models of up front.
+        :param matrices: Cell/gene files (paths, or names in the data directory) to open up front.
+        """
+        self.client = get_client()
+        self.models = {}
+        self.matrices = {}
+        self._lock = threading.Lock()
+        self.similar_batches = Coalescer(self._search)
+        self.cluster_calls = SingleFlight()
+        self.routes = {
+            'similar': self.similar,
+            'clusters': self.clusters,
+            'genes': self.genes,
+            'markers': self.markers,
+            'new_cells': self.new_cells,
+        }
+
+        get_neighbor_cache()
+        for collection in collections:
+            with metrics.span('service.preload', collection=collection):
+                collection_info(self.client, collection)
+                for file_name in list_models(collection):
+                    self.model(collection, file_name)
+        for file in matrices:
+            self.matrix(file)
+
+    def model(self, collection, file_name=None):
+        key = (collection, file_name)
+        with self._lock:
+            projection = self.models.get(key)
+        if projection is None:
+            projection = load_model(collection, file_name)
+            with self._lock:
+                self.models[key] = projection
+        return projection
+
+    def matrix(self, file):
+        path = file if os.path.exists(file) else os.path.join('data', file)
+        with self._lock:
+            matrix = self.matrices.get(path)
+        if matrix is None:
+            matrix = load_source_matrix(path)
+            with self._lock:
+                self.matrices[path] = matrix
+        return matrix
+
+    def handle(self, route, body):
+        """
+        Answer one request.
+
+        :param route: Endpoint name, e.g. 'similar'.
+        :param body: The decoded JSON request.
+        :return: The JSON-serializable response.
+        :raises KeyError: For an unknown route.
+        :raises ValueError: For a malformed request.
+        """
+        handler = self.routes[route]
+        with metrics.span(f'service.{route}'):
+            return handler(body)
+
+    def _search(self, key, ids):
+        collection, limit, experiments, min_similarity, adaptive, use_cache = key
+        return find_similarities(collection, ids, limit=limit, use_cache=use_cache,
+                                 experiments=None if experiments is None else list(experiments),
+                                 min_similarity=min_similarity, adaptive=adaptive)
+
+    def similar(self, body):
+        ids = [int(cell_id) for cell_id in _require(body, 'ids')]
+        key = (_require(body, 'collection'), int(body.get('limit', 10)), _experiments_key(body.get('experiments')),
+               body.get('min_similarity'), bool(body.get('adaptive', False)), bool(body.get('use_cache', True)))
+        return {'results': _matches(self.similar_batches.submit(key, ids))}
+
+    def clusters(self, body):
+        collection = _require(body, 'collection')
+        seed_ids = [int(cell_id) for cell_id in _require(body, 'seed_ids')]
+        options = {
+            'limit': int(body.get('limit', 1024)),
+            'iterations': int(body.get('iterations', 5)),
+            'experiments': body.get('experiments'),
+            'min_similarity': body.get('min_similarity'),
+            'adaptive': bool(body.get('adaptive', False)),
+            'use_cache': bool(body.get('use_cache', True)),
+        }
+        key = json.dumps({'collection': collection, 'seed_ids': seed_ids, **options}, sort_keys=True)
+        out = self.cluster_calls.do(key, lambda: find_clusters(collection, seed_ids, **options))
+        return {'cell_id': out['cell_id'].tolist(), 'count': out['count'].tolist()}
+
+    def genes(self, body):
+        file = _require(body, 'file')
+        collection = body.get('collection')
+        ids = np.asarray([int(cell_id) for cell_id in _require(body, 'ids')], dtype=np.int64)
+        top_n = int(body.get('top_n', DEFAULT_TOP_N))
+        if collection is not None and has_gene_index(collection, file, top_n):
+            index = get_gene_index(collection, file)
+            found, gene_idx, _ = index.top_genes(ids, top_n)
+            genes = index.gene_names[gene_idx].tolist()
+        else:
+            matrix = self.matrix(file)
+            rows = source_rows(file, matrix, ids)
+            found = rows >= 0
+            gene_idx, _ = top_n_columns(matrix.values[rows[found]], top_n)
+            genes = matrix.genes[gene_idx].tolist()
+        return {'results': {str(cell_id): cell_genes for cell_id, cell_genes in zip(ids[found].tolist(), genes)},
+                'missing': ids[~found].tolist()}
+
+    def markers(self, body):
+        max_rank = body.get('max_rank')
+        out = find_marker_cells(_require(body, 'collection'), _require(body, 'file'), _require(body, 'gene'),
+                                None if max_rank is None else int(max_rank))
+        return {'cell_id': out['cell_id'].tolist(), 'rank': out['rank'].tolist(),
+                'expression': out['expression'].tolist()}
+
+    def new_cells(self, body):
+        collection = _require(body, 'collection')
+        file_name = body.get('file_name')
+        cells = np.asarray(_require(body, 'cells'), dtype=np.float32)
+        if cells.ndim != 2:
+            raise ValueError('cells must be a list of expression rows')
+        results = search_new_cells(collection, cells, genes=np.asarray(_require(body, 'genes'), dtype=str),
+                                   file_name=file_name, limit=int(body.get('limit', 10)),
+                                   projection=self.model(collection, file_name))
+        return {'results': _matches(results)}
+
+
+def _require(body, field):
+    if field not in body:
+        raise ValueError(f'Missing field {field}')
+    return body[field]
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.strip('/') == 'health':
+            self._respond(200, {'status': 'ok', 'backend': type(self.server.service.client).__name__})
+        else:
+            self._respond(404, {'error': f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        route = self.path.strip('/')
+        length = int(self.headers.get('Content-Length', 0))
+        payload = self.rfile.read(length)
+        if route not in self.server.service.routes:
+            self._respond(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        try:
+            self._respond(200, self.server.service.handle(route, json.loads(payload or b'{}')))
+        except ValueError as error:
+            self._respond(400, {'error': str(error)})
+        except Exception as error:
+            self._respond(500, {'error': f'{type(error).__name__}: {error}'})
+
+    def _respond(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests are timed by the service.* metrics spans instead of an access log
+        pass
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, socket_path=SERVICE_SOCKET, port=None):
+    """
+    Answer requests until interrupted.
+
+    :param service: The Service to answer with.
+    :param socket_path: Unix socket to listen on (replaced if it exists).
+    :param port: Listen on this localhost TCP port instead of the socket.
+    """
+    if port is not None:
+        server = ThreadingHTTPServer(('127.0.0.1', port), ServiceHandler)
+        address = f'http://127.0.0.1:{port}'
+    else:
+        os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+        if os.path.exists(socket_path):
+            # Refuse to take over the socket of a service that is still running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                raise RuntimeError(f'A service is already listening on {socket_path}')
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(socket_path)
+            finally:
+                probe.close()
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        address = socket_path
+    server.service = service
+    print(f'Serving on {address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if port is None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve similarity, cluster and top-gene queries from a warm process')
+    parser.add_argument('--socket', default=SERVICE_SOCKET, help='Unix socket to listen on')
+    parser.add_argument('--port', type=int, default=None, help='Listen on this localhost TCP port instead')
+    parser.add_argument('--collection', action='append', default=[],
+                        help='Collection to open and load the projections of at startup (repeatable)')
+    parser.add_argument('--matrix', action='append', default=[],
+                        help='Cell/gene file to open at startup for /genes (repeatable)')
+    args = parser.parse_args()
+    serve(Service(args.collection, args.matrix), args.socket, args.port)
+
+
+if __name__ == '__main__':
+    main()
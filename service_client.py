@@ -0,0 +1,137 @@
+"""
+Command line client for the query service (service.py).
+
+Only standard library modules are imported, so a query costs a connection to
+the running service rather than importing NumPy, pandas and pymilvus. With
+--in-process the request is answered without a service instead; only then is
+the query stack imported.
+
+Usage:
+    python service_client.py similar <collection> <id> [<id> ...] [--limit 10] [--min-similarity 0.8]
+    python service_client.py clusters <collection> <seed_id> [...] [--limit 1024] [--iterations 5]
+    python service_client.py genes <file> <id> [<id> ...] [--top-n 20] [--collection NAME]
+    python service_client.py markers <collection> <file> <gene> [--max-rank 20]
+    python service_client.py health
+"""
+import argparse
+import http.client
+import json
+import socket
+import sys
+
+from global_variables import SERVICE_SOCKET
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTPConnection over a Unix socket.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(route, body=None, socket_path=SERVICE_SOCKET, port=None, timeout=None):
+    """
+    Send one request to the service.
+
+    :param route: Endpoint name, e.g. 'similar' (see service.py).
+    :param body: The JSON request. None sends a GET.
+    :param socket_path: Unix socket of the service.
+    :param port: Connect to this localhost TCP port instead of the socket.
+    :param timeout: Seconds to wait for the answer. Defaults to no limit.
+    :return: The decoded JSON response.
+    :raises ConnectionError: If no service is listening.
+    :raises RuntimeError: If the service answered with an error.
+    """
+    if port is not None:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    else:
+        connection = UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        if body is None:
+            connection.request('GET', f'/{route}')
+        else:
+            connection.request('POST', f'/{route}', body=json.dumps(body),
+                               headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        payload = json.loads(response.read() or b'{}')
+    except FileNotFoundError:
+        raise ConnectionError(f'No service socket at {socket_path}; start one with python service.py')
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(f'{route} failed ({response.status}): {payload.get("error")}')
+    return payload
+
+
+def answer_in_process(route, body):
+    # Deferred so that talking to a running service never imports the query stack
+    from service import Service
+    return Service().handle(route, body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a running scMilvus service')
+    parser.add_argument('--socket', default=SERVICE_SOCKET, help='Unix socket of the service')
+    parser.add_argument('--port', type=int, default=None, help='Localhost TCP port of the service instead')
+    parser.add_argument('--in-process', action='store_true', help='Answer without a service (slow to start)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    similar = commands.add_parser('similar', help='Most similar stored cells of stored cells')
+    similar.add_argument('collection')
+    similar.add_argument('ids', type=int, nargs='+')
+    similar.add_argument('--limit', type=int, default=10)
+    similar.add_argument('--experiments', type=int, nargs='+', default=None)
+    similar.add_argument('--min-similarity', type=float, default=None)
+    similar.add_argument('--adaptive', action='store_true')
+
+    clusters = commands.add_parser('clusters', help='find_clusters from seed cells')
+    clusters.add_argument('collection')
+    clusters.add_argument('seed_ids', type=int, nargs='+')
+    clusters.add_argument('--limit', type=int, default=1024)
+    clusters.add_argument('--iterations', type=int, default=5)
+    clusters.add_argument('--experiments', type=int, nargs='+', default=None)
+    clusters.add_argument('--min-similarity', type=float, default=None)
+    clusters.add_argument('--adaptive', action='store_true')
+
+    genes = commands.add_parser('genes', help='Most expressed genes of cells')
+    genes.add_argument('file', help='Cell/gene file the cells come from')
+    genes.add_argument('ids', type=int, nargs='+')
+    genes.add_argument('--top-n', type=int, default=20)
+    genes.add_argument('--collection', default=None, help='Read the top-gene index of this collection')
+
+    markers = commands.add_parser('markers', help='Cells with a gene among their most expressed')
+    markers.add_argument('collection')
+    markers.add_argument('file', help='Cell/gene file the cells come from')
+    markers.add_argument('gene')
+    markers.add_argument('--max-rank', type=int, default=None)
+
+    commands.add_parser('health', help='Check that the service is up')
+
+    args = vars(parser.parse_args())
+    route = args.pop('command')
+    socket_path, port, in_process = args.pop('socket'), args.pop('port'), args.pop('in_process')
+    body = args if route != 'health' else None
+
+    try:
+        if in_process:
+            result = {'status': 'ok'} if body is None else answer_in_process(route, body)
+        else:
+            result = request(route, body, socket_path, port)
+    except (ConnectionError, RuntimeError) as error:
+        print(error, file=sys.stderr)
+        raise SystemExit(1)
+    json.dump(result, sys.stdout)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
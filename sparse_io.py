@@ -0,0 +1,124 @@
+"""
+Readers for sparse single cell count matrices: 10x Genomics Matrix Market
+triplets and AnnData .h5ad files. Both return a cells x genes scipy.sparse CSR
+matrix without ever building the dense array.
+"""
+import gzip
+import os
+
+import numpy as np
+import scipy.io
+import scipy.sparse as sp
+
+import metrics
+
+
+def is_sparse_input(path):
+    """
+    True if path is a 10x directory, a Matrix Market file or an .h5ad file.
+    """
+    if os.path.isdir(path):
+        return True
+    return path.endswith(('.mtx', '.mtx.gz', '.h5ad'))
+
+
+def read_sparse_matrix(path):
+    """
+    Read a sparse count matrix.
+
+    :param path: A 10x directory (matrix.mtx, barcodes.tsv, features.tsv or genes.tsv,
+        optionally gzipped), a .mtx file inside such a directory, or an .h5ad file.
+    :return: A tuple (cell_names, gene_names, matrix) where matrix is a cells x genes
+        CSR matrix (or a dense array if the .h5ad stores X densely).
+    """
+    with metrics.span('sparse.load', file=os.path.basename(path.rstrip(os.sep))) as span:
+        cells, genes, matrix = read_h5ad(path) if path.endswith('.h5ad') else read_10x_mtx(path)
+        span.set(rows=matrix.shape[0], nnz=int(matrix.nnz) if sp.issparse(matrix) else matrix.size)
+    return cells, genes, matrix
+
+
+def _find(directory, names):
+    for name in names:
+        for candidate in (name, f'{name}.gz'):
+            file = os.path.join(directory, candidate)
+            if os.path.exists(file):
+                return file
+    raise FileNotFoundError(f'None of {names} found in {directory}')
+
+
+def _read_tsv_column(file, column):
+    opener = gzip.open if file.endswith('.gz') else open
+    with opener(file, 'rt') as fh:
+        rows = [line.rstrip('\n').split('\t') for line in fh if line.strip()]
+    return np.array([row[column] if len(row) > column else row[0] for row in rows])
+
+
+def read_10x_mtx(path):
+    """
+    Read 10x Matrix Market output. 10x writes genes x cells, so the matrix is transposed.
+
+    :param path: The 10x output directory, or the .mtx file inside it.
+    :return: A tuple (barcodes, gene_names, matrix) with matrix a cells x genes float32 CSR matrix.
+    """
+    directory = path if os.path.isdir(path) else os.path.dirname(path)
+    matrix_file = path if not os.path.isdir(path) else _find(directory, ['matrix.mtx'])
+    matrix = scipy.io.mmread(matrix_file)
+    matrix = sp.csr_matrix(matrix.T, dtype=np.float32)
+
+    barcodes = _read_tsv_column(_find(directory, ['barcodes.tsv']), 0)
+    # features.tsv (Cell Ranger 3+) and genes.tsv both hold the gene symbol in column 2
+    genes = _read_tsv_column(_find(directory, ['features.tsv', 'genes.tsv']), 1)
+    return barcodes, genes, matrix
+
+
+def read_h5ad(path):
+    """
+    Read an AnnData file. Uses anndata when it is installed and falls back to
+    reading the CSR arrays directly with h5py otherwise.
+
+    :param path: Path to the .h5ad file.
+    :return: A tuple (cell_names, gene_names, matrix) with matrix a cells x genes
+        CSR matrix (dense array if X is stored densely).
+    """
+    try:
+        import anndata
+    except ImportError:
+        anndata = None
+
+    if anndata is not None:
+        adata = anndata.read_h5ad(path)
+        matrix = adata.X
+        if sp.issparse(matrix):
+            matrix = sp.csr_matrix(matrix, dtype=np.float32)
+        return np.asarray(adata.obs_names), np.asarray(adata.var_names), matrix
+
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('Reading .h5ad files requires anndata or h5py (pip install anndata)')
+
+    with h5py.File(path, 'r') as fh:
+        x = fh['X']
+        if isinstance(x, h5py.Group):
+            shape = tuple(x.attrs.get('shape', x.attrs.get('h5sparse_shape')))
+            arrays = (x['data'][:].astype(np.float32), x['indices'][:], x['indptr'][:])
+            encoding = x.attrs.get('encoding-type', x.attrs.get('h5sparse_format', 'csr'))
+            if isinstance(encoding, bytes):
+                encoding = encoding.decode()
+            if encoding.startswith('csc'):
+                matrix = sp.csc_matrix(arrays, shape=shape).tocsr()
+            else:
+                matrix = sp.csr_matrix(arrays, shape=shape)
+        else:
+            matrix = x[:].astype(np.float32)
+        cells = _h5ad_index(fh['obs'])
+        genes = _h5ad_index(fh['var'])
+    return cells, genes, matrix
+
+
+def _h5ad_index(group):
+    key = group.attrs.get('_index', '_index')
+    if isinstance(key, bytes):
+        key = key.decode()
+    values = group[key][:]
+    return np.array([v.decode() if isinstance(v, bytes) else v for v in values])
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.io
+import scipy.sparse as sp
+
+# Tests always run against the in-process backend; set before global_variables is imported
+os.environ['SCMILVUS_BACKEND'] = 'local'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database_connections  # noqa: E402
+import gene_index  # noqa: E402
+import neighbor_cache  # noqa: E402
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    A scratch working directory with an empty data/ folder, a fresh local client and a
+    fresh neighbor cache. Every data path is relative, so nothing leaks between tests.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    # The local backend shares collections between clients of the same path, so give it its own
+    monkeypatch.setattr(database_connections, 'LOCAL_DB_PATH', str(tmp_path / 'data' / 'local_db'))
+    monkeypatch.setattr(database_connections, '_clients', {})
+    monkeypatch.setattr(neighbor_cache, '_cache', None)
+    monkeypatch.setattr(gene_index, '_indexes', {})
+    return tmp_path
+
+
+def write_10x(directory, n_cells=300, n_genes=80, seed=0):
+    """
+    Write a random sparse count matrix in the 10x Matrix Market layout (genes x cells).
+
+    :return: The (n_cells, n_genes) CSR matrix and the gene names.
+    """
+    rng = np.random.default_rng(seed)
+    counts = sp.random(n_cells, n_genes, density=0.2, format='csr', random_state=rng, dtype=np.float32,
+                       data_rvs=lambda size: rng.integers(1, 20, size=size))
+    genes = np.array([f'gene{i}' for i in range(n_genes)])
+    os.makedirs(directory)
+    scipy.io.mmwrite(os.path.join(directory, 'matrix.mtx'), counts.T.tocoo())
+    with open(os.path.join(directory, 'barcodes.tsv'), 'w') as fh:
+        fh.writelines(f'CELL{i}-1\n' for i in range(n_cells))
+    with open(os.path.join(directory, 'features.tsv'), 'w') as fh:
+        fh.writelines(f'ENSG{i}\t{gene}\tGene Expression\n' for i, gene in enumerate(genes))
+    return counts, genes
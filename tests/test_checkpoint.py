@@ -0,0 +1,62 @@
+import os
+
+import checkpoint
+import database_connections
+import ingest
+from benchmark import make_synthetic_experiment
+from database_connections import count_rows, insert_data
+from local_backend import LocalMilvusClient
+
+insert_columns = LocalMilvusClient.insert_columns
+
+
+def record_inserts(monkeypatch, fail_from=None):
+    """
+    Record the first key of every batch sent to the local backend, failing those from fail_from on.
+    """
+    sent = []
+
+    def insert(self, collection_name, keys, *args, **kwargs):
+        if fail_from is not None and keys[0] >= fail_from:
+            raise ConnectionError('connection reset')
+        sent.append(int(keys[0]))
+        return insert_columns(self, collection_name, keys, *args, **kwargs)
+
+    monkeypatch.setattr(LocalMilvusClient, 'insert_columns', insert)
+    return sent
+
+
+def test_interrupted_insert_resumes_from_checkpoint(workspace, monkeypatch):
+    filename, _ = make_synthetic_experiment(1, 1000, 60)
+    monkeypatch.setattr(ingest.time, 'sleep', lambda seconds: None)
+    sent = record_inserts(monkeypatch, fail_from=100600)
+    assert insert_data('resumed', filename, chunk_size=200) == 1
+    assert sorted(sent) == [100000, 100200, 100400]
+
+    # The second run neither refits the projection nor re-sends acknowledged batches
+    def no_refit(*args, **kwargs):
+        raise AssertionError('the projection was fitted again')
+
+    monkeypatch.setattr(database_connections, 'fit_projection', no_refit)
+    sent = record_inserts(monkeypatch)
+    assert insert_data('resumed', filename, chunk_size=200) == 0
+    assert sorted(sent) == [100600, 100800]
+    assert count_rows('resumed', filename) == 1000
+
+
+def test_touched_source_is_not_ingested_again(workspace, monkeypatch):
+    filename, _ = make_synthetic_experiment(1, 300, 60)
+    assert insert_data('touched', filename) == 0
+    sent = record_inserts(monkeypatch)
+
+    # A new mtime with the same contents is re-hashed once and keeps the checkpoint
+    os.utime(os.path.join('data', filename), (1, 1))
+    assert insert_data('touched', filename) == 0
+
+    # Unchanged size and mtime: the recorded hash is reused instead of reading the file
+    def no_hash(path):
+        raise AssertionError('the source was hashed again')
+
+    monkeypatch.setattr(checkpoint, 'file_sha256', no_hash)
+    assert insert_data('touched', filename) == 0
+    assert sent == []
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from analysis import get_similar_genes
+from database_connections import find_similarities, insert_data
+from gene_index import top_n_columns
+from ingest import experiment_primary_keys
+
+
+def test_top_n_columns_breaks_ties_by_column():
+    values = np.array([[1, 3, 3, 0, 3], [2, 2, 2, 2, 2]], dtype=np.float32)
+    indices, top_values = top_n_columns(values, 2)
+    np.testing.assert_array_equal(indices, [[1, 2], [0, 1]])
+    np.testing.assert_array_equal(top_values, [[3, 3], [2, 2]])
+
+
+def test_index_and_matrix_rank_tied_genes_alike(workspace):
+    # Few distinct expression levels, so most cells have ties at every cutoff
+    values = np.random.default_rng(0).integers(0, 4, size=(120, 60)).astype(np.float32)
+    frame = pd.DataFrame(values, columns=[f'gene{i}' for i in range(60)], index=experiment_primary_keys(1, 120))
+    frame.to_csv('data/ex_1_tied.csv')
+    assert insert_data('tied', 'ex_1_tied.csv') == 0
+    similarity = find_similarities('tied', [100000, 100001, 100002], limit=10)
+
+    indexed = get_similar_genes((similarity,), 'ex_1_tied.csv', top_n=7, collection='tied')
+    ranked = get_similar_genes((similarity,), 'ex_1_tied.csv', top_n=7)
+    pd.testing.assert_frame_equal(indexed, ranked)
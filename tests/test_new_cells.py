@@ -0,0 +1,16 @@
+import numpy as np
+
+from conftest import write_10x
+from database_connections import insert_data, search_new_cells
+
+
+def test_search_new_cells_from_10x_directory(workspace):
+    write_10x('data/ex_1_tenx', n_cells=300, n_genes=80)
+    assert insert_data('tenx', 'ex_1_tenx') == 0
+
+    # The stored cells themselves, read back from disk, find themselves first
+    results = search_new_cells('tenx', 'data/ex_1_tenx', limit=3)
+    assert len(results) == 300
+    assert list(results)[:2] == ['CELL0-1', 'CELL1-1']
+    best = np.array([matches[0][0] for matches in results.values()])
+    np.testing.assert_array_equal(best, np.arange(300) + 100000)
@@ -0,0 +1,27 @@
+import numpy as np
+from sklearn.decomposition import PCA, TruncatedSVD
+
+from benchmark import make_synthetic_experiment
+from database_connections import check_streaming_pca
+from matrix_cache import load_matrix
+from projection import variance_shortfall
+
+
+def test_streaming_pca_passes_check(workspace):
+    filename, _ = make_synthetic_experiment(1, 2000, 200)
+    passed, shortfall = check_streaming_pca(filename, read_rows=500)
+    assert passed
+    assert shortfall < 0.01
+
+
+def test_variance_shortfall_flags_faulty_fits(workspace):
+    filename, _ = make_synthetic_experiment(1, 2000, 200)
+    values = np.asarray(load_matrix(f'data/{filename}').values)
+    reference = PCA(n_components=50, svd_solver='arpack').fit(values).components_
+
+    assert variance_shortfall(values, reference, reference[:10]) < 1e-9
+    # Fit without centering, and fit on the first tenth of the cells only
+    uncentered = TruncatedSVD(n_components=50, random_state=0).fit(values).components_
+    partial = PCA(n_components=50, svd_solver='arpack').fit(values[:200]).components_
+    assert variance_shortfall(values, reference, uncentered) > 0.02
+    assert variance_shortfall(values, reference, partial) > 0.02
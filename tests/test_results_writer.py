@@ -0,0 +1,29 @@
+import os
+
+from results_writer import ResultsWriter, read_results, write_results
+
+
+def test_results_are_partitioned_by_the_experiment_of_the_matched_file(tmp_path):
+    path = str(tmp_path / 'similar_cells')
+    # 7 and 8 are CSV ids of a collection ingested before experiment keys; 200001 has no file name
+    similarity = {5: [(7, 0.9), (100003, 0.8), (200001, 0.7)], 6: [(8, 0.5)]}
+    file_names = {7: 'ex_3_a.csv', 100003: 'ex_1_b.csv', 8: 'ex_3_a.csv'}
+    assert write_results(path, similarity, file_names) == 4
+
+    assert sorted(os.listdir(path)) == ['experiment=1', 'experiment=2', 'experiment=3']
+    results = read_results(path)
+    assert results['query_id'].tolist() == [5, 5, 5, 6]
+    assert results['rank'].tolist() == [0, 1, 2, 0]
+    assert results['experiment'].tolist() == [3, 1, 2, 3]
+    assert read_results(path, experiments=[3])['neighbor_id'].tolist() == [7, 8]
+    assert read_results(path, query_ids=[6])['neighbor_id'].tolist() == [8]
+
+
+def test_each_writer_session_appends_its_own_part_files(tmp_path):
+    path = str(tmp_path / 'similar_cells')
+    for _ in range(2):
+        with ResultsWriter(path) as writer:
+            writer.write({1: [(100001, 1.0)]}, {100001: 'ex_1_a.csv'})
+            writer.write({2: [(100002, 0.5)]}, {100002: 'ex_1_a.csv'})
+    assert len(os.listdir(os.path.join(path, 'experiment=1'))) == 2
+    assert sorted(read_results(path)['query_id'].tolist()) == [1, 1, 2, 2]
@@ -0,0 +1,28 @@
+import numpy as np
+
+from database_connections import get_client
+from ingest import Batch, run_pipeline
+from neighbor_cache import get_neighbor_cache
+from schema import ensure_collection, migrate_padded_collection
+
+
+def test_migration_partitions_rows_and_invalidates_cached_neighbors(workspace):
+    client = get_client()
+    ensure_collection(client, 'padded', 64)
+    vectors = np.zeros((300, 64), dtype=np.float32)
+    vectors[:, :10] = np.random.default_rng(0).random((300, 10))
+    keys = np.r_[np.arange(150) + 100000, np.arange(150) + 200000]
+    run_pipeline(client, 'padded', iter([Batch(0, keys[:150], vectors[:150], 'ex_1_a.csv'),
+                                         Batch(150, keys[150:], vectors[150:], 'ex_2_b.csv')]))
+    # Neighbors cached for an earlier collection of the same name
+    cache = get_neighbor_cache()
+    cache.put_many('compact', {100000: [(100000, 1.0), (123, 0.5)]}, limit=2)
+
+    migrate_padded_collection(client, 'padded', 'compact', batch_size=100)
+
+    assert cache.get_many('compact', [100000], limit=2) == ({}, [100000])
+    for experiment_num in (1, 2):
+        rows = client.query(collection_name='compact', filter='primary_key >= 0', output_fields=['primary_key'],
+                            partition_names=[f'experiment_{experiment_num}'], limit=1000)
+        np.testing.assert_array_equal(np.sort([row['primary_key'] for row in rows]),
+                                      np.arange(150) + experiment_num * 100000)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from analysis import get_similar_genes
+from conftest import write_10x
+from database_connections import find_similarities, insert_data
+from service import Service
+
+
+def test_similar_genes_of_sparse_experiment(workspace):
+    counts, genes = write_10x('data/ex_1_tenx', n_cells=300, n_genes=80)
+    assert insert_data('tenx', 'ex_1_tenx') == 0
+    similarity = find_similarities('tenx', [100000, 100007], limit=5)
+
+    # Without a collection the sparse matrix itself is ranked; with one the index is used
+    ranked = get_similar_genes((similarity,), 'ex_1_tenx', top_n=5)
+    indexed = get_similar_genes((similarity,), 'ex_1_tenx', top_n=5, collection='tenx')
+    assert len(ranked) == 10
+    np.testing.assert_array_equal(ranked['cell_ids'], indexed['cell_ids'])
+
+    row = int(ranked['cell_ids'].iloc[0]) - 100000
+    expression = counts[row].toarray().ravel()
+    top = ranked.iloc[0, 1:].to_numpy(dtype=str)
+    # Ranked most to least expressed
+    assert np.all(np.diff(expression[[list(genes).index(gene) for gene in top]]) <= 0)
+
+
+def test_service_genes_of_sparse_experiment(workspace):
+    write_10x('data/ex_1_tenx', n_cells=300, n_genes=80)
+    answer = Service().handle('genes', {'file': 'ex_1_tenx', 'ids': [100003, 999], 'top_n': 4})
+    assert list(answer['results']) == ['100003']
+    assert len(answer['results']['100003']) == 4
+    assert answer['missing'] == [999]
+
+
+def test_similar_genes_by_legacy_csv_ids(workspace, capsys):
+    # Collections ingested before experiment keys were used everywhere are keyed by CSV ids
+    values = np.random.default_rng(0).random((20, 6))
+    frame = pd.DataFrame(values, columns=[f'gene{i}' for i in range(6)], index=np.arange(20) + 724)
+    frame.to_csv('data/ex_2_legacy.csv')
+    similarity = {724: [(724, 1.0), (730, 0.9), (5, 0.5)]}
+
+    out = get_similar_genes((similarity,), 'ex_2_legacy.csv', top_n=1)
+    assert out['cell_ids'].tolist() == [724, 730]
+    assert out.iloc[1, 1] == f'gene{np.argmax(values[6])}'
+    assert '1 of 3 matched cells are not in ex_2_legacy.csv' in capsys.readouterr().out
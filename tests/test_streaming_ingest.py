@@ -0,0 +1,17 @@
+import numpy as np
+
+from benchmark import make_synthetic_experiment
+from database_connections import get_client, insert_data_streaming
+
+
+def stored_keys(collection_name):
+    rows = get_client().query(collection_name=collection_name, filter='primary_key >= 0',
+                              output_fields=['primary_key'], limit=100000)
+    return np.sort([row['primary_key'] for row in rows])
+
+
+def test_read_block_not_a_multiple_of_chunk_size(workspace):
+    # Read blocks of 1500 and 500 rows, each ending in a chunk shorter than 400
+    filename, _ = make_synthetic_experiment(1, 2000, 60)
+    assert insert_data_streaming('streamed', filename, chunk_size=400, read_rows=1500) == 0
+    np.testing.assert_array_equal(stored_keys('streamed'), np.arange(2000) + 100000)